@@ -1,7 +1,17 @@
 # api_parser.py
+import time
+import threading
 import requests
-import ujson as json
-from config import get_timeout_config
+import codec as json
+from datetime import datetime, timedelta, timezone
+from config import get_config_value, get_timeout_config
+from site_manager import get_sites, update_sites
+import response_cache
+import poster_index
+import background
+import circuit_breaker
+import latency_tracker
+import metrics
 
 # 創建全局 Session 對象，使用連接池管理，防止連接洩漏
 _session = None
@@ -21,157 +31,612 @@ def get_session():
         _session.mount('https://', adapter)
     return _session
 
-def process_api_request(base_url, params, logger, ssl_verify=True, site_name=None):
-    site_info = f"站點 [{site_name}] " if site_name else ""
+def normalize_base_url(base_url):
+    """補上 scheme、去掉結尾斜線;快取 / 統計等各處都以這個形式當站台 key。"""
     if not base_url.startswith('http'):
         base_url = 'http://' + base_url
-    
-    clean_base_url = base_url.rstrip('/')
-    api_url = f"{clean_base_url}/api.php/provide/vod/"
-    
-    # 構建完整的請求URL用於日誌
-    import urllib.parse
-    full_url = f"{api_url}?{urllib.parse.urlencode(params)}"
-    logger.info(f"{site_info}開始處理請求: {full_url} (SSL Verify: {ssl_verify})")
-    
+    return base_url.rstrip('/')
+
+
+def build_api_url(clean_base_url):
+    return f"{clean_base_url}/api.php/provide/vod/"
+
+
+def describe_invalid_json(response_text, prefix='API'):
+    """回應不是合法 JSON 時,依內容給出可讀的錯誤訊息(prefix 區分列表 / 詳情)。
+    只看開頭就能判斷,所以提早中止讀取、只留開頭幾百位元組的回應也能分類。"""
+    if response_text.strip() == "":
+        return f"{prefix}返回空響應，可能是站點已失效或API端點錯誤"
+    if response_text.lstrip().startswith('<'):
+        return f"{prefix}返回HTML頁面而非JSON，可能是站點已失效或需要登錄"
+    if len(response_text) < 10:
+        return f"{prefix}返回內容過短: '{response_text}'，可能是站點已失效"
+    if "暂不支持搜索" in response_text:
+        return "該站台暫不支持搜尋功能" if prefix == 'API' else "該站台暫不支持此功能"
+    if "不支持" in response_text:
+        return "該站台不支持此功能"
+    return f"{prefix}返回無效JSON格式，響應內容: {response_text[:100]}..."
+
+
+def build_list_result(list_data, params, logger):
+    """把列表 API 的 JSON 轉成回給前端的結果。
+
+    回傳 (result, videos):videos 為 None 表示 result 已是最終結果(錯誤 / 無資料),
+    否則呼叫端要再補圖片後用 finish_list_result 組出最終結果。
+    """
+    if list_data.get('code') != 1:
+        if 'wd' in params and list_data.get('total') == 0:
+            logger.info("搜索無結果。")
+            return {'status': 'success', 'page': 0, 'pagecount': 0, 'total': 0, 'list': [], 'class': list_data.get('class', [])}, None
+        logger.error(f"API(列表)返回錯誤: {list_data.get('msg', '未知錯誤')}")
+        return {'status': 'error', 'message': list_data.get('msg', 'API返回錯誤狀態碼')}, None
+
+    videos = list_data.get('list', [])
+    if not videos:
+        return {'status': 'success', 'page': list_data.get('page'), 'pagecount': list_data.get('pagecount'), 'total': list_data.get('total'), 'list': [], 'class': list_data.get('class', [])}, None
+    return None, videos
+
+
+def finish_list_result(list_data, videos):
+    return {
+        'status': 'success',
+        'page': list_data.get('page'),
+        'pagecount': list_data.get('pagecount'),
+        'total': list_data.get('total'),
+        'list': videos,
+        'class': list_data.get('class', [])
+    }
+
+
+def absolute_pic_url(clean_base_url, pic_url):
+    if pic_url and not pic_url.startswith('http'):
+        return f"{clean_base_url}/{pic_url.lstrip('/')}"
+    return pic_url
+
+
+def known_pics(clean_base_url, videos):
+    """查海報索引:回傳 (已知的 {vod_id: 海報}, 還需要補圖的 vod_id 清單)。"""
+    vod_ids = [str(video['vod_id']) for video in videos]
+    pics = poster_index.lookup(clean_base_url, vod_ids)
+    return pics, [vid for vid in vod_ids if vid not in pics]
+
+
+def absorb_detail_response(clean_base_url, detail_data, pics):
+    """吸收 ac=videolist 回應:海報併進 pics 與持久索引,完整播放清單順手放進詳情快取。
+    回傳這次拆好的精簡詳情 {vod_id 字串: detail}。"""
+    if not detail_data or detail_data.get('code') != 1:
+        return {}
+    new_pics = {}
+    details = {}
+    for item in detail_data.get('list') or []:
+        if not isinstance(item, dict) or 'vod_id' not in item:
+            continue
+        vid = str(item['vod_id'])
+        # 優先使用詳細資訊中的圖片，因為它更可靠
+        new_pics[vid] = absolute_pic_url(clean_base_url, item.get('vod_pic', ''))
+        details[vid] = parse_detail_item(item)
+        response_cache.put_detail(clean_base_url, vid, details[vid])
+    pics.update(new_pics)
+    poster_index.remember(clean_base_url, new_pics)
+    return details
+
+
+def apply_pics(videos, pics):
+    """把海報寫進列表項;查不到的清成空字串(列表回應本身的 vod_pic 不可靠)。"""
+    for video in videos:
+        video['vod_pic'] = pics.get(str(video['vod_id']), '')
+
+
+def parse_play_sources(play_from, play_url):
+    """把 vod_play_from / vod_play_url 一次走完,拆成每條線路的平行陣列:
+    {'flag', 'names': [...], 'urls': [...], 'count'}。$$$ 分線路、# 分集、集內以 $ 分「名稱$網址」
+    (剛好一個 $ 的才算一集)。比每集一個 {'name','url'} dict 省物件也省 JSON 體積,
+    詳情快取存的就是這個形式。"""
+    sources = []
+    urls_by_source = play_url.split('$$$')
+    for i, flag in enumerate(play_from.split('$$$')):
+        names, urls = [], []
+        if i < len(urls_by_source):
+            for episode in urls_by_source[i].strip().split('#'):
+                name, sep, url = episode.partition('$')
+                if sep and '$' not in url:
+                    names.append(name)
+                    urls.append(url)
+        sources.append({'flag': flag, 'names': names, 'urls': urls, 'count': len(names)})
+    return sources
+
+
+def parse_detail_item(item):
+    """一筆 ac=videolist 的影片 → 精簡(columnar)詳情:vod_name / vod_pic / sources。"""
+    return {
+        'sources': parse_play_sources(item.get('vod_play_from') or '', item.get('vod_play_url') or ''),
+        'vod_name': item.get('vod_name', ''),
+        'vod_pic': item.get('vod_pic', ''),
+    }
+
+
+def expand_detail(detail):
+    """精簡詳情 → 舊格式:data = [{'flag', 'episodes': [{'name', 'url'}, ...]}]。"""
+    return {
+        'data': [{'flag': source['flag'],
+                  'episodes': [{'name': n, 'url': u} for n, u in zip(source['names'], source['urls'])]}
+                 for source in detail['sources']],
+        'vod_name': detail['vod_name'],
+        'vod_pic': detail['vod_pic'],
+    }
+
+
+def detail_result(detail, compact=False):
+    return {'status': 'success', **(detail if compact else expand_detail(detail))}
+
+
+DEFAULT_EPISODE_WINDOW = 100
+MAX_EPISODE_WINDOW = 1000
+
+
+def slice_detail(detail, source=None, offset=None, limit=None, around=None, compact=False):
+    """從(快取的)精簡詳情切出單一線路的一段集數,給上千集的連續劇分段載入。
+
+    source 可給線路索引或線路名稱(flag),預設第一條有集數的線路;
+    offset / limit 指定區段,或給 around(集數索引,從 0 起)取以它為中心的一段。
+    回傳所有線路的名稱與集數(讓前端能切換線路)、這段的位置與內容;source 找不到時丟 ValueError。
+    """
+    sources = detail['sources']
+    if source is None:
+        index = next((i for i, src in enumerate(sources) if src['count']), 0)
+    elif isinstance(source, int) or str(source).isdigit():
+        index = int(source)
+    else:
+        index = next((i for i, src in enumerate(sources) if src['flag'] == source), -1)
+    if not 0 <= index < len(sources):
+        raise ValueError(f"找不到線路: {source}")
+
+    chosen = sources[index]
+    total = chosen['count']
+    limit = max(1, min(int(limit or DEFAULT_EPISODE_WINDOW), MAX_EPISODE_WINDOW))
+    if around is not None:
+        offset = int(around) - limit // 2
+    offset = max(0, min(int(offset or 0), max(0, total - limit)))
+    names = chosen['names'][offset:offset + limit]
+    urls = chosen['urls'][offset:offset + limit]
+
+    result = {
+        'status': 'success',
+        'vod_name': detail['vod_name'],
+        'vod_pic': detail['vod_pic'],
+        'sources': [{'flag': src['flag'], 'count': src['count']} for src in sources],
+        'source': index,
+        'offset': offset,
+        'limit': limit,
+        'total': total,
+    }
+    if compact:
+        result.update(names=names, urls=urls)
+    else:
+        result['episodes'] = [{'name': n, 'url': u} for n, u in zip(names, urls)]
+    return result
+
+
+def decode_body(content, content_type):
+    """回應位元組 → 文字:有宣告 charset 就照用,否則當 UTF-8(MacCMS 站幾乎都是)。"""
+    charset = 'utf-8'
+    for part in (content_type or '').split(';')[1:]:
+        name, _, value = part.strip().partition('=')
+        if name.lower() == 'charset' and value:
+            charset = value.strip('"\' ')
     try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        timeout_seconds = get_timeout_config()
-        session = get_session()
-        list_response = session.get(api_url, headers=headers, params=params, timeout=timeout_seconds, verify=ssl_verify)
-        
-        # 檢查響應內容，如果是 "暂不支持搜索" 等特殊情況，直接返回錯誤
-        response_text = list_response.text.strip()
-        if response_text == "暂不支持搜索" or response_text == "不支持":
-            return {'status': 'error', 'message': f"該站台暫不支持搜尋功能"}
-        
-        # 檢查HTTP狀態碼
-        if list_response.status_code != 200:
-            return {'status': 'error', 'message': f"站台返回HTTP {list_response.status_code} 錯誤"}
-        
-        try:
-            list_data = list_response.json()
-        except ValueError:
-            # 獲取響應內容以便調試
-            try:
-                response_text = list_response.text if 'list_response' in locals() else "無法獲取響應內容"
-                response_status = list_response.status_code if 'list_response' in locals() else "未知"
-
-                # 提供更詳細的錯誤信息
-                if response_text.strip() == "":
-                    error_msg = "API返回空響應，可能是站點已失效或API端點錯誤"
-                elif response_text.startswith('<'):
-                    error_msg = "API返回HTML頁面而非JSON，可能是站點已失效或需要登錄"
-                elif len(response_text) < 10:
-                    error_msg = f"API返回內容過短: '{response_text}'，可能是站點已失效"
-                elif "暂不支持搜索" in response_text:
-                    error_msg = "該站台暫不支持搜尋功能"
-                elif "不支持" in response_text:
-                    error_msg = "該站台不支持此功能"
-                else:
-                    error_msg = f"API返回無效JSON格式，響應內容: {response_text[:100]}..."
-
-                return {
-                    'status': 'error',
-                    'message': error_msg
-                }
-            except Exception as debug_error:
-                return {'status': 'error', 'message': f"返回的不是有效的JSON格式: {e}"}
-        except RecursionError:
-            return {'status': 'error', 'message': 'API 返回的 JSON 結構過於複雜，無法解析'}
+        return content.decode(charset, errors='replace').lstrip('\ufeff')
+    except LookupError:
+        return content.decode('utf-8', errors='replace').lstrip('\ufeff')
 
-        if list_data.get('code') != 1:
-            if 'wd' in params and list_data.get('total') == 0:
-                 logger.info("搜索無結果。")
-                 return {'status': 'success', 'page': 0, 'pagecount': 0, 'total': 0, 'list': [], 'class': list_data.get('class', [])}
-            logger.error(f"API(列表)返回錯誤: {list_data.get('msg', '未知錯誤')}")
-            return {'status': 'error', 'message': list_data.get('msg', 'API返回錯誤狀態碼')}
-
-        videos = list_data.get('list', [])
-        if not videos:
-            return {'status': 'success', 'page': list_data.get('page'), 'pagecount': list_data.get('pagecount'), 'total': list_data.get('total'), 'list': [], 'class': list_data.get('class', [])}
-
-        # 統一處理流程：無論是瀏覽還是搜尋，都透過第二次請求獲取最可靠的圖片路徑
-        vod_ids = [str(video['vod_id']) for video in videos]
-        ids_string = ','.join(vod_ids)
-        detail_params = {'ac': 'videolist', 'ids': ids_string}
-        session = get_session()
-        detail_response = session.get(api_url, headers=headers, params=detail_params, timeout=timeout_seconds, verify=ssl_verify)
-        detail_response.raise_for_status()
+
+# --- 有上限的串流讀取 ---
+# 上游回應不再整包讀進記憶體:邊讀邊累計,超過該種類的上限就中止(config.json 的 max_response_kb 可覆寫);
+# 開頭看得出不是 JSON(第一個字元是 '<',或 Content-Type 是圖片 / 影片之類的二進位)就只留開頭幾百位元組,
+# 後面不讀了 —— describe_invalid_json 靠開頭就能分類錯誤。
+# 很多 MacCMS 站回 JSON 時 Content-Type 標的是 text/html,所以 text/html 本身不算「不是 JSON」,要看開頭。
+DEFAULT_BODY_LIMITS_KB = {
+    'list': 1024,       # ac=list 一頁 20 筆,正常只有幾十 KB
+    'videolist': 4096,  # 帶完整簡介與播放清單的 ac=videolist
+    'detail': 4096,     # 單片詳情(長篇連續劇的播放清單可能很長)
+}
+_CHUNK_SIZE = 16 * 1024
+_SNIFF_BYTES = 512
+_BINARY_TYPES = ('image/', 'video/', 'audio/', 'application/octet-stream', 'application/zip')
+
+
+class ResponseTooLarge(Exception):
+    def __init__(self, limit):
+        super().__init__(f"回應超過 {limit // 1024} KB 上限")
+        self.limit = limit
+
+
+def body_limit(kind):
+    limits = get_config_value('max_response_kb', {})
+    if isinstance(limits, dict) and kind in limits:
+        return int(limits[kind]) * 1024
+    return DEFAULT_BODY_LIMITS_KB[kind] * 1024
+
+
+def body_kind(query):
+    return 'videolist' if query.get('ac') == 'videolist' else 'list'
+
+
+class BoundedBody:
+    """串流讀取的緩衝:feed 一段段收,回 False 代表可以停止讀取;超過上限丟 ResponseTooLarge。"""
+
+    def __init__(self, limit, content_type, content_length=None):
+        self.limit = limit
+        self.content_type = content_type or ''
+        self.chunks = []
+        self.size = 0
+        self.sniffed = False
+        self.aborted = False
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            raise ResponseTooLarge(limit)
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if not self.sniffed:
+            head = b''.join(self.chunks).lstrip(b'\xef\xbb\xbf \t\r\n')
+            media_type = self.content_type.split(';')[0].strip().lower()
+            if head or media_type.startswith(_BINARY_TYPES):
+                self.sniffed = True
+                if head[:1] == b'<' or media_type.startswith(_BINARY_TYPES):
+                    self.aborted = True
+                    return False
+        if self.size > self.limit:
+            raise ResponseTooLarge(self.limit)
+        return True
+
+    def text(self):
+        body = b''.join(self.chunks)
+        if self.aborted:
+            body = body[:_SNIFF_BYTES]
+        return decode_body(body, self.content_type)
+
+
+def read_bounded(response, kind):
+    """讀 requests 的串流回應(須以 stream=True 送出),回傳解碼後文字;讀完或中止後釋放連線。"""
+    with response:
+        body = BoundedBody(body_limit(kind), response.headers.get('Content-Type'),
+                           response.headers.get('Content-Length'))
+        for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+            if not body.feed(chunk):
+                break
+        return body.text()
+
+
+def too_large_result(clean_base_url, kind, error, logger, site_info=''):
+    metrics.upstream(clean_base_url, kind, 'too_large')
+    circuit_breaker.record_failure(clean_base_url, '回應過大')
+    logger.error(f"{site_info}{error},已中止讀取")
+    return {'status': 'error', 'message': f"站台{error}，已中止讀取"}
+
+
+# --- 每站的列表策略 ---
+# 有些站 ac=list 本身就帶可靠的 vod_pic;有些站 ac=videolist 直接支援分頁瀏覽 / 搜尋。
+# 這些能力學到後記在 sites.json 的站台記錄上(list_mode / list_mode_checked_at),之後挑最省的做法:
+LIST_MODE_TWO_CALL = 'two_call'    # ac=list + ac=videolist&ids= 補圖(預設,最保險)
+LIST_MODE_LIST_PIC = 'list_pic'    # ac=list 的圖就可靠,不必補圖
+LIST_MODE_VIDEOLIST = 'videolist'  # 直接用 ac=videolist 分頁,一次拿到圖(順便填詳情快取)
+_LIST_MODE_RELEARN_DAYS = 7
+
+# 本程序已經排過學習的站台(學習中或學完)-> 排入時間。background.submit 的去重只在工作還在排隊時有效,
+# 學完後 sites.json 的快取還沒更新前的那幾頁仍會拿到 mode None,沒有這份紀錄就會對同一站一再試打
+_list_mode_lock = threading.Lock()
+_list_mode_claimed = {}
+
+# videolist 模式拿到的是完整詳情(整串播放網址、簡介…),列表只回這些欄位,不讓回應膨脹好幾倍
+_LIST_FIELDS = ('vod_id', 'vod_name', 'type_id', 'type_name', 'vod_en', 'vod_time', 'vod_remarks',
+                'vod_play_from', 'vod_pic', 'vod_year', 'vod_area', 'vod_lang', 'vod_class')
+
+
+def _site_record(clean_base_url):
+    return next((s for s in get_sites() if normalize_base_url(s.get('url', '')) == clean_base_url), None)
+
+
+def site_list_mode(clean_base_url):
+    """站台記錄上學到的列表策略;沒學過、或太久沒重新確認就回 None(這次會順便學)。"""
+    site = _site_record(clean_base_url)
+    if not site or site.get('list_mode') not in (LIST_MODE_TWO_CALL, LIST_MODE_LIST_PIC, LIST_MODE_VIDEOLIST):
+        return None
+    try:
+        checked_at = datetime.fromisoformat(site.get('list_mode_checked_at', ''))
+    except (TypeError, ValueError):
+        return None
+    if datetime.now(timezone.utc) - checked_at > timedelta(days=_LIST_MODE_RELEARN_DAYS):
+        return None
+    return site['list_mode']
+
+
+def _save_list_mode(clean_base_url, mode, logger):
+    def _apply(sites):
+        for site in sites:
+            if normalize_base_url(site.get('url', '')) == clean_base_url:
+                site['list_mode'] = mode
+                site['list_mode_checked_at'] = datetime.now(timezone.utc).isoformat()
+
+    # 沒在站台清單裡的網址(例如歷史紀錄帶來的外站)就不記
+    if _site_record(clean_base_url):
+        update_sites(_apply)
+        logger.info(f"站台 {clean_base_url} 列表策略: {mode}")
+
+
+def _claim_list_mode_learning(clean_base_url):
+    """這個站台本程序在重新學習的週期內還沒學過才回 True(並記下),確保每站只學一次。"""
+    now = time.time()
+    with _list_mode_lock:
+        claimed_at = _list_mode_claimed.get(clean_base_url)
+        if claimed_at is not None and now - claimed_at < _LIST_MODE_RELEARN_DAYS * 86400:
+            return False
+        _list_mode_claimed[clean_base_url] = now
+        return True
+
+
+def _probe_videolist(clean_base_url, ssl_verify, logger):
+    """試打一次 ac=videolist 分頁:有分頁資訊、每筆都有圖、也帶分類清單,才值得改用單次呼叫。"""
+    if site_list_mode(clean_base_url) is not None:
+        return  # 另一個 worker 已經學好寫進 sites.json 了
+    mode = LIST_MODE_TWO_CALL
+    try:
+        response = get_session().get(build_api_url(clean_base_url), headers={'User-Agent': 'Mozilla/5.0'},
+                                     params={'ac': 'videolist', 'pg': 1},
+                                     timeout=get_timeout_config(), verify=ssl_verify, stream=True)
+        data = json.loads(read_bounded(response, 'videolist'))
+        items = data.get('list') if isinstance(data, dict) else None
+        if (response.status_code == 200 and data.get('code') == 1 and items and data.get('pagecount')
+                and data.get('class') and all(isinstance(v, dict) and v.get('vod_pic') for v in items)):
+            mode = LIST_MODE_VIDEOLIST
+    except Exception as e:
+        logger.info(f"站台 {clean_base_url} 不支援 ac=videolist 分頁: {e}")
+    _save_list_mode(clean_base_url, mode, logger)
+
+
+def _learn_list_mode(clean_base_url, list_pics, detail_pics, ssl_verify, logger):
+    """用剛完成的兩段式結果判斷站台能力:ac=list 的圖跟詳情一致 → list_pic;否則背景試 videolist 分頁。"""
+    if not _claim_list_mode_learning(clean_base_url):
+        return
+    checked = {vid: pic for vid, pic in detail_pics.items() if pic}
+    if checked and all(list_pics.get(vid) == pic for vid, pic in checked.items()):
+        background.submit(('list_mode', clean_base_url), _save_list_mode, clean_base_url, LIST_MODE_LIST_PIC, logger)
+    else:
+        background.submit(('list_mode', clean_base_url), _probe_videolist, clean_base_url, ssl_verify, logger)
+
+
+def _parse_json_text(text):
+    """回傳 (dict, 錯誤結果);解析失敗時 dict 為 None。"""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None, {'status': 'error', 'message': describe_invalid_json(text)}
+    except RecursionError:
+        return None, {'status': 'error', 'message': 'API 返回的 JSON 結構過於複雜，無法解析'}
+    if not isinstance(data, dict):
+        return None, {'status': 'error', 'message': describe_invalid_json(text)}
+    return data, None
+
+
+def _videolist_page(clean_base_url, params, status, text, logger):
+    """videolist 模式的單次呼叫結果;回應不堪用時回 None,由呼叫端退回兩段式。"""
+    if status != 200:
+        return None
+    data, _ = _parse_json_text(text)
+    if data is None:
+        return None
+    result, videos = build_list_result(data, params, logger)
+    if videos is None:
+        return result if result['status'] == 'success' else None
+    pics = {}
+    absorb_detail_response(clean_base_url, data, pics)
+    videos = [{k: v[k] for k in _LIST_FIELDS if k in v} for v in videos if isinstance(v, dict) and 'vod_id' in v]
+    apply_pics(videos, pics)
+    return finish_list_result(data, videos)
+
+
+def list_flow(clean_base_url, params, logger, ssl_verify=True, site_name=None):
+    """列表 / 搜尋 / 分類的完整流程,寫成 generator 讓同步(requests)與 asyncio 兩種驅動共用:
+    每次 yield 一組要對 API 端點送的 query params,驅動端實際送出後 send 回 (HTTP 狀態碼, 文字);
+    流程結束時以 return 回傳結果 dict。網路例外(逾時、連線失敗)由驅動端處理。
+    """
+    site_info = _site_info(site_name)
+    mode = site_list_mode(clean_base_url)
+
+    if mode == LIST_MODE_VIDEOLIST:
+        status, text = yield {**params, 'ac': 'videolist'}
+        result = _videolist_page(clean_base_url, params, status, text, logger)
+        if result is not None:
+            return result
+        logger.warning(f"{site_info}ac=videolist 分頁失效,改回兩段式")
+        background.submit(('list_mode', clean_base_url), _save_list_mode, clean_base_url, LIST_MODE_TWO_CALL, logger)
+        mode = LIST_MODE_TWO_CALL
+
+    status, list_text = yield params
+
+    # 檢查響應內容，如果是 "暂不支持搜索" 等特殊情況，直接返回錯誤
+    response_text = list_text.strip()
+    if response_text == "暂不支持搜索" or response_text == "不支持":
+        return {'status': 'error', 'message': f"該站台暫不支持搜尋功能"}
+
+    # 檢查HTTP狀態碼
+    if status != 200:
+        return {'status': 'error', 'message': f"站台返回HTTP {status} 錯誤"}
+
+    list_data, error = _parse_json_text(list_text)
+    if list_data is None:
+        return error
+
+    result, videos = build_list_result(list_data, params, logger)
+    if videos is None:
+        return result
+
+    # 統一處理流程：無論是瀏覽還是搜尋，都透過第二次請求獲取最可靠的圖片路徑;
+    # 海報索引裡已有的 id 不必再要,站台的 ac=list 圖可靠時也不必,整頁都有圖就整個省掉這次請求
+    list_pics = {str(v['vod_id']): absolute_pic_url(clean_base_url, v.get('vod_pic') or '') for v in videos}
+    pics, missing_ids = known_pics(clean_base_url, videos)
+    if mode == LIST_MODE_LIST_PIC:
+        pics.update({vid: pic for vid, pic in list_pics.items() if pic})
+        missing_ids = [vid for vid in missing_ids if vid not in pics]
+
+    if missing_ids:
+        status, detail_text = yield {'ac': 'videolist', 'ids': ','.join(missing_ids)}
+        if status >= 400:
+            return {'status': 'error', 'message': f"網絡連接失敗，請檢查URL或您的網絡連接。"}
         try:
-            detail_data = detail_response.json()
+            detail_data = json.loads(detail_text)
+        except ValueError:
+            return {'status': 'error', 'message': describe_invalid_json(detail_text)}
         except RecursionError:
             logger.error(f"{site_info}詳情 API 返回複雜 JSON，略過圖片更新")
             detail_data = None
-        
-        detail_videos_map = {}
-        if detail_data.get('code') == 1:
-            detail_videos_map = {str(v['vod_id']): v for v in detail_data.get('list', [])}
-
-        for video in videos:
-            vod_id_str = str(video['vod_id'])
-            if vod_id_str in detail_videos_map:
-                detail_video = detail_videos_map[vod_id_str]
-                # 優先使用詳細資訊中的圖片，因為它更可靠
-                pic_url = detail_video.get('vod_pic', '')
-                if pic_url and not pic_url.startswith('http'):
-                    video['vod_pic'] = f"{clean_base_url}/{pic_url.lstrip('/')}"
-                else:
-                    video['vod_pic'] = pic_url
-            else:
-                video['vod_pic'] = ''
-
-        return {
-            'status': 'success',
-            'page': list_data.get('page'),
-            'pagecount': list_data.get('pagecount'),
-            'total': list_data.get('total'),
-            'list': videos,
-            'class': list_data.get('class', [])
-        }
+        detail_pics = {}
+        absorb_detail_response(clean_base_url, detail_data if isinstance(detail_data, dict) else None, detail_pics)
+        pics.update(detail_pics)
+        if mode is None and detail_pics:
+            _learn_list_mode(clean_base_url, list_pics, detail_pics, ssl_verify, logger)
+
+    apply_pics(videos, pics)
+    return finish_list_result(list_data, videos)
+
+
+def process_api_request(base_url, params, logger, ssl_verify=True, site_name=None):
+    """列表 / 搜尋 / 分類。成功結果會進 response_cache,同一頁短時間內再要就不打上游。"""
+    clean_base_url = normalize_base_url(base_url)
+    cached, state = serve_cached_list(clean_base_url, params, logger, ssl_verify, site_name)
+    if state in ('fresh', 'stale'):
+        return cached
+    result = _fetch_list(clean_base_url, params, logger, ssl_verify, site_name)
+    return settle_list_result(clean_base_url, params, result, cached, logger, site_name)
+
+
+def serve_cached_list(clean_base_url, params, logger, ssl_verify, site_name):
+    """查 response_cache。回傳 (快取結果, 狀態);狀態 'fresh' / 'stale' 時呼叫端直接回傳快取即可,
+    'stale' 會順手排一個背景刷新。'expired' 的結果留給 settle_list_result 在上游失敗時墊用。"""
+    cached, state = response_cache.lookup_response(clean_base_url, params)
+    if state == 'fresh':
+        logger.info(f"{_site_info(site_name)}命中快取: {clean_base_url} {params}")
+    elif state == 'stale':
+        logger.info(f"{_site_info(site_name)}命中過期快取,先回舊資料並背景刷新: {clean_base_url} {params}")
+        background.submit(('refresh',) + response_cache.cache_key(clean_base_url, params),
+                          refresh_list, clean_base_url, params, logger, ssl_verify, site_name)
+    return cached, state
+
+
+def settle_list_result(clean_base_url, params, result, cached, logger, site_name):
+    """上游結果落地:成功就寫快取;失敗但手上有保留期內的舊資料 → 回舊資料並標 stale: true。"""
+    if result.get('status') == 'success':
+        response_cache.put_response(clean_base_url, params, result)
+        return result
+    if cached is not None:
+        logger.warning(f"{_site_info(site_name)}上游失敗({result.get('message')}),改回傳過期快取")
+        cached['stale'] = True
+        return cached
+    return result
+
+
+def refresh_list(clean_base_url, params, logger, ssl_verify=True, site_name=None):
+    """背景刷新一頁列表進快取(stale-while-revalidate 用)。"""
+    result = _fetch_list(clean_base_url, params, logger, ssl_verify, site_name)
+    response_cache.put_response(clean_base_url, params, result)
+    return result
+
+
+def _site_info(site_name):
+    return f"站點 [{site_name}] " if site_name else ""
+
+
+def metric_kind(params):
+    """指標用的請求種類:有關鍵字算 search,其餘(瀏覽 / 分類)算 list。"""
+    return 'search' if params.get('wd') else 'list'
+
+
+def record_latency(clean_base_url, kind, status_code, seconds, text=None):
+    """一次上游請求的耗時同時餵給自適應逾時與 /api/metrics;status_code 為 None 代表逾時。
+    有給 text 時,回的不是 JSON(空白 / HTML 頁)記為 invalid。逾時只計次,不當成耗時樣本。"""
+    if status_code is None:
+        latency_tracker.observe_timeout(clean_base_url)
+        outcome = 'timeout'
+    else:
+        latency_tracker.observe(clean_base_url, seconds)
+        if status_code >= 400:
+            outcome = 'http_error'
+        elif text is not None and text.lstrip()[:1] not in ('{', '['):
+            outcome = 'invalid'
+        else:
+            outcome = 'ok'
+    metrics.upstream(clean_base_url, kind, outcome, seconds)
+
+
+def circuit_open_result(clean_base_url, site_name, logger):
+    """熔斷中的站台不打上游,直接回錯誤(列表有舊快取時 settle_list_result 會改回舊資料)。"""
+    message = circuit_breaker.open_message(clean_base_url)
+    logger.info(f"{_site_info(site_name)}熔斷中,略過請求: {clean_base_url}")
+    return {'status': 'error', 'message': message, 'circuit_open': True}
+
 
+def _fetch_list(clean_base_url, params, logger, ssl_verify, site_name):
+    """用 requests 驅動 list_flow。"""
+    site_info = _site_info(site_name)
+    api_url = build_api_url(clean_base_url)
+    
+    # 構建完整的請求URL用於日誌
+    import urllib.parse
+    full_url = f"{api_url}?{urllib.parse.urlencode(params)}"
+    logger.info(f"{site_info}開始處理請求: {full_url} (SSL Verify: {ssl_verify})")
+    
+    if not circuit_breaker.allow(clean_base_url):
+        return circuit_open_result(clean_base_url, site_name, logger)
+
+    headers = {'User-Agent': 'Mozilla/5.0'}
+    timeout_seconds = latency_tracker.timeout_for(clean_base_url)
+    kind = metric_kind(params)
+    session = get_session()
+    flow = list_flow(clean_base_url, params, logger, ssl_verify, site_name)
+    try:
+        query = next(flow)
+        while True:
+            started = time.monotonic()
+            response = session.get(api_url, headers=headers, params=query, timeout=timeout_seconds,
+                                   verify=ssl_verify, stream=True)
+            text = read_bounded(response, body_kind(query))
+            record_latency(clean_base_url, kind, response.status_code, time.monotonic() - started, text)
+            circuit_breaker.record_response(clean_base_url, response.status_code, text)
+            query = flow.send((response.status_code, text))
+    except StopIteration as stop:
+        return stop.value
     except requests.exceptions.Timeout:
+        record_latency(clean_base_url, kind, None, timeout_seconds)
+        circuit_breaker.record_failure(clean_base_url, '逾時')
         logger.error(f"{site_info}網絡請求超時 (超過 {timeout_seconds} 秒): {full_url}")
         return {'status': 'error', 'message': f"連接目標站點超時，該站點可能已失效或網絡不佳。"}
     except requests.exceptions.RequestException as e:
+        metrics.upstream(clean_base_url, kind, 'error')
+        circuit_breaker.record_failure(clean_base_url, '連線失敗')
         # 不記錄詳細錯誤，讓上層處理
         return {'status': 'error', 'message': f"網絡連接失敗，請檢查URL或您的網絡連接。"}
-    except ValueError as e:
-        # 獲取響應內容以便調試
-        try:
-            response_text = list_response.text if 'list_response' in locals() else "無法獲取響應內容"
-            response_status = list_response.status_code if 'list_response' in locals() else "未知"
-            
-            # 提供更詳細的錯誤信息
-            if response_text.strip() == "":
-                error_msg = "API返回空響應，可能是站點已失效或API端點錯誤"
-            elif response_text.startswith('<'):
-                error_msg = "API返回HTML頁面而非JSON，可能是站點已失效或需要登錄"
-            elif len(response_text) < 10:
-                error_msg = f"API返回內容過短: '{response_text}'，可能是站點已失效"
-            elif "暂不支持搜索" in response_text:
-                error_msg = "該站台暫不支持搜尋功能"
-            elif "不支持" in response_text:
-                error_msg = "該站台不支持此功能"
-            else:
-                error_msg = f"API返回無效JSON格式，響應內容: {response_text[:100]}..."
-                
-            return {'status': 'error', 'message': error_msg}
-        except Exception as debug_error:
-            return {'status': 'error', 'message': f"返回的不是有效的JSON格式: {e}"}
+    except ResponseTooLarge as e:
+        return too_large_result(clean_base_url, kind, e, logger, site_info)
     except Exception as e:
         logger.error(f"站點檢查發生未知錯誤: {site_info} ({full_url})", exc_info=True)
         return {'status': 'error', 'message': f"發生未知錯誤: {e}"}
 
 
-def get_details_from_api(base_url, vod_id, logger, ssl_verify=True, site_name=None):
+def get_details_from_api(base_url, vod_id, logger, ssl_verify=True, site_name=None, compact=False):
+    """取得單片詳情。compact=True 回傳精簡格式(每條線路 names / urls 平行陣列 + count),
+    否則回傳舊格式 data / episodes。"""
     site_info = f"站點 [{site_name}] " if site_name else ""
+    clean_base_url = normalize_base_url(base_url)
+    cached = response_cache.get_detail(clean_base_url, vod_id)
+    if cached is not None:
+        logger.info(f"{site_info}影片ID {vod_id} 詳情命中快取")
+        return detail_result(cached, compact)
+
+    if not circuit_breaker.allow(clean_base_url):
+        return circuit_open_result(clean_base_url, site_name, logger)
+
     logger.info(f"{site_info}準備獲取影片ID {vod_id} 的詳細播放列表... (SSL Verify: {ssl_verify})")
-    
-    if not base_url.startswith('http'):
-        base_url = 'http://' + base_url
-    clean_base_url = base_url.rstrip('/')
-    api_url = f"{clean_base_url}/api.php/provide/vod/"
+    api_url = build_api_url(clean_base_url)
     detail_params = {'ac': 'videolist', 'ids': str(vod_id)}
     
     # 構建完整的請求URL用於日誌
@@ -181,12 +646,17 @@ def get_details_from_api(base_url, vod_id, logger, ssl_verify=True, site_name=No
     
     try:
         headers = {'User-Agent': 'Mozilla/5.0'}
-        timeout_seconds = get_timeout_config()
+        timeout_seconds = latency_tracker.timeout_for(clean_base_url)
         session = get_session()
-        response = session.get(api_url, headers=headers, params=detail_params, timeout=timeout_seconds, verify=ssl_verify)
+        started = time.monotonic()
+        response = session.get(api_url, headers=headers, params=detail_params, timeout=timeout_seconds,
+                               verify=ssl_verify, stream=True)
+        text = read_bounded(response, 'detail')
+        record_latency(clean_base_url, 'detail', response.status_code, time.monotonic() - started, text)
+        circuit_breaker.record_response(clean_base_url, response.status_code, text)
         
         # 檢查響應內容，如果是特殊情況，直接返回錯誤
-        response_text = response.text.strip()
+        response_text = text.strip()
         if response_text == "暂不支持搜索" or response_text == "不支持":
             logger.warning(f"{site_info}站台返回: {response_text}")
             return {'status': 'error', 'message': f"該站台暫不支持此功能"}
@@ -197,71 +667,180 @@ def get_details_from_api(base_url, vod_id, logger, ssl_verify=True, site_name=No
             return {'status': 'error', 'message': f"站台返回HTTP {response.status_code} 錯誤"}
 
         try:
-            result_data = response.json()
+            result_data = json.loads(text)
         except RecursionError:
             logger.error(f"{site_info}詳情 API 返回複雜 JSON，無法解析")
             return {'status': 'error', 'message': 'API 返回的 JSON 結構過於複雜，無法解析'}
 
         if 'list' in result_data and isinstance(result_data['list'], list) and result_data['list']:
-            item = result_data['list'][0]
-            dl = []
-            play_from = item.get('vod_play_from', '').split('$$$')
-            play_url = item.get('vod_play_url', '').split('$$$')
-            
-            for i, source_name in enumerate(play_from):
-                source = {'flag': source_name, 'episodes': []}
-                if i < len(play_url):
-                    episodes_raw = play_url[i].strip().split('#')
-                    for epi in episodes_raw:
-                        parts = epi.split('$')
-                        if len(parts) == 2:
-                            source['episodes'].append({'name': parts[0], 'url': parts[1]})
-                dl.append(source)
-                
+            detail = parse_detail_item(result_data['list'][0])
+            response_cache.put_detail(clean_base_url, vod_id, detail)
             logger.info(f"成功解析影片ID {vod_id} 的播放列表。")
-            return {
-                'status': 'success',
-                'data': dl,
-                'vod_name': item.get('vod_name', ''),
-                'vod_pic': item.get('vod_pic', ''),
-            }
+            return detail_result(detail, compact)
         else:
             logger.error(f"{site_info}詳情API返回的JSON格式不符合預期，缺少有效的 'list' 數據。收到的數據: {result_data}")
             raise ValueError("詳情API未返回有效的 'list' 數據")
             
     except requests.exceptions.Timeout:
+        record_latency(clean_base_url, 'detail', None, timeout_seconds)
+        circuit_breaker.record_failure(clean_base_url, '逾時')
         logger.error(f"{site_info}獲取詳情時超時 (超過 {timeout_seconds} 秒): {full_url}")
         return {'status': 'error', 'message': f"獲取詳情時連接超時。"}
     except requests.exceptions.RequestException as e:
+        metrics.upstream(clean_base_url, 'detail', 'error')
+        circuit_breaker.record_failure(clean_base_url, '連線失敗')
         logger.error(f"{site_info}獲取詳情時網絡請求失敗: {e} (URL: {full_url})")
         return {'status': 'error', 'message': f"獲取詳情時網絡連接失敗，請檢查站點是否可用。"}
+    except ResponseTooLarge as e:
+        return too_large_result(clean_base_url, 'detail', e, logger, site_info)
     except ValueError as e:
         # 獲取響應內容以便調試
         try:
-            response_text = response.text if 'response' in locals() else "無法獲取響應內容"
+            response_text = text if 'text' in locals() else "無法獲取響應內容"
             response_status = response.status_code if 'response' in locals() else "未知"
             
             # 記錄JSON解析失敗，顯示響應內容
             logger.error(f"{site_info}解析JSON失敗: URL={full_url}, 狀態碼={response_status}, 響應內容={response_text}")
             
-            # 提供更詳細的錯誤信息
-            if response_text.strip() == "":
-                error_msg = "詳情API返回空響應，可能是站點已失效或API端點錯誤"
-            elif response_text.startswith('<'):
-                error_msg = "詳情API返回HTML頁面而非JSON，可能是站點已失效或需要登錄"
-            elif len(response_text) < 10:
-                error_msg = f"詳情API返回內容過短: '{response_text}'，可能是站點已失效"
-            elif "暂不支持搜索" in response_text:
-                error_msg = "該站台暫不支持此功能"
-            elif "不支持" in response_text:
-                error_msg = "該站台不支持此功能"
-            else:
-                error_msg = f"詳情API返回無效JSON格式，響應內容: {response_text[:100]}..."
-                
-            return {'status': 'error', 'message': error_msg}
+            return {'status': 'error', 'message': describe_invalid_json(response_text, prefix='詳情API')}
         except Exception as debug_error:
             logger.error(f"{site_info}詳情API調試信息獲取失敗: {debug_error}")
             return {'status': 'error', 'message': f"詳情API返回無效JSON格式: {e}"}
     except Exception as e:
         logger.error(f"{site_info}獲取影片ID {vod_id} 的詳情時出錯: {e}")
         return {'status': 'error', 'message': f'獲取詳情失敗: {e}'}
+
+
+# ac=videolist&ids= 一次帶幾個 id:MacCMS 預設一頁 20 筆,超過的會被截掉
+_BATCH_IDS = 20
+
+
+def get_details_batch(base_url, vod_ids, logger, ssl_verify=True, site_name=None, deadline=None):
+    """一次查同一站多部影片的精簡詳情:詳情快取有的直接用,其餘以 ac=videolist&ids=a,b,c
+    每 _BATCH_IDS 個一批查(同一站依序查,不對單一站台併發)。
+
+    deadline 是 time.monotonic() 的截止時間,到了就不再送下一批。
+    回傳 ({vod_id 字串: 精簡詳情}, 錯誤訊息或 None);站台沒回的 id 不會出現在結果裡。
+    """
+    site_info = _site_info(site_name)
+    clean_base_url = normalize_base_url(base_url)
+    details = {}
+    missing = []
+    for vid in dict.fromkeys(str(v) for v in vod_ids):
+        cached = response_cache.get_detail(clean_base_url, vid)
+        if cached is not None:
+            details[vid] = cached
+        else:
+            missing.append(vid)
+
+    api_url = build_api_url(clean_base_url)
+    headers = {'User-Agent': 'Mozilla/5.0'}
+    session = get_session()
+    for start in range(0, len(missing), _BATCH_IDS):
+        if deadline is not None and time.monotonic() >= deadline:
+            return details, "檢查時間已用完，其餘影片下次再檢查"
+        if not circuit_breaker.allow(clean_base_url):
+            return details, circuit_breaker.open_message(clean_base_url)
+        query = {'ac': 'videolist', 'ids': ','.join(missing[start:start + _BATCH_IDS])}
+        timeout_seconds = latency_tracker.timeout_for(clean_base_url)
+        try:
+            started = time.monotonic()
+            response = session.get(api_url, headers=headers, params=query, timeout=timeout_seconds,
+                                   verify=ssl_verify, stream=True)
+            text = read_bounded(response, 'videolist')
+            record_latency(clean_base_url, 'detail', response.status_code, time.monotonic() - started, text)
+            circuit_breaker.record_response(clean_base_url, response.status_code, text)
+        except requests.exceptions.Timeout:
+            record_latency(clean_base_url, 'detail', None, timeout_seconds)
+            circuit_breaker.record_failure(clean_base_url, '逾時')
+            logger.error(f"{site_info}批次獲取詳情時超時 (超過 {timeout_seconds} 秒)")
+            return details, "獲取詳情時連接超時。"
+        except requests.exceptions.RequestException as e:
+            metrics.upstream(clean_base_url, 'detail', 'error')
+            circuit_breaker.record_failure(clean_base_url, '連線失敗')
+            logger.error(f"{site_info}批次獲取詳情時網絡請求失敗: {e}")
+            return details, "獲取詳情時網絡連接失敗，請檢查站點是否可用。"
+        except ResponseTooLarge as e:
+            return details, too_large_result(clean_base_url, 'detail', e, logger, site_info)['message']
+
+        if response.status_code != 200:
+            return details, f"站台返回HTTP {response.status_code} 錯誤"
+        data, error = _parse_json_text(text)
+        if data is None:
+            return details, error['message']
+        details.update(absorb_detail_response(clean_base_url, data, {}))
+    return details, None
+
+
+def fetch_json_page(base_url, query, logger, ssl_verify=True, site_name=None, label='列表'):
+    """背景工作(更新偵測、目錄爬取)用的單頁讀取:熔斷、自適應逾時、延遲統計與讀取上限都照列表請求的規矩。
+    回傳 (dict, None) 或 (None, 錯誤訊息);label 只用在日誌與錯誤訊息。"""
+    site_info = _site_info(site_name)
+    clean_base_url = normalize_base_url(base_url)
+    if not circuit_breaker.allow(clean_base_url):
+        return None, circuit_breaker.open_message(clean_base_url)
+    timeout_seconds = latency_tracker.timeout_for(clean_base_url)
+    try:
+        started = time.monotonic()
+        response = get_session().get(build_api_url(clean_base_url), headers={'User-Agent': 'Mozilla/5.0'},
+                                     params=query, timeout=timeout_seconds, verify=ssl_verify, stream=True)
+        text = read_bounded(response, body_kind(query))
+        record_latency(clean_base_url, 'list', response.status_code, time.monotonic() - started, text)
+        circuit_breaker.record_response(clean_base_url, response.status_code, text)
+    except requests.exceptions.Timeout:
+        record_latency(clean_base_url, 'list', None, timeout_seconds)
+        circuit_breaker.record_failure(clean_base_url, '逾時')
+        logger.error(f"{site_info}讀取{label}時超時 (超過 {timeout_seconds} 秒)")
+        return None, f"讀取{label}時連接超時。"
+    except requests.exceptions.RequestException as e:
+        metrics.upstream(clean_base_url, 'list', 'error')
+        circuit_breaker.record_failure(clean_base_url, '連線失敗')
+        logger.error(f"{site_info}讀取{label}時網絡請求失敗: {e}")
+        return None, f"讀取{label}時網絡連接失敗。"
+    except ResponseTooLarge as e:
+        return None, too_large_result(clean_base_url, 'list', e, logger, site_info)['message']
+
+    if response.status_code != 200:
+        return None, f"站台返回HTTP {response.status_code} 錯誤"
+    data, error = _parse_json_text(text)
+    if data is None:
+        return None, error['message']
+    return data, None
+
+
+def page_count(data):
+    try:
+        return int(data.get('pagecount') or 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+# ac=list&h= 最多翻幾頁:更新偵測一輪每站就這麼多次請求,超過代表這站在窗口內更新量太大,交給呼叫端改查詳情
+_RECENT_MAX_PAGES = 10
+
+
+def get_recent_changes(base_url, hours, logger, ssl_verify=True, site_name=None, deadline=None):
+    """MacCMS 的「最近 N 小時有更新」列表(ac=list&h=N),逐頁讀完。
+
+    回傳 ({vod_id 字串: {'vod_time', 'vod_remarks'}}, 是否完整, 錯誤訊息或 None)。
+    頁數超過 _RECENT_MAX_PAGES、時間用完或中途出錯時「是否完整」為 False,已讀到的照樣回傳。
+    """
+    changes = {}
+    page = 1
+    while True:
+        if deadline is not None and time.monotonic() >= deadline:
+            return changes, False, "檢查時間已用完"
+        data, error = fetch_json_page(base_url, {'ac': 'list', 'h': max(1, int(hours)), 'pg': page}, logger,
+                                      ssl_verify=ssl_verify, site_name=site_name, label='最近更新列表')
+        if data is None:
+            return changes, False, error
+        for item in data.get('list') or []:
+            if isinstance(item, dict) and item.get('vod_id') is not None:
+                changes[str(item['vod_id'])] = {'vod_time': item.get('vod_time', ''),
+                                                'vod_remarks': item.get('vod_remarks', '')}
+        if page >= page_count(data):
+            return changes, True, None
+        if page >= _RECENT_MAX_PAGES:
+            logger.info(f"{_site_info(site_name)}最近 {hours} 小時更新超過 {_RECENT_MAX_PAGES} 頁,只讀前面幾頁")
+            return changes, False, None
+        page += 1
@@ -0,0 +1,204 @@
+# async_client.py
+#
+# 多站搜尋用的 asyncio 上游客戶端。
+# 舊版 multi_site_search 每個請求都開一個 ThreadPoolExecutor、每站佔一條執行緒做阻塞 I/O,
+# 小機器(0.5 CPU / 450M)上十幾個人同時搜就是幾十條執行緒。改成:
+#   - 每個 worker 程序只有一個 event loop(背景 daemon 執行緒),所有搜尋請求共用;
+#   - 非阻塞 socket(aiohttp),等待上游時不佔執行緒;
+#   - TCPConnector 限制每個站台(host)同時在途的請求數,避免把單一站台打爆。
+# 請求端(Flask 的同步 view)用 submit() 把 coroutine 丟進 loop,拿回 concurrent.futures.Future。
+#
+# aiohttp 是選用依賴:沒裝時 is_available() 回 False,multi_site_search 退回舊的執行緒池寫法。
+
+import os
+import time
+import asyncio
+import threading
+import urllib.parse
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover - 依部署環境而定
+    aiohttp = None
+
+from api_parser import (
+    _site_info, normalize_base_url, build_api_url, list_flow, BoundedBody, ResponseTooLarge,
+    body_limit, body_kind, too_large_result, _CHUNK_SIZE,
+    serve_cached_list, settle_list_result, circuit_open_result, metric_kind, record_latency,
+)
+import circuit_breaker
+import latency_tracker
+import metrics
+import response_cache
+
+# 同一站台同時在途的請求上限,與全部站台合計上限(對應 requests 版的連接池大小)
+_PER_HOST_LIMIT = 4
+_TOTAL_LIMIT = 32
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+_session = None  # 只在 loop 執行緒內存取,不需要鎖
+
+
+def is_available():
+    return aiohttp is not None
+
+
+def _get_loop():
+    """取得(必要時啟動)本程序共用的 event loop。
+
+    以 pid 判斷:gunicorn --preload 會在 master 匯入後 fork,子程序要自己重開一個 loop,
+    不能沿用 fork 前(執行緒已不存在)的那個。
+    """
+    global _loop, _loop_pid, _session
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='upstream-loop', daemon=True)
+            thread.start()
+            _loop, _loop_pid, _session = loop, os.getpid(), None
+        return _loop
+
+
+def submit(coro):
+    """把 coroutine 丟進共用 loop 執行,回傳 concurrent.futures.Future(可搭配 as_completed)。"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+async def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=_TOTAL_LIMIT, limit_per_host=_PER_HOST_LIMIT, ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector, headers={'User-Agent': 'Mozilla/5.0'})
+    return _session
+
+
+async def _fetch_text(api_url, params, ssl_verify, timeout_seconds, limit):
+    """送一個 GET,回傳 (HTTP 狀態碼, 解碼後文字);本文有上限地串流讀取(見 api_parser.BoundedBody)。"""
+    session = await _get_session()
+    query = {k: str(v) for k, v in params.items()}
+    async with session.get(api_url, params=query, ssl=None if ssl_verify else False,
+                           timeout=aiohttp.ClientTimeout(total=timeout_seconds)) as resp:
+        body = BoundedBody(limit, resp.headers.get('Content-Type'),
+                           resp.headers.get('Content-Length'))
+        async for chunk in resp.content.iter_chunked(_CHUNK_SIZE):
+            if not body.feed(chunk):
+                break
+        return resp.status, body.text()
+
+
+async def _fetch_hedged(api_url, params, ssl_verify, timeout_seconds, delay, limit):
+    """尾端延遲不穩的站台:等了 delay(latency_tracker.hedge_delay)秒還沒回,就再送一個相同請求,誰先成功用誰。"""
+    if delay is None or delay >= timeout_seconds:
+        return await _fetch_text(api_url, params, ssl_verify, timeout_seconds, limit)
+
+    first = asyncio.ensure_future(_fetch_text(api_url, params, ssl_verify, timeout_seconds, limit))
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    second = asyncio.ensure_future(_fetch_text(api_url, params, ssl_verify, timeout_seconds - delay, limit))
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                for other in pending:
+                    other.cancel()
+                return task.result()
+            error = task.exception()
+    raise error
+
+
+async def process_api_request_async(base_url, params, logger, ssl_verify=True, site_name=None):
+    """process_api_request 的 asyncio 版:回傳格式與錯誤訊息完全相同,也共用同一個 response_cache。"""
+    clean_base_url = normalize_base_url(base_url)
+    cached, state = await _blocking(serve_cached_list, clean_base_url, params, logger, ssl_verify, site_name)
+    if state in ('fresh', 'stale'):
+        return cached
+    result = await _fetch_list(clean_base_url, params, logger, ssl_verify, site_name)
+    return await _blocking(settle_list_result, clean_base_url, params, result, cached, logger, site_name)
+
+
+async def refresh_list_async(base_url, params, logger, ssl_verify=True, site_name=None):
+    """api_parser.refresh_list 的 asyncio 版:不查快取,直接抓一頁寫進 response_cache(預抓用)。"""
+    clean_base_url = normalize_base_url(base_url)
+    result = await _fetch_list(clean_base_url, params, logger, ssl_verify, site_name)
+    await _blocking(response_cache.put_response, clean_base_url, params, result)
+    return result
+
+
+async def _blocking(fn, *args):
+    """同步函式丟到 loop 的預設執行緒池跑。list_flow 與快取 / 設定 / 站台清單的讀寫都可能碰 storage,
+    KV 後端時是同步的 HTTP 請求,在 loop 執行緒上跑會卡住所有在途的搜尋與預抓。"""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+def _prepare(clean_base_url, params, logger, ssl_verify, site_name):
+    """送出前的同步部分:熔斷判斷、逾時 / hedge 設定,以及 list_flow 的第一步。
+    回傳 (熔斷結果或 None, 逾時秒數, hedge 延遲, flow, _advance 的第一步)。"""
+    if not circuit_breaker.allow(clean_base_url):
+        return circuit_open_result(clean_base_url, site_name, logger), None, None, None, (True, None, None)
+    flow = list_flow(clean_base_url, params, logger, ssl_verify, site_name)
+    return (None, latency_tracker.timeout_for(clean_base_url), latency_tracker.hedge_delay(clean_base_url),
+            flow, _advance(flow, None))
+
+
+def _advance(flow, reply):
+    """推進 list_flow 一步,回傳 (是否結束, 下一組 query 或最終結果, 這組 query 的回應大小上限)。
+    StopIteration 不能穿過 run_in_executor 的 Future,所以在這裡先接住。"""
+    try:
+        query = next(flow) if reply is None else flow.send(reply)
+    except StopIteration as stop:
+        return True, stop.value, None
+    return False, query, body_limit(body_kind(query))
+
+
+def _record_and_advance(flow, clean_base_url, kind, status, elapsed, text):
+    record_latency(clean_base_url, kind, status, elapsed, text)
+    circuit_breaker.record_response(clean_base_url, status, text)
+    return _advance(flow, (status, text))
+
+
+def _record_failure(clean_base_url, kind, reason, timeout_seconds=None):
+    if reason == '逾時':
+        record_latency(clean_base_url, kind, None, timeout_seconds)
+    else:
+        metrics.upstream(clean_base_url, kind, 'error')
+    circuit_breaker.record_failure(clean_base_url, reason)
+
+
+async def _fetch_list(clean_base_url, params, logger, ssl_verify, site_name):
+    """用 aiohttp 驅動 api_parser.list_flow(流程與同步版完全共用)。"""
+    site_info = _site_info(site_name)
+    api_url = build_api_url(clean_base_url)
+    full_url = f"{api_url}?{urllib.parse.urlencode(params)}"
+    logger.info(f"{site_info}開始處理請求(async): {full_url} (SSL Verify: {ssl_verify})")
+
+    kind = metric_kind(params)
+    timeout_seconds = None
+    try:
+        # list_flow 本身(站台策略、海報索引、設定…)都在執行緒池裡推進,loop 執行緒只等網路
+        blocked, timeout_seconds, delay, flow, (done, step, limit) = await _blocking(
+            _prepare, clean_base_url, params, logger, ssl_verify, site_name)
+        if blocked is not None:
+            return blocked
+        while not done:
+            started = time.monotonic()
+            status, text = await _fetch_hedged(api_url, step, ssl_verify, timeout_seconds, delay, limit)
+            done, step, limit = await _blocking(_record_and_advance, flow, clean_base_url, kind, status,
+                                               time.monotonic() - started, text)
+        return step
+    except asyncio.TimeoutError:
+        await _blocking(_record_failure, clean_base_url, kind, '逾時', timeout_seconds)
+        logger.error(f"{site_info}網絡請求超時 (超過 {timeout_seconds} 秒): {full_url}")
+        return {'status': 'error', 'message': f"連接目標站點超時，該站點可能已失效或網絡不佳。"}
+    except aiohttp.ClientError:
+        await _blocking(_record_failure, clean_base_url, kind, '連線失敗')
+        return {'status': 'error', 'message': f"網絡連接失敗，請檢查URL或您的網絡連接。"}
+    except ResponseTooLarge as e:
+        return await _blocking(too_large_result, clean_base_url, kind, e, logger, site_info)
+    except Exception as e:
+        logger.error(f"站點請求發生未知錯誤: {site_info} ({full_url})", exc_info=True)
+        return {'status': 'error', 'message': f"發生未知錯誤: {e}"}
@@ -0,0 +1,73 @@
+# background.py
+#
+# 程序內共用的小型背景工作池。回應已經送出後才需要做的事(學習站台能力、落盤索引、
+# 背景刷新快取…)都丟這裡,不要每次自己開 threading.Thread,也不要佔用請求執行緒或
+# async_client 的 event loop。
+#
+# worker 數壓得很小(小機器 0.5 CPU);同一個 key 的工作還在排隊 / 執行時不會重複排入。
+# 以 pid 判斷是否需要重建:gunicorn --preload fork 之後,父程序的執行緒不會跟過來。
+
+import os
+import threading
+import concurrent.futures
+import metrics
+from logger_config import setup_logger
+
+_MAX_WORKERS = 2
+
+logger = setup_logger()
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_pending = set()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKERS, thread_name_prefix='background')
+        _executor_pid = os.getpid()
+        _pending.clear()
+    return _executor
+
+
+def submit(key, fn, *args, **kwargs):
+    """排入一個背景工作;同 key 已在排隊 / 執行中就略過。回傳是否有排入。"""
+    with _lock:
+        if key in _pending:
+            return False
+        _pending.add(key)
+        executor = _get_executor()
+
+    def _run():
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"背景工作 {key} 失敗: {e}", exc_info=True)
+        finally:
+            with _lock:
+                _pending.discard(key)
+
+    executor.submit(_run)
+    return True
+
+
+def pending_count():
+    """目前排隊 + 執行中的工作數。"""
+    with _lock:
+        return len(_pending)
+
+
+def queue_depth():
+    """已排入執行緒池、還沒有 worker 接手的工作數。"""
+    with _lock:
+        executor = _executor if _executor_pid == os.getpid() else None
+    return executor._work_queue.qsize() if executor else 0
+
+
+metrics.describe('background_pending', 'gauge', 'Background jobs queued or running.')
+metrics.describe('background_queue_depth', 'gauge', 'Background jobs waiting for a free worker thread.')
+metrics.register_collector(lambda: [
+    ('background_pending', {}, pending_count()),
+    ('background_queue_depth', {}, queue_depth()),
+])
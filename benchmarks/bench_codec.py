@@ -0,0 +1,106 @@
+# benchmarks/bench_codec.py
+#
+# JSON 後端微基準:用仿 MacCMS 的典型回應量測各後端的解析 / 序列化耗時,
+# 以及「一次瀏覽請求」(解析 ac=list + 解析 ac=videolist 補圖 + 序列化回前端的結果)的總成本。
+# 跟舊做法比較:詳情原本走 requests 的 Response.json()(整包解碼成 str 再交給標準庫 json)。
+#
+# 用法(在專案根目錄):python benchmarks/bench_codec.py [次數]
+
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec  # noqa: E402
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _video(i, episodes):
+    play_from = 'lineA$$$lineB'
+    play_url = '$$$'.join(
+        '#'.join(f'第{e:02d}集$https://vod{line}.example.com/20261017/{i}/{e}/index.m3u8' for e in range(1, episodes + 1))
+        for line in (1, 2)
+    )
+    return {
+        'vod_id': 100000 + i, 'type_id': 13, 'type_name': '國產劇', 'vod_name': f'測試影片第{i}部',
+        'vod_sub': '', 'vod_en': f'ceshiyingpian{i}', 'vod_time': '2026-10-17 10:00:00',
+        'vod_remarks': f'更新至{episodes}集', 'vod_play_from': play_from,
+        'vod_pic': f'https://img.example.com/upload/vod/20261017-1/{i:08x}.jpg',
+        'vod_area': '大陸', 'vod_lang': '國語', 'vod_year': '2026', 'vod_actor': '演員甲,演員乙,演員丙',
+        'vod_director': '導演', 'vod_content': '<p>' + '劇情簡介。' * 60 + '</p>',
+        'vod_play_url': play_url,
+    }
+
+
+def payloads():
+    classes = [{'type_id': t, 'type_pid': 0, 'type_name': f'分類{t}'} for t in range(1, 40)]
+    items = [_video(i, 40) for i in range(20)]
+    list_page = {
+        'code': 1, 'msg': '數據列表', 'page': 1, 'pagecount': 500, 'limit': '20', 'total': 10000,
+        'list': [{k: v[k] for k in ('vod_id', 'vod_name', 'type_id', 'type_name', 'vod_en', 'vod_time',
+                                    'vod_remarks', 'vod_play_from')} for v in items],
+        'class': classes,
+    }
+    videolist = {'code': 1, 'msg': '數據列表', 'page': 1, 'pagecount': 1, 'limit': '20', 'total': 20, 'list': items}
+    detail = {'code': 1, 'msg': '數據列表', 'page': 1, 'pagecount': 1, 'limit': '20', 'total': 1,
+              'list': [_video(1, 120)]}
+    result = {'status': 'success', 'list': [{'vod_id': v['vod_id'], 'vod_name': v['vod_name'],
+                                             'vod_pic': v['vod_pic'], 'vod_remarks': v['vod_remarks']} for v in items],
+              'pagecount': 500, 'categories': classes}
+    return {
+        'ac=list 一頁': json.dumps(list_page, ensure_ascii=False).encode('utf-8'),
+        'ac=videolist 20 筆': json.dumps(videolist, ensure_ascii=False).encode('utf-8'),
+        '單片詳情 120 集': json.dumps(detail, ensure_ascii=False).encode('utf-8'),
+    }, result
+
+
+def backends():
+    found = [('json', lambda b: json.loads(b.decode('utf-8')), lambda o: json.dumps(o, ensure_ascii=False))]
+    if ujson:
+        found.append(('ujson', lambda b: ujson.loads(b.decode('utf-8')), lambda o: ujson.dumps(o, ensure_ascii=False)))
+    if orjson:
+        found.append(('orjson', orjson.loads, lambda o: orjson.dumps(o).decode('utf-8')))
+    return found
+
+
+def _per_call_us(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    samples, result = payloads()
+    print(f"codec 目前使用的後端: {codec.BACKEND}\n")
+    print(f"{'payload':<20}{'大小':>10}" + ''.join(f"{name + ' 解析 µs':>16}" for name, _, _ in backends()))
+    for label, raw in samples.items():
+        row = f"{label:<18}{len(raw) // 1024:>8} KB"
+        for _, loads, _ in backends():
+            row += f"{_per_call_us(lambda: loads(raw), number):>16.1f}"
+        print(row)
+
+    print(f"\n{'後端':<10}{'序列化結果 µs':>16}{'一次瀏覽請求 µs':>18}")
+    baseline = None
+    for name, loads, dumps in backends():
+        dump_us = _per_call_us(lambda: dumps(result), number)
+
+        def browse():
+            loads(samples['ac=list 一頁'])
+            loads(samples['ac=videolist 20 筆'])
+            dumps(result)
+        total_us = _per_call_us(browse, number)
+        baseline = baseline or total_us
+        print(f"{name:<10}{dump_us:>16.1f}{total_us:>18.1f}   ({baseline / total_us:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
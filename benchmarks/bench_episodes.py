@@ -0,0 +1,69 @@
+# benchmarks/bench_episodes.py
+#
+# 播放清單解析微基準:長篇連續劇(幾千集 × 多條線路)的 vod_play_url,
+# 比較舊做法(每集一個 {'name','url'} dict)與 api_parser.parse_play_sources 的 columnar 形式:
+# 解析耗時、序列化耗時與回應 JSON 體積。
+#
+# 用法(在專案根目錄):python benchmarks/bench_episodes.py [次數]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec  # noqa: E402
+from api_parser import parse_play_sources  # noqa: E402
+
+
+def legacy_parse(play_from, play_url):
+    """改版前 parse_detail_item 的拆法。"""
+    dl = []
+    play_from = play_from.split('$$$')
+    play_url = play_url.split('$$$')
+    for i, source_name in enumerate(play_from):
+        source = {'flag': source_name, 'episodes': []}
+        if i < len(play_url):
+            for epi in play_url[i].strip().split('#'):
+                parts = epi.split('$')
+                if len(parts) == 2:
+                    source['episodes'].append({'name': parts[0], 'url': parts[1]})
+        dl.append(source)
+    return dl
+
+
+def play_strings(lines, episodes):
+    flags = ['ffm3u8', 'lzm3u8', 'hnm3u8', 'wjm3u8', 'bfzym3u8', 'snm3u8'][:lines]
+    urls = []
+    for n, flag in enumerate(flags):
+        urls.append('#'.join(
+            f'第{e:04d}集$https://v{n}.cdn-{flag}.example.com/20261017/{e:06d}abcdef/index.m3u8'
+            for e in range(1, episodes + 1)
+        ))
+    return '$$$'.join(flags), '$$$'.join(urls)
+
+
+def _ms(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1000
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print(f"JSON 後端: {codec.BACKEND}")
+    print(f"{'線路 × 集數':<14}{'原始 KB':>9}{'舊 解析 ms':>12}{'新 解析 ms':>12}"
+          f"{'舊 序列化 ms':>14}{'新 序列化 ms':>14}{'舊 KB':>9}{'新 KB':>9}")
+    for lines, episodes in ((2, 40), (5, 1000), (5, 3000), (6, 5000)):
+        play_from, play_url = play_strings(lines, episodes)
+        legacy = legacy_parse(play_from, play_url)
+        columnar = parse_play_sources(play_from, play_url)
+        assert [[e['url'] for e in s['episodes']] for s in legacy] == [s['urls'] for s in columnar]
+        print(f"{f'{lines} × {episodes}':<16}{len(play_url.encode()) // 1024:>9}"
+              f"{_ms(lambda: legacy_parse(play_from, play_url), number):>12.2f}"
+              f"{_ms(lambda: parse_play_sources(play_from, play_url), number):>12.2f}"
+              f"{_ms(lambda: codec.dumpb(legacy), number):>14.2f}"
+              f"{_ms(lambda: codec.dumpb(columnar), number):>14.2f}"
+              f"{len(codec.dumpb(legacy)) // 1024:>9}{len(codec.dumpb(columnar)) // 1024:>9}")
+
+
+if __name__ == '__main__':
+    main()
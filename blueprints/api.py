@@ -1,12 +1,24 @@
 import time
-import json
+import base64
+import binascii
+import codec as json
 import concurrent.futures
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, session, Response, stream_with_context
 from urllib.parse import urlparse, urlunparse
 
 from logger_config import setup_logger
+from config import get_config_value, get_timeout_config
 from site_manager import get_sites, save_sites
-from api_parser import process_api_request, get_details_from_api
+from api_parser import process_api_request, get_details_from_api, get_details_batch, normalize_base_url, slice_detail
+import async_client
+import update_detector
+import catalog
+from search_results import group_results, rank_results
+import response_cache
+import prefetch
+import circuit_breaker
+import latency_tracker
+import metrics
 import storage
 
 # 容量上限放寬,留空間給軟刪墓碑(deletedAt):active 200(跟前端一致)+ 墓碑(30 天後清)
@@ -101,6 +113,32 @@ def _search_concurrency(task_count):
         return task_count
     return min(task_count, _FILE_BACKEND_MAX_WORKERS)
 
+def _search_deadline():
+    """多站搜尋的總時限(秒),可用 config.json 的 search_deadline 覆寫。
+
+    單站每次上游請求的逾時最多是 request_timeout(見 latency_tracker),但列表流程最多打兩次
+    (列表 + 補圖),預設給 1.5 倍:正常站台兩次都回得來,死站 / 卡住的站到時間就不等了。
+    """
+    return get_config_value('search_deadline', get_timeout_config() * 1.5)
+
+
+_SEARCH_DEADLINE_MESSAGE = '搜尋逾時,已略過此站台'
+
+
+def _deadline_results(pending):
+    """總時限到了還沒回的站台 → 各 yield 一筆逾時錯誤,並取消還沒開始的工作。"""
+    for future, site in pending.items():
+        future.cancel()
+        logger.warning(f"站台 {site['name']} 超過搜尋總時限,略過")
+        yield site, [], 0, _SEARCH_DEADLINE_MESSAGE
+
+
+@api_bp.route('/metrics', methods=['GET'])
+def metrics_export():
+    """Prometheus 格式的監控指標(僅管理員;數值為處理這次請求的 worker 所見)"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @api_bp.route('/health', methods=['GET'])
 def health_check():
     """健康檢查端點 - 檢查應用程式和依賴服務狀態"""
@@ -118,6 +156,8 @@ def health_check():
         return jsonify({
             'status': 'healthy',
             'sites_count': len(sites),
+            'response_cache': response_cache.response_cache.stats(),
+            'detail_cache': response_cache.detail_cache.stats(),
             'timestamp': int(time.time())
         })
     except Exception as e:
@@ -164,6 +204,11 @@ def add_or_get_sites():
         if context == 'setup':
             logger.info("GET /api/sites?context=setup - 請求所有站點列表（用於設定頁面）")
             sorted_sites = sorted(sites, key=lambda s: s.get('order', float('inf')))
+            # 熔斷狀態與延遲統計只存在記憶體(本 worker 觀察到的),附上給設定頁看
+            for site in sorted_sites:
+                clean = normalize_base_url(site.get('url', ''))
+                site['breaker'] = circuit_breaker.snapshot(clean)
+                site['latency'] = latency_tracker.snapshot(clean)
             return jsonify(sorted_sites)
         
         logger.info("GET /api/sites - 請求已啟用且排序的站點列表")
@@ -506,6 +551,29 @@ def update_account():
     return jsonify({'status': 'success'})
 
 
+# GET 時由 update_detector 補上的欄位;client 整包 POST 回來時丟掉,不存進 storage
+_UPDATE_FLAG_FIELDS = ('hasUpdate', 'newEpisodesCount')
+
+
+def _list_with_update_flags(key):
+    """讀歷史 / 收藏並附上背景偵測算好的 hasUpdate / totalEpisodes(見 update_detector.annotate)。
+    背景偵測有在跑時加 X-Update-Status: precomputed,前端看到就不必開頁時自己打 check_updates。"""
+    data = _parse_list(storage.get_text(key))
+    try:
+        data = update_detector.annotate(data)
+    except Exception as e:
+        logger.warning(f"附加更新狀態失敗: {e}")
+    response = jsonify(data)
+    if update_detector.active():
+        response.headers['X-Update-Status'] = 'precomputed'
+    return response
+
+
+def _strip_update_flags(items):
+    return [{k: v for k, v in item.items() if k not in _UPDATE_FLAG_FIELDS} if isinstance(item, dict) else item
+            for item in items]
+
+
 @api_bp.route('/history', methods=['GET', 'POST'])
 def account_history():
     """觀看歷史綁帳號、存伺服器端(storage:Docker 檔案 / Vercel KV)→ 跨裝置同步。
@@ -517,14 +585,7 @@ def account_history():
     key = f'history_{account_id}'
 
     if request.method == 'GET':
-        raw = storage.get_text(key)
-        if not raw:
-            return jsonify([])
-        try:
-            data = json.loads(raw)
-            return jsonify(data if isinstance(data, list) else [])
-        except ValueError:
-            return jsonify([])
+        return _list_with_update_flags(key)
 
     # POST:跟伺服器現有資料逐筆 merge(鍵=videoId|siteUrl,較新者贏),不再整包覆寫。
     # 避免「帶著舊資料的裝置推一次,把另一台剛存的新進度整包蓋掉」。
@@ -532,6 +593,7 @@ def account_history():
     data = request.get_json(silent=True)
     if not isinstance(data, list):
         return jsonify({'status': 'error', 'message': '格式錯誤:預期陣列'}), 400
+    data = _strip_update_flags(data)
     now_ms = int(time.time() * 1000)
 
     def _merge(raw):
@@ -558,19 +620,13 @@ def account_favorites():
     key = f'favorites_{account_id}'
 
     if request.method == 'GET':
-        raw = storage.get_text(key)
-        if not raw:
-            return jsonify([])
-        try:
-            data = json.loads(raw)
-            return jsonify(data if isinstance(data, list) else [])
-        except ValueError:
-            return jsonify([])
+        return _list_with_update_flags(key)
 
     # POST:逐筆 merge(鍵=videoId|siteUrl,較新者贏),理由同 history,不整包覆寫;同樣包進鎖內。
     data = request.get_json(silent=True)
     if not isinstance(data, list):
         return jsonify({'status': 'error', 'message': '格式錯誤:預期陣列'}), 400
+    data = _strip_update_flags(data)
     now_ms = int(time.time() * 1000)
 
     def _merge(raw):
@@ -603,6 +659,9 @@ def api_get_list_route():
     site_name = site['name'] if site else None
 
     result = process_api_request(url, params, logger, ssl_verify=ssl_verify, site_name=site_name)
+    if site:
+        # 照順序翻頁時下一頁多半馬上會被點:先背景抓進快取
+        prefetch.next_page(site, params, result)
     return jsonify(result)
 
 @api_bp.route('/details', methods=['POST'])
@@ -613,68 +672,293 @@ def api_get_details_route():
     site = next((s for s in sites if s['url'] == url), None)
     ssl_verify = site.get('ssl_verify', True) if site else True
 
-    result = get_details_from_api(url, data.get('id'), logger, ssl_verify=ssl_verify, site_name=site['name'] if site else None)
+    # compact: true → 每條線路回 names / urls 平行陣列與 count,長篇連續劇的回應小很多
+    compact = bool(data.get('compact'))
+    # 帶 source / offset / limit / around 任一個 → 只回單一線路的一段集數(從快取的詳情切,不重打上游)
+    windowed = any(data.get(k) is not None for k in ('source', 'offset', 'limit', 'around'))
+    result = get_details_from_api(url, data.get('id'), logger, ssl_verify=ssl_verify,
+                                  site_name=site['name'] if site else None, compact=compact or windowed)
+    if windowed and result.get('status') == 'success':
+        try:
+            result = slice_detail(result, data.get('source'), data.get('offset'), data.get('limit'),
+                                  data.get('around'), compact=compact)
+        except (TypeError, ValueError) as e:
+            return jsonify({'status': 'error', 'message': f'集數區段參數錯誤: {e}'}), 400
     return jsonify(result)
 
+def _collect_search_result(site, result):
+    """單站搜尋結果 → (影片清單, pagecount, 錯誤訊息);影片補上來源站台。失敗回 ([], 0, 訊息)。"""
+    if result.get('status') == 'success':
+        page_count = int(result.get('pagecount') or 0)
+        if not result.get('list'):
+            # 搜尋成功但沒有結果
+            return [], page_count, None
+        for video in result['list']:
+            video['from_site'] = site['name']
+            video['from_site_id'] = site['id']
+        return result['list'], page_count, None
+    # 真正的搜尋失敗
+    error_msg = result.get('message', '未知錯誤')
+    logger.warning(f"站台 {site['name']} 搜尋失敗: {error_msg}")
+    return [], 0, error_msg
+
+
+def _fan_out_search(sites, params, pages=None):
+    """對多個站台同時送同一組搜尋參數,依完成先後 yield (site, 影片清單, pagecount, 錯誤訊息)。
+
+    pages 給 {site id: 頁碼} 時各站查自己的那一頁(合併分頁用),沒列到的站用 params 的 pg。
+    有開本機目錄(catalog)時,已收錄且夠新的站台先直接查索引、最先 yield,其餘站台才即時搜尋;
+    索引查詢出錯就全部退回即時搜尋。
+    有 aiohttp 時走 async_client 的共用 event loop(不額外開執行緒);沒有則退回執行緒池。
+    即時搜尋整體受 _search_deadline() 限制,到時還沒回的站台 yield 逾時錯誤,不再等。
+    送出前先用 circuit_breaker.adopt_check 同步背景健康檢查的結果,其他 worker 查出來壞掉的站台也會被熔斷。
+    """
+    def site_params(site):
+        return dict(params, pg=pages[site['id']]) if pages and site['id'] in pages else params
+
+    if params.get('wd'):
+        indexed = {}
+        try:
+            by_page = {}
+            for site in catalog.covered_sites(sites):
+                by_page.setdefault(site_params(site).get('pg', 1), []).append(site)
+            for pg, covered in by_page.items():
+                indexed.update(catalog.search(params['wd'], covered, pg))
+        except Exception as e:
+            logger.warning(f"本機目錄查詢失敗,改為即時搜尋: {e}")
+            indexed = {}
+        for site in sites:
+            if site['id'] in indexed:
+                yield (site,) + indexed[site['id']] + (None,)
+        sites = [s for s in sites if s['id'] not in indexed]
+    if not sites:
+        return
+    # 背景健康檢查只在持有租約的 worker 回報熔斷器,這裡把 sites.json 裡的結果補進本 worker
+    for site in sites:
+        circuit_breaker.adopt_check(normalize_base_url(site['url']), site)
+    if async_client.is_available():
+        future_to_site = {
+            async_client.submit(async_client.process_api_request_async(
+                site['url'], site_params(site), logger, ssl_verify=site.get('ssl_verify', True),
+                site_name=site['name'])): site
+            for site in sites
+        }
+        pending = dict(future_to_site)
+        try:
+            for future in concurrent.futures.as_completed(future_to_site, timeout=_search_deadline()):
+                site = pending.pop(future)
+                try:
+                    yield (site,) + _collect_search_result(site, future.result())
+                except Exception as exc:
+                    logger.error(f'站台 {site["name"]} 搜尋異常: {type(exc).__name__}: {str(exc)}')
+                    yield site, [], 0, str(exc)
+        except concurrent.futures.TimeoutError:
+            yield from _deadline_results(pending)
+        return
+
+    def search_site(site):
+        result = process_api_request(site['url'], site_params(site), logger, ssl_verify=site.get('ssl_verify', True),
+                                     site_name=site['name'])
+        return _collect_search_result(site, result)
+
+    max_workers = _search_concurrency(len(sites))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    future_to_site = {executor.submit(search_site, site): site for site in sites}
+    pending = dict(future_to_site)
+    try:
+        for future in concurrent.futures.as_completed(future_to_site, timeout=_search_deadline()):
+            site = pending.pop(future)
+            try:
+                yield (site,) + future.result()
+            except Exception as exc:
+                logger.error(f'站台 {site["name"]} 搜尋異常: {type(exc).__name__}: {str(exc)}')
+                yield site, [], 0, str(exc)
+    except concurrent.futures.TimeoutError:
+        yield from _deadline_results(pending)
+    finally:
+        # 不等還在跑的站台(它們各自受單次逾時限制,結束後執行緒自然回收)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _parse_limit(limit):
+    """limit 參數:None → 不限;其他要是正整數,否則丟 ValueError / TypeError。"""
+    if limit is None:
+        return None
+    limit = int(limit)
+    if limit <= 0:
+        raise ValueError('必須大於 0')
+    return limit
+
+
 @api_bp.route('/multi_site_search', methods=['POST'])
 def multi_site_search():
     data = request.json
     site_ids = data.get('site_ids', [])
     keyword = data.get('keyword')
     page = data.get('page', 1)
+    # grouped: true → 同一部片(正規化片名 + 年份)只回一個代表,其他站只列 site_id / vod_id
+    grouped = bool(data.get('grouped'))
+    # 結果一律依相關度排序;limit → 只回前幾筆(分組時是前幾組),total 仍是全部的數量
+    limit = data.get('limit')
 
     if not site_ids:
         return jsonify({'status': 'error', 'message': '缺少站台資訊'}), 400
+    try:
+        limit = _parse_limit(limit)
+    except (TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f'limit 參數錯誤: {e}'}), 400
 
     all_sites = get_sites()
     sites_to_search = [s for s in all_sites if s['id'] in site_ids and s.get('enabled', True)]
-    
+
+    # 帶 cursor(第一頁給 null)→ 合併分頁模式,見 _merged_search_page
+    if 'cursor' in data:
+        try:
+            state = _decode_cursor(data['cursor'], keyword)
+            page_size = int(data.get('page_size') or _MERGED_PAGE_SIZE)
+            if not 0 < page_size <= _MAX_MERGED_PAGE_SIZE:
+                raise ValueError(f'page_size 須在 1 ~ {_MAX_MERGED_PAGE_SIZE} 之間')
+        except (TypeError, ValueError) as e:
+            return jsonify({'status': 'error', 'message': f'分頁參數錯誤: {e}'}), 400
+        return jsonify(_merged_search_page(sites_to_search, keyword, state, page_size))
+
     all_results = []
     max_page_count = 0
-    
-    def search_site(site):
-        params = {'wd': keyword, 'pg': page}
-        ssl_verify = site.get('ssl_verify', True)
-        try:
-            result = process_api_request(site['url'], params, logger, ssl_verify=ssl_verify, site_name=site['name'])
-            
-            if result.get('status') == 'success':
-                if result.get('list'):
-                    for video in result['list']:
-                        video['from_site'] = site['name']
-                        video['from_site_id'] = site['id']
-                    
-                    page_count = int(result.get('pagecount', 0))
-                    return result['list'], page_count
-                else:
-                    # 搜尋成功但沒有結果
-                    page_count = int(result.get('pagecount', 0))
-                    return [], page_count
-            else:
-                # 真正的搜尋失敗
-                error_msg = result.get('message', '未知錯誤')
-                logger.warning(f"站台 {site['name']} 搜尋失敗: {error_msg}")
-                return [], 0
-        except Exception as e:
-            logger.error(f"站台 {site['name']} 搜尋異常: {type(e).__name__}: {str(e)}")
-            return [], 0
+    params = {'wd': keyword, 'pg': page}
 
-    max_workers = _search_concurrency(len(sites_to_search))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_site = {executor.submit(search_site, site): site for site in sites_to_search}
-        for future in concurrent.futures.as_completed(future_to_site):
-            try:
-                results, page_count = future.result()
-                all_results.extend(results)
-                if page_count > max_page_count:
-                    max_page_count = page_count
-            except Exception as exc:
-                site_name = future_to_site[future]['name']
-                logger.error(f'站台 {site_name} 搜尋異常: {type(exc).__name__}: {str(exc)}')
+    for site, results, page_count, _ in _fan_out_search(sites_to_search, params):
+        all_results.extend(results)
+        if page_count > max_page_count:
+            max_page_count = page_count
 
     if max_page_count == 0 and len(all_results) == 0:
         max_page_count = page
 
+    all_results = rank_results(all_results, keyword, sites_to_search)
+    summary = _search_summary(sites_to_search, all_results, page, max_page_count)
+    if grouped:
+        summary['list'] = group_results(all_results)
+        summary['total'] = len(summary['list'])
+        summary['result_count'] = len(all_results)
+        summary['grouped'] = True
+    if limit:
+        summary['list'] = summary['list'][:limit]
+    return jsonify(summary)
+
+
+# --- 合併分頁(cursor)---
+# 原本翻頁是「每個站都要第 N 頁」再串起來:每翻一頁就重打所有站,pagecount 也只是各站最大值。
+# 合併模式把各站結果當成一條條序列輪流取(round-robin),湊滿固定筆數就回一頁;
+# 每站讀到第幾頁第幾筆記在 cursor 裡(base64 JSON,伺服器不存狀態,多 worker 也通用)。
+# 回應後對「目前這頁快讀完」的站台背景預抓下一頁進 response_cache,使用者翻下一頁時大多直接命中快取。
+_MERGED_PAGE_SIZE = 20
+_MAX_MERGED_PAGE_SIZE = 100
+_MERGED_FETCH_ROUNDS = 3  # 一次請求最多補抓幾輪上游,避免某站一直回空頁時拖住回應
+
+
+def _encode_cursor(state):
+    return base64.urlsafe_b64encode(json.dumpb(state)).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor, keyword):
+    """cursor 為空 → 從頭開始;否則還原成 {'k': 關鍵字, 's': {site id 字串: [頁碼, 頁內位置, pagecount, 已結束]}}。"""
+    if not cursor:
+        return {'k': keyword, 's': {}}
+    if not isinstance(cursor, str):
+        raise ValueError('cursor 格式錯誤')
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise ValueError('cursor 格式錯誤')
+    if not isinstance(state, dict) or not isinstance(state.get('s'), dict):
+        raise ValueError('cursor 格式錯誤')
+    # 被改過 / 舊版的 cursor 要在這裡擋下,不能等 _merged_search_page 取索引時才出 500
+    for pos in state['s'].values():
+        if not (isinstance(pos, list) and len(pos) == 4 and all(type(v) is int and v >= 0 for v in pos)
+                and pos[0] >= 1 and pos[3] in (0, 1)):
+            raise ValueError('cursor 格式錯誤')
+    if state.get('k') != keyword:
+        raise ValueError('cursor 與關鍵字不符')
+    return state
+
+
+def _merged_search_page(sites, keyword, state, page_size):
+    positions = {site['id']: list(state['s'].get(str(site['id']), [1, 0, 0, 0])) for site in sites}
+    buffers = {}  # site id -> 目前這頁的結果
+    failed = {}
+    collected = []
+    fetch_rounds = 0
+    while len(collected) < page_size:
+        want = {sid: pos[0] for sid, pos in positions.items() if not pos[3] and sid not in buffers}
+        if want:
+            if fetch_rounds >= _MERGED_FETCH_ROUNDS:
+                break
+            fetch_rounds += 1
+            for site, results, page_count, error in _fan_out_search(
+                    [s for s in sites if s['id'] in want], {'wd': keyword}, pages=want):
+                pos = positions[site['id']]
+                if error:
+                    failed[site['name']] = error
+                    pos[3] = 1
+                    continue
+                buffers[site['id']] = results
+                pos[2] = page_count
+                if not results or pos[1] >= len(results):
+                    pos[3] = 1
+        if not any(sid in buffers and not pos[3] for sid, pos in positions.items()):
+            if not any(not pos[3] for pos in positions.values()):
+                break
+            continue
+        for site in sites:
+            pos = positions[site['id']]
+            buf = buffers.get(site['id'])
+            if pos[3] or buf is None:
+                continue
+            collected.append(buf[pos[1]])
+            pos[1] += 1
+            if pos[1] >= len(buf):
+                # 這頁取完:還有下一頁就前進(下一輪補抓),否則這站結束
+                if pos[0] < pos[2]:
+                    pos[0], pos[1] = pos[0] + 1, 0
+                    buffers.pop(site['id'])
+                else:
+                    pos[3] = 1
+            if len(collected) >= page_size:
+                break
+
+    # 下一頁輪流取時每站大約會用掉 share 筆;這頁剩的不夠就先預抓下一頁。
+    # 本機目錄查得到的站台下一頁一樣走目錄,不必(也不該)預抓即時搜尋
+    active = [site for site in sites if not positions[site['id']][3]]
+    share = -(-page_size // max(len(active), 1))
+    try:
+        covered = {site['id'] for site in catalog.covered_sites(active)}
+    except Exception as e:
+        logger.warning(f"本機目錄查詢失敗,略過預抓判斷: {e}")
+        covered = set()
+    for site in active:
+        if site['id'] in covered:
+            continue
+        pos = positions[site['id']]
+        buf = buffers.get(site['id'])
+        if buf is None:
+            prefetch.schedule(site, {'wd': keyword, 'pg': pos[0]})
+        elif len(buf) - pos[1] <= share and pos[0] < pos[2]:
+            prefetch.schedule(site, {'wd': keyword, 'pg': pos[0] + 1})
+
+    has_more = any(not pos[3] for pos in positions.values())
+    next_state = {'k': keyword, 's': {str(sid): pos for sid, pos in positions.items()}}
+    return {
+        'status': 'success',
+        'list': rank_results(collected, keyword, sites),
+        'total': len(collected),
+        'has_more': has_more,
+        'next_cursor': _encode_cursor(next_state) if has_more else None,
+        'failed_sites': failed,
+    }
+
+
+def _search_summary(sites_to_search, all_results, page, max_page_count):
+    """多站搜尋的彙總(list / pagecount / search_stats),一般回應與串流最後一幀共用。"""
     # 統計各站台的搜尋結果
     results_by_site = {}
     # 初始化所有站台的結果為0
@@ -689,7 +973,7 @@ def multi_site_search():
 
     logger.info(f"多站台搜尋完成 - 總結果數: {len(all_results)}, 參與搜尋站台數: {len(sites_to_search)}, 有結果站台數: {len([s for s in results_by_site.values() if s > 0])}, 各站台統計: {results_by_site}")
 
-    return jsonify({
+    return {
         'status': 'success',
         'list': all_results,
         'page': page,
@@ -700,24 +984,92 @@ def multi_site_search():
             'sites_with_results': len(results_by_site),
             'results_by_site': results_by_site
         }
-    })
+    }
+
+
+@api_bp.route('/multi_site_search/stream', methods=['POST'])
+def multi_site_search_stream():
+    """多站搜尋的串流版(NDJSON):每個站台一完成就送出一行,不必等最慢的站台。
+
+    每行一個 JSON 物件:
+      {"type": "site", "site_id", "site_name", "status", "message", "pagecount", "count", "list": [...]}
+      {"type": "summary", ...}  最後一行;欄位與 /api/multi_site_search 回應相同,但 list 為空
+                                (影片已在前面各站那幾行送過,不重複傳),改給 order:
+                                依相關度排好(有 limit 就只到前幾筆)的 [site_id, vod_id],前端照這個順序重排。
+    """
+    data = request.json or {}
+    site_ids = data.get('site_ids', [])
+    keyword = data.get('keyword')
+    page = data.get('page', 1)
+
+    if not site_ids:
+        return jsonify({'status': 'error', 'message': '缺少站台資訊'}), 400
+    try:
+        limit = _parse_limit(data.get('limit'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f'limit 參數錯誤: {e}'}), 400
+
+    sites_to_search = [s for s in get_sites() if s['id'] in site_ids and s.get('enabled', True)]
+    params = {'wd': keyword, 'pg': page}
+
+    def generate():
+        all_results = []
+        max_page_count = 0
+        for site, results, page_count, error_msg in _fan_out_search(sites_to_search, params):
+            all_results.extend(results)
+            max_page_count = max(max_page_count, page_count)
+            frame = {
+                'type': 'site',
+                'site_id': site['id'],
+                'site_name': site['name'],
+                'status': 'error' if error_msg else 'success',
+                'message': error_msg,
+                'pagecount': page_count,
+                'count': len(results),
+                'list': results,
+            }
+            yield json.dumps(frame, ensure_ascii=False) + '\n'
+
+        if max_page_count == 0 and not all_results:
+            max_page_count = page
+        ranked = rank_results(all_results, keyword, sites_to_search, limit=limit)
+        summary = _search_summary(sites_to_search, all_results, page, max_page_count)
+        summary['type'] = 'summary'
+        summary['list'] = []
+        summary['order'] = [[video['from_site_id'], video['vod_id']] for video in ranked]
+        yield json.dumps(summary, ensure_ascii=False) + '\n'
+
+    resp = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # 告訴 nginx 之類的反向代理不要緩衝,否則串流會被攢到最後才一次送出
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
 
 @api_bp.route('/sites/check_now', methods=['POST'])
 def check_sites_now():
-    """立即檢查所有站點並返回結果"""
-    from site_manager import check_sites_immediately
+    """開始檢查所有站點,立即回傳工作狀態(含 job id),進度用 check_job_status 輪詢"""
+    from site_manager import start_check_job
     try:
         data = request.json or {}
         include_disabled = data.get('include_disabled', False)
-        results = check_sites_immediately(include_disabled=include_disabled)
+        job = start_check_job(include_disabled=include_disabled)
         return jsonify({
             'status': 'success',
-            'results': results
+            'job': job
         })
     except Exception as e:
         logger.error(f"立即檢查站點失敗: {e}")
         return jsonify({'status': 'error', 'message': f'檢查失敗: {e}'}), 500
 
+@api_bp.route('/sites/check_now/<job_id>', methods=['GET'])
+def check_job_status(job_id):
+    """查詢立即檢查工作的進度與已完成的結果"""
+    from site_manager import get_check_job
+    job = get_check_job(job_id)
+    if not job:
+        return jsonify({'status': 'error', 'message': '找不到這個檢查工作'}), 404
+    return jsonify({'status': 'success', 'job': job})
+
 @api_bp.route('/sites/<int:site_id>/check', methods=['POST'])
 def check_single_site(site_id):
     """檢查單一站點"""
@@ -732,9 +1084,36 @@ def check_single_site(site_id):
         logger.error(f"檢查站點 {site_id} 失敗: {e}")
         return jsonify({'status': 'error', 'message': f'檢查失敗: {e}'}), 500
 
+# 歷史更新檢查的時間預算(秒):到了就不再送新的批次,沒查到的下次再查;可用 config.json 的 history_check_budget 覆寫
+_HISTORY_CHECK_BUDGET = 45
+
+
+def _update_check_result(item, detail):
+    """依最新詳情比對歷史記錄的集數,組出單筆檢查結果。"""
+    video_id = item.get('videoId')
+    site_url = item.get('siteUrl')
+    old_total_episodes = item.get('totalEpisodes', 0)
+    # 計算總集數（取各來源最大值）
+    total_episodes = max((source['count'] for source in detail['sources']), default=0)
+    result = {
+        'videoId': video_id,
+        'siteUrl': site_url,
+        'status': 'success',
+        'totalEpisodes': total_episodes,
+        'hasUpdate': False
+    }
+    # 首次記錄集數(old 為 0)不算更新
+    if old_total_episodes and total_episodes > old_total_episodes:
+        result['hasUpdate'] = True
+        result['newEpisodesCount'] = total_episodes - old_total_episodes
+        logger.info(f"發現更新: {item.get('videoName', '未知影片')} 新增 {result['newEpisodesCount']} 集 "
+                    f"(從 {old_total_episodes} 到 {total_episodes})")
+    return result
+
+
 @api_bp.route('/history/check_updates', methods=['POST'])
 def check_history_updates():
-    """批量檢查歷史記錄更新"""
+    """批量檢查歷史記錄更新:依 siteUrl 分組,每站以 ac=videolist&ids= 批次查詳情,各站同時進行"""
     try:
         data = request.json
         history_items = data.get('history_items', [])
@@ -742,106 +1121,61 @@ def check_history_updates():
         if not history_items:
             return jsonify({'status': 'error', 'message': '沒有要檢查的歷史記錄'}), 400
         
-        # 限制最多檢查10個，避免過度請求
-        history_items = history_items[:10]
+        history_items = history_items[:MAX_HISTORY_ITEMS]
         
         all_sites = get_sites()
         results = []
-        updated_count = 0
-        failed_count = 0
+        groups = {}  # siteUrl -> 該站要查的歷史項目
         
         for item in history_items:
-            try:
-                video_id = item.get('videoId')
-                site_url = item.get('siteUrl')
-                site_name = item.get('siteName')
-                old_total_episodes = item.get('totalEpisodes', 0)
-                video_name = item.get('videoName', '未知影片')
-                
-                # 以 siteUrl 為準直接查;本地剛好有這站台就沿用其 ssl_verify / 名稱,沒有也照樣能查
-                site = next((s for s in all_sites if s['url'] == site_url), None)
-                if not site_url or (site and not site.get('enabled', True)):
-                    results.append({
-                        'videoId': video_id,
-                        'siteUrl': site_url,
-                        'status': 'skipped',
-                        'reason': '歷史無站台網址,或本地對應站台已停用'
-                    })
-                    continue
-
-                # 獲取影片詳情
-                ssl_verify = site.get('ssl_verify', True) if site else True
-                check_name = site['name'] if site else (site_name or site_url)
-                detail_result = get_details_from_api(site_url, video_id, logger, ssl_verify=ssl_verify, site_name=check_name)
-                
-                if detail_result.get('status') != 'success' or not detail_result.get('data'):
-                    results.append({
-                        'videoId': video_id,
-                        'siteUrl': site_url,
-                        'status': 'failed',
-                        'reason': detail_result.get('message', '獲取詳情失敗')
-                    })
-                    failed_count += 1
-                    continue
-                
-                # 計算總集數（取各來源最大值）
-                total_episodes = 0
-                for source in detail_result['data']:
-                    if source.get('episodes'):
-                        episode_count = len(source['episodes'])
-                        if episode_count > total_episodes:
-                            total_episodes = episode_count
-                
-                # 比較集數變化
-                has_update = False
-                new_episodes_count = 0
-                
-                if old_total_episodes == 0:
-                    # 首次記錄集數
-                    results.append({
-                        'videoId': video_id,
-                        'siteUrl': site_url,
-                        'status': 'success',
-                        'totalEpisodes': total_episodes,
-                        'hasUpdate': False
-                    })
-                elif total_episodes > old_total_episodes:
-                    # 有新集數
-                    has_update = True
-                    new_episodes_count = total_episodes - old_total_episodes
-                    updated_count += 1
-                    
-                    results.append({
-                        'videoId': video_id,
-                        'siteUrl': site_url,
-                        'status': 'success',
-                        'totalEpisodes': total_episodes,
-                        'hasUpdate': True,
-                        'newEpisodesCount': new_episodes_count
-                    })
-                    
-                    logger.info(f"發現更新: {video_name} 新增 {new_episodes_count} 集 (從 {old_total_episodes} 到 {total_episodes})")
-                else:
-                    # 無變化
-                    results.append({
-                        'videoId': video_id,
-                        'siteUrl': site_url,
-                        'status': 'success',
-                        'totalEpisodes': total_episodes,
-                        'hasUpdate': False
-                    })
-                
-            except Exception as e:
-                logger.error(f"檢查影片 {item.get('videoName', '未知')} 更新失敗: {e}")
+            site_url = item.get('siteUrl')
+            # 以 siteUrl 為準直接查;本地剛好有這站台就沿用其 ssl_verify / 名稱,沒有也照樣能查
+            site = next((s for s in all_sites if s['url'] == site_url), None)
+            if not site_url or item.get('videoId') is None or (site and not site.get('enabled', True)):
                 results.append({
                     'videoId': item.get('videoId'),
-                    'siteUrl': item.get('siteUrl'),
-                    'status': 'error',
-                    'reason': str(e)
+                    'siteUrl': site_url,
+                    'status': 'skipped',
+                    'reason': '歷史無站台網址,或本地對應站台已停用'
                 })
-                failed_count += 1
-        
-        logger.info(f"批量檢查完成: 檢查 {len(history_items)} 個，更新 {updated_count} 個，失敗 {failed_count} 個")
+                continue
+            groups.setdefault(site_url, []).append(item)
+
+        deadline = time.monotonic() + get_config_value('history_check_budget', _HISTORY_CHECK_BUDGET)
+
+        def check_site(site_url, items):
+            site = next((s for s in all_sites if s['url'] == site_url), None)
+            ssl_verify = site.get('ssl_verify', True) if site else True
+            check_name = site['name'] if site else (items[0].get('siteName') or site_url)
+            return get_details_batch(site_url, [item['videoId'] for item in items], logger,
+                                     ssl_verify=ssl_verify, site_name=check_name, deadline=deadline)
+
+        if groups:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=_search_concurrency(len(groups))) as executor:
+                future_to_url = {executor.submit(check_site, url, items): url for url, items in groups.items()}
+                for future in concurrent.futures.as_completed(future_to_url):
+                    site_url = future_to_url[future]
+                    try:
+                        details, error = future.result()
+                    except Exception as e:
+                        logger.error(f"檢查站台 {site_url} 的歷史更新失敗: {e}")
+                        details, error = {}, str(e)
+                    for item in groups[site_url]:
+                        detail = details.get(str(item['videoId']))
+                        if detail and detail['sources']:
+                            results.append(_update_check_result(item, detail))
+                        else:
+                            results.append({
+                                'videoId': item['videoId'],
+                                'siteUrl': site_url,
+                                'status': 'failed',
+                                'reason': error or '獲取詳情失敗'
+                            })
+
+        updated_count = sum(1 for r in results if r.get('hasUpdate'))
+        failed_count = sum(1 for r in results if r['status'] == 'failed')
+        logger.info(f"批量檢查完成: 檢查 {len(history_items)} 個（{len(groups)} 個站台），"
+                    f"更新 {updated_count} 個，失敗 {failed_count} 個")
         
         return jsonify({
             'status': 'success',
@@ -1,6 +1,6 @@
 import os
 import time
-import json
+import codec as json
 import secrets
 import threading
 from flask import Blueprint, request, render_template, session, redirect, url_for, jsonify
@@ -483,7 +483,8 @@ def init_auth_check(app):
                 or ep.startswith('members.')
                 or ep in ('api.manage_site', 'api.move_site', 'api.probe_batch',
                           'api.import_sites', 'api.export_sites',
-                          'api.check_sites_now', 'api.check_single_site')
+                          'api.check_sites_now', 'api.check_job_status', 'api.check_single_site',
+                          'api.metrics_export')
                 or (ep == 'api.add_or_get_sites' and request.method == 'POST')
                 or (ep == 'main.site_settings' and request.method == 'POST')
             )
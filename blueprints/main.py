@@ -1,7 +1,7 @@
 from flask import Blueprint, render_template, request, jsonify, send_file, Response, session
 import os
 import time
-import ujson as json
+import codec as json
 import storage
 from config import get_config_value, set_config_value
 
@@ -0,0 +1,333 @@
+# catalog.py
+#
+# 選用的本機影片目錄(SQLite FTS5)。關鍵字搜尋原本每次都即時打所有啟用的站台,
+# 最慢的站決定整體延遲;這裡在背景把各站的影片列表逐頁爬進本機 SQLite,
+# multi_site_search 對已收錄的站台直接查索引(毫秒級),還沒收錄 / 太久沒同步的站台照舊即時搜尋。
+#
+#   - 資料表 videos:每站每部影片一列(片名、年份、地區、類型、備註、封面、vod_time);
+#     videos_fts 是片名的 FTS5 索引(external content,由觸發器同步),tokenizer 用 trigram,
+#     中文片名不必斷詞就能做子字串比對;少於 3 個字的關鍵字 trigram 用不上,改用 LIKE 掃片名。
+#   - 爬取登記成 periodic 的定期工作:每輪在 catalog_crawl_budget 秒內逐頁讀,
+#     頁碼記在 crawl_state,下一輪接著讀;整站讀完記 completed_at,水位 synced_at 記爬取開始的時間。
+#     站台有學到 list_pic 模式時讀 ac=list(較輕),否則讀 ac=videolist(才有封面)。
+#   - 之後每 catalog_sync_interval(預設 1 小時)做增量同步:同樣的列表加 h=N,
+#     只讀水位之後更新過的影片,一站通常一兩個請求;讀完才推進水位。
+#     整站重爬只為了清掉下架的影片,間隔 catalog_refresh_hours(預設 7 天);
+#     增量斷了超過 _MAX_SYNC_HOURS(站台掛了好幾天)也改成整站重爬。
+#   - 每站的請求都依序送(不對單一主機併發),站台之間最多 catalog_concurrency 個同時進行,
+#     整輪共用一個時間預算,沒做完的下一輪接著做。
+#   - 搜尋只採用 synced_at 在 3 × catalog_sync_interval 內的站台,太舊的當作沒收錄。
+#
+# 預設關閉(config.json 的 catalog 設 true 開啟);serverless(KV 後端 / Vercel)沒有可寫的本機磁碟,一律不啟用。
+# Python 內建的 sqlite3 沒編進 FTS5 時也自動停用。
+
+import os
+import math
+import time
+import sqlite3
+import threading
+import concurrent.futures
+import storage
+import periodic
+from config import get_config_value
+from site_manager import get_sites
+from api_parser import (fetch_json_page, page_count, normalize_base_url, absolute_pic_url, site_list_mode,
+                        LIST_MODE_LIST_PIC)
+from logger_config import setup_logger
+
+DB_FILE = 'catalog.db'
+PAGE_SIZE = 20                # 回給 multi_site_search 的每站每頁筆數,跟 MacCMS 預設一致
+DEFAULT_SYNC_INTERVAL = 3600  # 秒;增量同步的間隔
+DEFAULT_REFRESH_HOURS = 168   # 整站重爬(清掉下架影片)的間隔
+_MAX_SYNC_HOURS = 72          # 增量同步最多往回補幾小時,再久就整站重爬
+DEFAULT_CRAWL_BUDGET = 50     # 秒;每輪爬取的時間預算
+DEFAULT_CONCURRENCY = 2       # 同時爬幾個站台(同一站依序翻頁)
+_CRAWL_EVERY = 60
+
+_FIELDS = ('vod_name', 'vod_year', 'vod_area', 'type_name', 'vod_remarks', 'vod_pic', 'vod_time')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    site_url TEXT NOT NULL,
+    vod_id TEXT NOT NULL,
+    vod_name TEXT NOT NULL,
+    vod_year TEXT, vod_area TEXT, type_name TEXT, vod_remarks TEXT, vod_pic TEXT, vod_time TEXT,
+    synced_at REAL NOT NULL,
+    UNIQUE (site_url, vod_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS videos_fts USING fts5(
+    vod_name, content='videos', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS videos_ai AFTER INSERT ON videos BEGIN
+    INSERT INTO videos_fts(rowid, vod_name) VALUES (new.id, new.vod_name);
+END;
+CREATE TRIGGER IF NOT EXISTS videos_ad AFTER DELETE ON videos BEGIN
+    INSERT INTO videos_fts(videos_fts, rowid, vod_name) VALUES ('delete', old.id, old.vod_name);
+END;
+CREATE TRIGGER IF NOT EXISTS videos_au AFTER UPDATE OF vod_name ON videos BEGIN
+    INSERT INTO videos_fts(videos_fts, rowid, vod_name) VALUES ('delete', old.id, old.vod_name);
+    INSERT INTO videos_fts(rowid, vod_name) VALUES (new.id, new.vod_name);
+END;
+-- 單站依更新時間分頁;帶 vod_name 讓 3 字以下的 LIKE 計數只掃索引、不必回表
+CREATE INDEX IF NOT EXISTS videos_site_time ON videos (site_url, vod_time, vod_name);
+CREATE TABLE IF NOT EXISTS crawl_state (
+    site_url TEXT PRIMARY KEY,
+    next_page INTEGER NOT NULL DEFAULT 1,
+    pagecount INTEGER,
+    started_at REAL,
+    completed_at REAL,
+    synced_at REAL
+);
+"""
+
+logger = setup_logger()
+_local = threading.local()
+_fts5 = None
+
+
+def _fts5_available():
+    global _fts5
+    if _fts5 is None:
+        try:
+            sqlite3.connect(':memory:').execute("CREATE VIRTUAL TABLE t USING fts5(a, tokenize='trigram')")
+            _fts5 = True
+        except sqlite3.Error:
+            logger.warning("sqlite3 不支援 FTS5 trigram,本機目錄停用")
+            _fts5 = False
+    return _fts5
+
+
+def enabled():
+    return periodic.enabled() and bool(get_config_value('catalog', False)) and _fts5_available()
+
+
+def _db():
+    """每條執行緒(也依 pid 區分,fork 後不沿用)一個連線;WAL 讓爬取寫入時搜尋照樣能讀。"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+    os.makedirs(storage.DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(storage.DATA_DIR, DB_FILE), timeout=10)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(_SCHEMA)
+    _local.conn, _local.pid = conn, os.getpid()
+    return conn
+
+
+def _refresh_seconds():
+    return get_config_value('catalog_refresh_hours', DEFAULT_REFRESH_HOURS) * 3600
+
+
+# --- 寫入 ---
+
+def upsert(site_url, items, now=None):
+    """把一頁影片寫進目錄(同站同 vod_id 覆寫),回傳寫入筆數。海報存成絕對網址(同列表的補圖)。"""
+    now = now or time.time()
+    rows = []
+    for item in items:
+        if not isinstance(item, dict) or item.get('vod_id') is None or not item.get('vod_name'):
+            continue
+        item = dict(item, vod_pic=absolute_pic_url(site_url, item.get('vod_pic') or ''))
+        rows.append((site_url, str(item['vod_id'])) + tuple(str(item.get(f) or '') for f in _FIELDS) + (now,))
+    if not rows:
+        return 0
+    conn = _db()
+    with conn:
+        conn.executemany(
+            f"INSERT INTO videos (site_url, vod_id, {', '.join(_FIELDS)}, synced_at) "
+            f"VALUES ({', '.join('?' * (len(_FIELDS) + 3))}) "
+            f"ON CONFLICT (site_url, vod_id) DO UPDATE SET "
+            + ', '.join(f'{f} = excluded.{f}' for f in _FIELDS + ('synced_at',)),
+            rows)
+    return len(rows)
+
+
+def _state(site_url):
+    row = _db().execute('SELECT * FROM crawl_state WHERE site_url = ?', (site_url,)).fetchone()
+    return dict(row) if row else None
+
+
+def _save_state(site_url, **fields):
+    conn = _db()
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO crawl_state (site_url) VALUES (?)', (site_url,))
+        conn.execute(f"UPDATE crawl_state SET {', '.join(f'{k} = ?' for k in fields)} WHERE site_url = ?",
+                     tuple(fields.values()) + (site_url,))
+
+
+# --- 爬取 ---
+
+def _list_ac(site_url):
+    return 'list' if site_list_mode(site_url) == LIST_MODE_LIST_PIC else 'videolist'
+
+
+def _needs_crawl(state, now):
+    if not state or not state.get('completed_at'):
+        return True
+    if (state.get('next_page') or 1) > 1 or now - state['completed_at'] >= _refresh_seconds():
+        return True
+    # 增量同步斷了太久(站台掛了好幾天),h 窗口已經補不回來,只能整站重爬
+    return now - (state.get('synced_at') or 0) >= _MAX_SYNC_HOURS * 3600
+
+
+def _needs_sync(state, now):
+    if not state or not state.get('completed_at') or not state.get('synced_at'):
+        return False
+    age = now - state['synced_at']
+    return get_config_value('catalog_sync_interval', DEFAULT_SYNC_INTERVAL) <= age < _MAX_SYNC_HOURS * 3600
+
+
+def crawl_site(site, deadline):
+    """從上次停下的頁碼接著爬一個站台,直到讀完或時間用完。回傳這次寫入幾筆。"""
+    site_url = normalize_base_url(site['url'])
+    now = time.time()
+    state = _state(site_url) or {}
+    page = state.get('next_page') or 1
+    if page == 1:
+        _save_state(site_url, started_at=now)
+        state['started_at'] = now
+    ac = _list_ac(site_url)
+    written = 0
+    while time.monotonic() < deadline:
+        data, error = fetch_json_page(site['url'], {'ac': ac, 'pg': page}, logger,
+                                      ssl_verify=site.get('ssl_verify', True), site_name=site['name'],
+                                      label='目錄頁')
+        if data is None:
+            logger.warning(f"目錄爬取 [{site['name']}] 第 {page} 頁失敗: {error}")
+            break
+        written += upsert(site_url, data.get('list') or [])
+        total_pages = page_count(data)
+        if page >= total_pages:
+            # 整站讀完:這輪開始之前就存在、這次沒再出現的影片(站台下架)刪掉
+            conn = _db()
+            with conn:
+                conn.execute('DELETE FROM videos WHERE site_url = ? AND synced_at < ?',
+                             (site_url, state['started_at']))
+            # 水位記爬取開始的時間:爬的過程中才更新的影片,下一次增量同步會補上
+            synced_at = max(state['started_at'], state.get('synced_at') or 0)
+            _save_state(site_url, next_page=1, pagecount=total_pages, completed_at=time.time(), synced_at=synced_at)
+            logger.info(f"目錄爬取 [{site['name']}] 完成: 共 {total_pages} 頁")
+            return written
+        page += 1
+        _save_state(site_url, next_page=page, pagecount=total_pages)
+    return written
+
+
+def sync_site(site, state, deadline):
+    """增量同步:讀上次水位之後更新過的影片(ac=...&h=N,N 為距水位的小時數 + 1)寫回目錄。
+    讀完才推進水位;中途出錯或時間用完就不動,下一輪以更大的 N 重讀(寫入是覆寫,重讀無妨)。"""
+    site_url = normalize_base_url(site['url'])
+    started = time.time()
+    hours = math.ceil((started - state['synced_at']) / 3600) + 1
+    ac = _list_ac(site_url)
+    written = 0
+    page = 1
+    while time.monotonic() < deadline:
+        data, error = fetch_json_page(site['url'], {'ac': ac, 'h': hours, 'pg': page}, logger,
+                                      ssl_verify=site.get('ssl_verify', True), site_name=site['name'],
+                                      label='目錄增量')
+        if data is None:
+            logger.warning(f"目錄增量同步 [{site['name']}] 第 {page} 頁失敗: {error}")
+            return written
+        written += upsert(site_url, data.get('list') or [])
+        if page >= page_count(data):
+            _save_state(site_url, synced_at=started)
+            return written
+        page += 1
+    return written
+
+
+def update_site(site, deadline):
+    """一個站台這一輪要做的事:先增量同步(便宜、讓索引保持新鮮),再視需要接著整站爬取。
+    同一站的請求都在這裡依序送,不會對單一主機併發。"""
+    now = time.time()
+    state = _state(normalize_base_url(site['url']))
+    written = 0
+    if _needs_sync(state, now):
+        written += sync_site(site, state, deadline)
+    if _needs_crawl(state, now) and time.monotonic() < deadline:
+        written += crawl_site(site, deadline)
+    return written
+
+
+def run_round():
+    """同步 / 爬取一輪需要更新的站台,回傳寫入筆數。"""
+    now = time.time()
+    sites = [s for s in get_sites() if s.get('enabled', True)]
+    todo = []
+    for site in sites:
+        state = _state(normalize_base_url(site['url']))
+        if _needs_sync(state, now) or _needs_crawl(state, now):
+            todo.append(site)
+    if not todo:
+        return 0
+    deadline = time.monotonic() + get_config_value('catalog_crawl_budget', DEFAULT_CRAWL_BUDGET)
+    workers = max(1, min(get_config_value('catalog_concurrency', DEFAULT_CONCURRENCY), len(todo)))
+    written = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='catalog') as pool:
+        futures = {pool.submit(update_site, site, deadline): site for site in todo}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                written += future.result()
+            except Exception as e:
+                logger.error(f"目錄更新 [{futures[future]['name']}] 出錯: {e}", exc_info=True)
+    return written
+
+
+# --- 查詢 ---
+
+def covered_sites(sites):
+    """sites 裡目錄夠新、可以直接查索引的站台。"""
+    if not sites or not enabled():
+        return []
+    fresh_after = time.time() - 3 * get_config_value('catalog_sync_interval', DEFAULT_SYNC_INTERVAL)
+    rows = _db().execute('SELECT site_url FROM crawl_state WHERE synced_at >= ?', (fresh_after,)).fetchall()
+    fresh = {row['site_url'] for row in rows}
+    return [s for s in sites if normalize_base_url(s['url']) in fresh]
+
+
+def _escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _vod_id(value):
+    return int(value) if value.isdigit() else value
+
+
+def search(keyword, sites, page=1):
+    """對已收錄的站台查片名,回傳 {site id: (影片清單, pagecount)},每站分頁方式同 MacCMS(每頁 PAGE_SIZE 筆)。
+    每站各查一次:分頁(LIMIT / OFFSET)與總數(COUNT)都在 SQL 裡做,只把這一頁的資料讀進 Python。"""
+    keyword = (keyword or '').strip()
+    by_url = {normalize_base_url(s['url']): s for s in sites}
+    if not keyword or not by_url:
+        return {}
+    if len(keyword) >= 3:
+        # CROSS JOIN 固定先走 FTS 再回表;一般 JOIN 時規劃器會先掃整站再逐筆查 FTS,大目錄慢上千倍
+        source = ("videos_fts CROSS JOIN videos v ON v.id = videos_fts.rowid "
+                  "WHERE videos_fts MATCH ? AND v.site_url = ?")
+        match = '"' + keyword.replace('"', '""') + '"'
+    else:
+        # trigram 索引查不了 3 字以下;用 site_url 索引縮到單站再 LIKE
+        source = "videos v WHERE v.site_url = ? AND v.vod_name LIKE ? ESCAPE '\\'"
+        match = f'%{_escape_like(keyword)}%'
+
+    conn = _db()
+    offset = (max(int(page), 1) - 1) * PAGE_SIZE
+    results = {}
+    for url, site in by_url.items():
+        args = (match, url) if len(keyword) >= 3 else (url, match)
+        total = conn.execute(f"SELECT COUNT(*) FROM {source}", args).fetchone()[0]
+        rows = conn.execute(f"SELECT v.* FROM {source} ORDER BY v.vod_time DESC LIMIT ? OFFSET ?",
+                            args + (PAGE_SIZE, offset)).fetchall() if offset < total else []
+        # vod_id 還原成數字(站台原本回的型別),前端比對歷史 / 收藏用的是嚴格相等
+        videos = [dict({f: row[f] for f in _FIELDS}, vod_id=_vod_id(row['vod_id']), from_site=site['name'],
+                       from_site_id=site['id'], from_catalog=True)
+                  for row in rows]
+        results[site['id']] = (videos, (total + PAGE_SIZE - 1) // PAGE_SIZE)
+    return results
+
+
+periodic.register('catalog', run_round, _CRAWL_EVERY, enabled=enabled)
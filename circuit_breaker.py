@@ -0,0 +1,180 @@
+# circuit_breaker.py
+#
+# 每個站台一個熔斷器,由真實的上游請求結果驅動(列表 / 搜尋 / 詳情,以及背景健康檢查)。
+# 舊版只有按「立即檢查」時才更新 consecutive_errors,多站搜尋照樣對連續逾時幾十次的站台送請求,
+# 每次都白等 request_timeout 秒。狀態:
+#   closed    正常放行;連續失敗達門檻 → open
+#   open      直接拒絕(不打上游),冷卻時間到 → half_open
+#   half_open 只放一個試探請求:成功 → closed;失敗 → 回 open,冷卻時間加倍(有上限)
+#
+# 狀態存在程序記憶體(gunicorn 每個 worker 各一份),不落盤:熔斷是「最近幾分鐘」的判斷,
+# 重啟後從 closed 重新觀察即可。背景健康檢查只跑在持有租約的 worker,它寫進 sites.json 的結果
+# 由 adopt_check 在搜尋前套進其他 worker 的熔斷器。門檻與冷卻可在 config.json 的
+# breaker_failure_threshold / breaker_cooldown 調整。
+
+import time
+import threading
+from datetime import datetime
+from config import get_config_value
+import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_COOLDOWN = 60          # 秒
+_MAX_COOLDOWN = 15 * 60        # 試探一再失敗時,冷卻最多拉到 15 分鐘
+
+_lock = threading.Lock()
+_breakers = {}  # clean_base_url -> dict
+
+
+def _breaker(clean_base_url):
+    b = _breakers.get(clean_base_url)
+    if b is None:
+        b = {
+            'state': CLOSED,
+            'failures': 0,          # 連續失敗次數
+            'opened_at': 0.0,
+            'cooldown': get_config_value('breaker_cooldown', DEFAULT_COOLDOWN),
+            'probe_started_at': 0.0,
+            'last_error': None,
+            'last_change': 0.0,     # 從沒變過狀態時為 0,任何持久化的檢查結果都比它新
+        }
+        _breakers[clean_base_url] = b
+    return b
+
+
+def _set_state(b, state):
+    b['state'] = state
+    b['last_change'] = time.time()
+
+
+def allow(clean_base_url):
+    """這次可以打上游嗎?half_open 時只有第一個呼叫者拿到試探名額。
+
+    只在「真的要送請求」前呼叫(快取命中之類不算),拿到名額就一定要回報 record_*。
+    """
+    now = time.time()
+    with _lock:
+        b = _breaker(clean_base_url)
+        if b['state'] == CLOSED:
+            return True
+        if b['state'] == OPEN:
+            if now - b['opened_at'] < b['cooldown']:
+                return False
+            _set_state(b, HALF_OPEN)
+            b['probe_started_at'] = now
+            return True
+        # half_open:試探請求還沒回來就不再放行;但試探本身卡死太久(超過冷卻時間)就再給一次機會
+        if now - b['probe_started_at'] >= b['cooldown']:
+            b['probe_started_at'] = now
+            return True
+        return False
+
+
+def record_success(clean_base_url):
+    with _lock:
+        b = _breaker(clean_base_url)
+        b['failures'] = 0
+        b['last_error'] = None
+        if b['state'] != CLOSED:
+            _set_state(b, CLOSED)
+            b['cooldown'] = get_config_value('breaker_cooldown', DEFAULT_COOLDOWN)
+
+
+def record_failure(clean_base_url, reason=''):
+    now = time.time()
+    with _lock:
+        b = _breaker(clean_base_url)
+        b['failures'] += 1
+        b['last_error'] = reason
+        if b['state'] == HALF_OPEN:
+            b['cooldown'] = min(b['cooldown'] * 2, _MAX_COOLDOWN)
+            b['opened_at'] = now
+            _set_state(b, OPEN)
+        elif b['state'] == CLOSED and b['failures'] >= get_config_value('breaker_failure_threshold', DEFAULT_FAILURE_THRESHOLD):
+            b['opened_at'] = now
+            _set_state(b, OPEN)
+
+
+def record_response(clean_base_url, status_code, text):
+    """依一次 HTTP 回應判定成敗:4xx/5xx、空回應、回 HTML 都算站台壞了;
+    能回 JSON(即使是 code != 1 或「暫不支持搜索」)代表站台活著。"""
+    stripped = text.lstrip()[:1] if text else ''
+    if status_code >= 400:
+        record_failure(clean_base_url, f'HTTP {status_code}')
+    elif not stripped or stripped == '<':
+        record_failure(clean_base_url, '非 JSON 回應')
+    else:
+        record_success(clean_base_url)
+
+
+def adopt_check(clean_base_url, site):
+    """把 site(get_sites() 的一筆)裡背景健康檢查寫回的結果套進本 worker 的熔斷器。
+
+    只採用比本機最近一次狀態變化還新的檢查:成功就關閉熔斷;連續失敗達門檻就打開,
+    冷卻從檢查時間起算。重複套用同一筆結果不會改變狀態,可以每次搜尋前都呼叫。
+    """
+    try:
+        checked_at = datetime.fromisoformat(site['last_check']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return
+    with _lock:
+        b = _breaker(clean_base_url)
+        if checked_at <= b['last_change']:
+            return
+        if site.get('check_status') == 'success':
+            if b['state'] != CLOSED:
+                b['failures'] = 0
+                b['last_error'] = None
+                b['cooldown'] = get_config_value('breaker_cooldown', DEFAULT_COOLDOWN)
+                _set_state(b, CLOSED)
+        elif site.get('check_status') == 'failed' and b['state'] == CLOSED:
+            b['failures'] = max(b['failures'], site.get('consecutive_errors', 0))
+            if b['failures'] >= get_config_value('breaker_failure_threshold', DEFAULT_FAILURE_THRESHOLD):
+                b['last_error'] = '背景健康檢查失敗'
+                b['opened_at'] = checked_at
+                _set_state(b, OPEN)
+
+
+def open_message(clean_base_url):
+    """被熔斷擋下時回給前端的錯誤訊息。"""
+    with _lock:
+        b = _breaker(clean_base_url)
+        remaining = max(0, int(b['cooldown'] - (time.time() - b['opened_at'])))
+    return f"站台連續失敗，已暫停請求（約 {remaining} 秒後重試）"
+
+
+def snapshot(clean_base_url):
+    """給設定頁顯示的熔斷狀態。"""
+    now = time.time()
+    with _lock:
+        b = _breakers.get(clean_base_url)
+        if b is None:
+            return {'state': CLOSED, 'failures': 0, 'retry_in': 0, 'last_error': None}
+        retry_in = 0
+        if b['state'] == OPEN:
+            retry_in = max(0, int(b['cooldown'] - (now - b['opened_at'])))
+        return {
+            'state': b['state'],
+            'failures': b['failures'],
+            'retry_in': retry_in,
+            'last_error': b['last_error'],
+        }
+
+
+def all_snapshots():
+    with _lock:
+        urls = list(_breakers)
+    return {url: snapshot(url) for url in urls}
+
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+metrics.describe('breaker_state', 'gauge', 'Circuit breaker state per site (0 closed, 1 half_open, 2 open).')
+metrics.register_collector(lambda: [
+    ('breaker_state', {'site': url}, _STATE_VALUES[snap['state']])
+    for url, snap in all_snapshots().items()
+])
@@ -0,0 +1,79 @@
+# codec.py
+#
+# 全專案共用的 JSON 編解碼。原本 api_parser / site_manager / config 用 ujson,blueprints 用標準庫 json,
+# 詳情還走 requests 的 Response.json()(先整包解碼成文字再用標準庫解析),同一份資料各走各的路。
+# 現在一律經過這裡,後端依可用性挑最快的:orjson > ujson > 標準庫 json。
+#
+# 介面刻意跟 json / ujson 相容(loads / dumps,接受 ensure_ascii、indent),
+# 各模組只要 `import codec as json` 就能換過來:
+#   - loads 接受 str 或 bytes(orjson 可直接吃 UTF-8 位元組,少一次解碼);
+#   - dumps 一律回傳 str、不轉義非 ASCII(存檔 / 回應本來就都是 UTF-8);
+#     有 indent 時 orjson 只支援 2 格縮排,sites.json / config.json 之類的人看檔因此改成 2 格;
+#   - dumpb 回傳 bytes,給 Flask 回應直接用。
+# 解析失敗一律丟 ValueError 的子類別(三種後端都是),呼叫端照舊 except ValueError。
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 依部署環境而定
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+import json as _stdlib_json
+
+BACKEND = 'orjson' if orjson else ('ujson' if ujson else 'json')
+
+if orjson:
+    _OPTS = orjson.OPT_NON_STR_KEYS
+    _INDENT_OPTS = _OPTS | orjson.OPT_INDENT_2
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumpb(obj, indent=None, ensure_ascii=False, default=None):
+        return orjson.dumps(obj, default=default, option=_INDENT_OPTS if indent else _OPTS)
+
+    def dumps(obj, indent=None, ensure_ascii=False, default=None):
+        return dumpb(obj, indent, default=default).decode('utf-8')
+
+elif ujson:
+    def loads(data):
+        return ujson.loads(data)
+
+    def dumps(obj, indent=None, ensure_ascii=False, default=None):
+        if default is not None:
+            return _stdlib_json.dumps(obj, indent=indent, ensure_ascii=False, default=default)
+        return ujson.dumps(obj, indent=indent or 0, ensure_ascii=False)
+
+    def dumpb(obj, indent=None, ensure_ascii=False, default=None):
+        return dumps(obj, indent, default=default).encode('utf-8')
+
+else:
+    def loads(data):
+        return _stdlib_json.loads(data)
+
+    def dumps(obj, indent=None, ensure_ascii=False, default=None):
+        return _stdlib_json.dumps(obj, indent=indent, ensure_ascii=False, default=default)
+
+    def dumpb(obj, indent=None, ensure_ascii=False, default=None):
+        return dumps(obj, indent, default=default).encode('utf-8')
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """讓 jsonify / request.json 也走 codec。遇到後端不認得的型別(Decimal、dataclass…)
+    交給 Flask 預設的轉換規則。"""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj, default=DefaultJSONProvider.default)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumpb(obj, default=DefaultJSONProvider.default), mimetype=self.mimetype)
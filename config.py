@@ -1,5 +1,5 @@
 import time
-import ujson as json
+import codec as json
 import storage
 
 # 儲存層的 key（檔案後端時即為 data/ 下的檔名，與舊版相容）
@@ -0,0 +1,79 @@
+# health_monitor.py
+#
+# 背景定期健康檢查。原本站台健康只在管理員按「立即檢查」時更新,而且逐站同步檢查,
+# 站台一多就卡住整個 gunicorn sync worker。這裡登記成 periodic 的定期工作:
+#   - 每 periodic.TICK 秒看一次哪些站台到期,到期的用小型執行緒池並行探測(site_manager.probe_site);
+#   - 檢查間隔 health_check_interval(預設 10 分鐘),加 ±_JITTER 的隨機抖動,避免所有站同一秒被打;
+#   - 連續失敗的站台間隔加倍退避(2^連續錯誤數),最多到 health_check_max_interval;
+#   - 每一輪的結果用 site_manager.apply_check_results 一次寫回 sites.json,探測本身也會回報熔斷器;
+#     探測只跑在持有租約的 worker,其他 worker 的熔斷器看不到,所以搜尋前會用
+#     circuit_breaker.adopt_check 把 sites.json 裡較新的檢查結果套進自己的熔斷器。
+#
+# 多 worker 與 serverless 的處理(租約、KV / Vercel 不啟動)都在 periodic;
+# config.json 的 health_monitor 設 false 也可關閉。
+
+import time
+import random
+import concurrent.futures
+from datetime import datetime
+import periodic
+from config import get_config_value
+from site_manager import get_sites, probe_site, apply_check_results
+from logger_config import setup_logger
+
+DEFAULT_INTERVAL = 600       # 秒
+DEFAULT_MAX_INTERVAL = 3600  # 失敗退避的上限
+DEFAULT_CONCURRENCY = 8
+_JITTER = 0.1                # 間隔 ±10%
+
+logger = setup_logger()
+_jitter = {}  # site_id -> 本輪的抖動係數(檢查完重抽)
+
+
+def _interval_for(site):
+    base = get_config_value('health_check_interval', DEFAULT_INTERVAL)
+    upper = max(base, get_config_value('health_check_max_interval', DEFAULT_MAX_INTERVAL))
+    errors = min(site.get('consecutive_errors', 0), 10)
+    return min(base * (2 ** errors), upper) * _jitter.setdefault(site['id'], 1 + random.uniform(-_JITTER, _JITTER))
+
+
+def _last_check(site):
+    try:
+        return datetime.fromisoformat(site['last_check']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+def due_sites(now=None):
+    now = now or time.time()
+    return [s for s in get_sites()
+            if s.get('enabled', True) and now - _last_check(s) >= _interval_for(s)]
+
+
+def run_round():
+    """檢查一輪到期的站台,回傳檢查了幾個。"""
+    sites = due_sites()
+    if not sites:
+        return 0
+    workers = max(1, min(get_config_value('health_check_concurrency', DEFAULT_CONCURRENCY), len(sites)))
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='health-check') as pool:
+        futures = {pool.submit(probe_site, site): site for site in sites}
+        for future in concurrent.futures.as_completed(futures):
+            site = futures[future]
+            try:
+                ok, message, elapsed = future.result()
+            except Exception as e:
+                ok, message, elapsed = False, str(e), 0.0
+            results[site['id']] = (ok, elapsed)
+            _jitter.pop(site['id'], None)
+            if not ok:
+                logger.warning(f"背景檢查失敗: {site['name']} ({site['url']}) - {message}")
+    apply_check_results(results)
+    healthy = sum(1 for ok, _ in results.values() if ok)
+    logger.info(f"背景健康檢查完成: {healthy}/{len(results)} 個站點正常")
+    return len(results)
+
+
+periodic.register('health_monitor', run_round, periodic.TICK,
+                  enabled=lambda: bool(get_config_value('health_monitor', True)))
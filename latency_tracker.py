@@ -0,0 +1,100 @@
+# latency_tracker.py
+#
+# 每個站台最近 N 次上游請求的耗時,用來替「這一次」請求算逾時:
+#   timeout = clamp(p95 × timeout_factor, timeout_min, timeout_max)
+# 取代原本所有站台共用同一個 request_timeout:快的站不必白等 5 秒才判死,
+# 慢但穩定會回的站也不會被一刀切掉。樣本不足(剛啟動 / 新站)時沿用全域 request_timeout。
+# 上限預設就是全域 request_timeout:自適應只會把快站的逾時縮短,不會替任何站台放寬到比原本還久。
+# 逾時的請求是「設限截斷」的樣本(只知道至少這麼久),不進百分位數,否則一再逾時的站台 p95 會被墊高、
+# 下一次給更久的時間,死站反而拖住整個搜尋;只另外計數給設定頁看。
+#
+# 可選的 hedged request:尾端延遲很不穩(p99 遠大於 p50)的站台,在等了 p90 還沒回應時
+# 再送一個相同請求,兩個誰先回用誰(只在 async_client 的多站搜尋裡用,由 hedge_requests 開關)。
+#
+# config.json 可調:adaptive_timeout(預設開)、timeout_factor、timeout_min、timeout_max、hedge_requests。
+# 數據只存在程序記憶體,重啟後重新累積。
+
+import threading
+from collections import deque
+from config import get_config_value, get_timeout_config
+
+_WINDOW = 50        # 每站保留最近幾筆
+_MIN_SAMPLES = 10   # 少於這個數量不調整逾時
+_HEDGE_RATIO = 3.0  # p99 / p50 超過這個倍數才算「尾端不穩」
+
+DEFAULT_FACTOR = 2.0
+DEFAULT_MIN = 2.0
+
+_lock = threading.Lock()
+_samples = {}   # clean_base_url -> deque[秒]
+_timeouts = {}  # clean_base_url -> 逾時次數
+
+
+def observe(clean_base_url, seconds):
+    with _lock:
+        window = _samples.get(clean_base_url)
+        if window is None:
+            window = _samples[clean_base_url] = deque(maxlen=_WINDOW)
+        window.append(seconds)
+
+
+def observe_timeout(clean_base_url):
+    """記一次逾時(不進百分位數,見檔頭說明)。"""
+    with _lock:
+        _timeouts[clean_base_url] = _timeouts.get(clean_base_url, 0) + 1
+
+
+def _percentiles(clean_base_url, *qs):
+    with _lock:
+        window = _samples.get(clean_base_url)
+        if not window or len(window) < _MIN_SAMPLES:
+            return None
+        ordered = sorted(window)
+    last = len(ordered) - 1
+    return [ordered[min(last, int(round(q * last)))] for q in qs]
+
+
+def timeout_for(clean_base_url):
+    """這個站台這次請求該給的逾時秒數。"""
+    base = get_timeout_config()
+    if not get_config_value('adaptive_timeout', True):
+        return base
+    p = _percentiles(clean_base_url, 0.95)
+    if p is None:
+        return base
+    factor = get_config_value('timeout_factor', DEFAULT_FACTOR)
+    lower = get_config_value('timeout_min', DEFAULT_MIN)
+    upper = min(get_config_value('timeout_max', base), base)
+    return round(min(max(p[0] * factor, lower), upper), 2)
+
+
+def hedge_delay(clean_base_url):
+    """要對這個站台發 hedged request 的話,等多久(秒)再送第二個;不需要 hedge 回 None。"""
+    if not get_config_value('hedge_requests', False):
+        return None
+    p = _percentiles(clean_base_url, 0.5, 0.9, 0.99)
+    if p is None:
+        return None
+    p50, p90, p99 = p
+    if p50 <= 0 or p99 / p50 < _HEDGE_RATIO:
+        return None
+    # 慢的請求多到 p90 本身就落在尾端時,等到 p90 再補送也救不回來
+    if p90 * 2 > p99:
+        return None
+    return p90
+
+
+def snapshot(clean_base_url):
+    """給監控 / 設定頁看的延遲摘要(秒)。"""
+    p = _percentiles(clean_base_url, 0.5, 0.95, 0.99)
+    with _lock:
+        count = len(_samples.get(clean_base_url, ()))
+        timeouts = _timeouts.get(clean_base_url, 0)
+    return {
+        'samples': count,
+        'timeouts': timeouts,
+        'p50': round(p[0], 3) if p else None,
+        'p95': round(p[1], 3) if p else None,
+        'p99': round(p[2], 3) if p else None,
+        'timeout': timeout_for(clean_base_url),
+    }
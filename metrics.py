@@ -0,0 +1,145 @@
+# metrics.py
+#
+# 程序內的計數器 / 直方圖,給 /api/metrics 以 Prometheus text 格式輸出。
+# 原本想知道哪個站慢、哪個站壞只能翻 logger 的彩色日誌;這裡把每一次上游請求
+# (依站台 × 種類 list / search / detail / health)的次數、結果與耗時記下來,
+# 再加上快取命中率、背景工作池排隊數、儲存層(檔案 / KV)呼叫耗時與 update_text 等鎖時間。
+#
+# 數據只在本程序記憶體,gunicorn 每個 worker 各一份(抓取時打到哪個 worker 就是哪份),
+# 指標都帶 pid 標籤可區分;重啟歸零,符合 Prometheus counter 的語意。
+# 這個模組不 import 其他專案模組(storage 也會呼叫它),避免循環 import。
+
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# 直方圖分桶(秒):上游請求 / 儲存層呼叫共用,涵蓋本機檔案的毫秒級到上游逾時的十幾秒
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+
+_PREFIX = 'maccms_'
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> float
+_histograms = {}  # (name, labels) -> [各桶計數..., sum, count]
+_help = {}        # name -> (type, 說明)
+_collectors = []  # 抓取時才呼叫的 gauge 來源:fn() -> [(name, labels dict, value)]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def describe(name, kind, text):
+    _help[name] = (kind, text)
+
+
+def inc(name, value=1, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(_BUCKETS) + 2)
+        index = bisect.bisect_left(_BUCKETS, seconds)
+        if index < len(_BUCKETS):  # 超過最大桶的只算進 +Inf(即 count)
+            h[index] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """with metrics.timer('storage_seconds', op='get'): ... 把區塊耗時記進直方圖。"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
+
+def register_collector(fn):
+    """登記一個抓取時才取值的 gauge 來源(快取大小、排隊數等不必每次變動都記)。"""
+    _collectors.append(fn)
+
+
+def upstream(site, kind, outcome, seconds=None):
+    """記一次上游請求:site 用 clean_base_url,kind 為 list / search / detail / health,
+    outcome 為 ok / http_error / invalid / too_large / timeout / error。"""
+    inc('upstream_requests_total', site=site, kind=kind, outcome=outcome)
+    if seconds is not None:
+        observe('upstream_request_seconds', seconds, site=site, kind=kind)
+
+
+describe('upstream_requests_total', 'counter', 'Upstream HTTP requests by site, kind and outcome.')
+describe('upstream_request_seconds', 'histogram', 'Upstream HTTP request latency in seconds.')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    """輸出 Prometheus text exposition format(0.0.4)。"""
+    pid = ('pid', str(os.getpid()))
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+
+    gauges = {}
+    for fn in list(_collectors):
+        try:
+            for name, labels, value in fn():
+                gauges[(name, _labels(labels))] = value
+        except Exception:
+            continue  # 某個來源壞掉不該讓整個 /metrics 失敗
+
+    lines = []
+    seen = set()
+
+    def header(name, default_kind):
+        if name in seen:
+            return
+        seen.add(name)
+        kind, text = _help.get(name, (default_kind, name))
+        lines.append(f'# HELP {_PREFIX}{name} {text}')
+        lines.append(f'# TYPE {_PREFIX}{name} {kind}')
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, 'counter')
+        lines.append(f'{_PREFIX}{name}{_format_labels(labels, (pid,))} {_number(value)}')
+
+    for (name, labels), value in sorted(gauges.items()):
+        header(name, 'gauge')
+        lines.append(f'{_PREFIX}{name}{_format_labels(labels, (pid,))} {_number(value)}')
+
+    for (name, labels), h in sorted(histograms.items()):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(_BUCKETS, h):
+            cumulative += count
+            lines.append(f'{_PREFIX}{name}_bucket{_format_labels(labels, (pid, ("le", _number(bound))))} {cumulative}')
+        lines.append(f'{_PREFIX}{name}_bucket{_format_labels(labels, (pid, ("le", "+Inf")))} {h[-1]}')
+        lines.append(f'{_PREFIX}{name}_sum{_format_labels(labels, (pid,))} {round(h[-2], 6)}')
+        lines.append(f'{_PREFIX}{name}_count{_format_labels(labels, (pid,))} {h[-1]}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,112 @@
+# periodic.py
+#
+# 程序內的定期工作排程。背景健康檢查原本自己帶一條執行緒與跨 worker 租約,
+# 之後的更新偵測等定期工作也要同一套,所以抽出來共用:
+#   - 每個 worker 一條排程執行緒(gunicorn --preload 時執行緒不會跟著 fork,掛在 before_request 上延後啟動);
+#   - 各工作用 register(name, fn, every) 登記,every 可以是秒數或回傳秒數的函式(間隔可在 config.json 改);
+#   - 到期時先搶該工作的 storage 租約('<name>_lease.json'),只有持有者會執行,
+#     持有者每次執行都續約,超過 3 個間隔沒續約視為掛了,其他 worker 接手;
+#     登記時給 leased=False 的工作不搶租約,每個 worker 都跑(處理各自程序內的狀態);
+#   - 工作依序在排程執行緒裡跑,單一工作出錯只記 log,不影響其他工作。
+# serverless(KV 後端 / Vercel)沒有常駐程序,整個不啟動。
+
+import os
+import time
+import random
+import secrets
+import threading
+import codec as json
+import storage
+from logger_config import setup_logger
+
+TICK = 30  # 排程器多久醒來看一次;要「每輪都看一下」的工作直接拿它當 every
+
+logger = setup_logger()
+_lock = threading.Lock()
+_thread = None
+_thread_pid = None
+_owner = secrets.token_hex(8)
+_jobs = []  # [{'name', 'fn', 'every', 'enabled', 'next_at'}]
+
+
+def enabled():
+    return not (storage.USE_KV or os.environ.get('VERCEL'))
+
+
+def register(name, fn, every, enabled=None, leased=True):
+    """登記一個定期工作。enabled 是回傳 bool 的函式(讀 config 開關用),每次到期時才判斷。
+    leased=False 的工作不搶租約,每個 worker 各自執行(例如把本程序記憶體裡的東西落盤)。"""
+    _jobs.append({'name': name, 'fn': fn, 'every': every, 'leased': leased,
+                  'enabled': enabled or (lambda: True), 'next_at': 0.0})
+
+
+def _interval(job):
+    every = job['every']
+    return float(every() if callable(every) else every)
+
+
+def ensure_started():
+    """第一次被呼叫時(每個 worker 各一次)啟動排程執行緒;掛在 before_request,開銷只是一次比較。"""
+    global _thread, _thread_pid
+    if _thread_pid == os.getpid() and _thread is not None:
+        return
+    with _lock:
+        if _thread_pid == os.getpid() and _thread is not None:
+            return
+        _thread_pid = os.getpid()
+        if not enabled() or not _jobs:
+            _thread = False  # 標記已判斷過,不再重試
+            return
+        _thread = threading.Thread(target=_run, name='periodic', daemon=True)
+        _thread.start()
+        logger.info(f"背景排程已啟動: {', '.join(job['name'] for job in _jobs)}")
+
+
+def acquire_lease(name, ttl):
+    """拿到(或續約)跨 worker 的租約才執行。檔案鎖只在程序內,兩個 worker 剛好同時搶到時
+    最多重複執行一輪,寫回後再讀一次確認持有者,之後就只剩一個。"""
+    key = f'{name}_lease.json'
+    now = time.time()
+    owner = f'{os.getpid()}:{_owner}'
+
+    def _claim(raw):
+        try:
+            lease = json.loads(raw) if raw else {}
+        except ValueError:
+            lease = {}
+        if lease.get('owner') in (None, owner) or lease.get('expires_at', 0) < now:
+            lease = {'owner': owner, 'expires_at': now + ttl}
+        return json.dumps(lease)
+
+    try:
+        storage.update_text(key, _claim)
+        return json.loads(storage.get_text(key) or '{}').get('owner') == owner
+    except Exception as e:
+        logger.warning(f"取得 {name} 租約失敗: {e}")
+        return False
+
+
+def run_due(now=None):
+    """執行所有到期的工作,回傳實際執行了哪些。"""
+    now = now or time.time()
+    ran = []
+    for job in _jobs:
+        if now < job['next_at']:
+            continue
+        try:
+            interval = _interval(job)
+            job['next_at'] = now + interval
+            if job['enabled']() and (not job['leased'] or acquire_lease(job['name'], max(interval, TICK) * 3)):
+                job['fn']()
+                ran.append(job['name'])
+        except Exception as e:
+            logger.error(f"背景工作 {job['name']} 出錯: {e}", exc_info=True)
+    return ran
+
+
+def _run():
+    # 啟動時先錯開一點,兩個 worker 不要同一刻搶租約
+    time.sleep(random.uniform(1, 5))
+    while True:
+        run_due()
+        time.sleep(TICK)
@@ -0,0 +1,153 @@
+# poster_index.py
+#
+# 每個站台一份「vod_id → 海報絕對網址」索引,持久化在 storage(Docker 檔案 / Vercel KV)。
+# process_api_request 原本每頁都要再打一次 ac=videolist&ids=... 只為了拿可靠的 vod_pic;
+# 有了索引後只需替「還沒見過的 id」補圖,整頁都認得時第二次請求直接省掉。
+#
+# 寫入採 write-behind:新圖先進記憶體,由 periodic 每 _FLUSH_INTERVAL 秒(每個 worker 各自,不搶租約)
+# 呼叫 sync_all 落盤:用 storage.update_text 跟其他 worker / 實例寫進去的內容合併,不會互蓋,
+# 合併後的結果也讀回記憶體,另一個 worker 學到的圖這邊也看得到;沒有新圖的站台只重新讀一次。
+# serverless 沒有排程執行緒,remember 時距上次落盤超過間隔就順手排一次背景落盤。
+# 每站最多留 _MAX_PER_SITE 筆(dict 保留插入順序,超過就丟最舊的)。
+
+import time
+import hashlib
+import threading
+import codec as json
+import storage
+import background
+import periodic
+from logger_config import setup_logger
+
+_MAX_PER_SITE = 5000
+_FLUSH_INTERVAL = 60  # 秒
+
+logger = setup_logger()
+_lock = threading.Lock()
+_sites = {}  # clean_base_url -> {'pics': dict, 'dirty': set, 'flushed_at': float(上次跟 storage 同步的時間)}
+
+
+def _storage_key(clean_base_url):
+    digest = hashlib.sha1(clean_base_url.encode('utf-8')).hexdigest()[:16]
+    return f'posters_{digest}.json'
+
+
+def _parse(raw):
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+        return data if isinstance(data, dict) else {}
+    except ValueError:
+        return {}
+
+
+def _trim(pics):
+    overflow = len(pics) - _MAX_PER_SITE
+    if overflow > 0:
+        for key in list(pics)[:overflow]:
+            del pics[key]
+    return pics
+
+
+def _entry(clean_base_url):
+    """取得(必要時從 storage 載入)某站的索引;回傳的 entry 要持 _lock 才能讀寫。
+    呼叫端不可持 _lock:第一次載入可能是一次 KV 網路請求,不能在鎖裡等,
+    否則所有站台的查詢(包括 async_client 的 event loop)都會跟著卡住。"""
+    with _lock:
+        entry = _sites.get(clean_base_url)
+    if entry is not None:
+        return entry
+    try:
+        pics = _parse(storage.get_text(_storage_key(clean_base_url)))
+    except Exception as e:
+        logger.warning(f"讀取海報索引失敗 ({clean_base_url}): {e}")
+        pics = {}
+    with _lock:
+        # 等待讀取期間別的呼叫端可能已經載入(甚至寫入新圖),以先放進去的為準
+        return _sites.setdefault(clean_base_url, {'pics': pics, 'dirty': set(), 'flushed_at': time.time()})
+
+
+def lookup(clean_base_url, vod_ids):
+    """回傳 {vod_id 字串: 海報網址},只含索引裡已有的 id。"""
+    entry = _entry(clean_base_url)
+    with _lock:
+        pics = entry['pics']
+        return {vid: pics[vid] for vid in vod_ids if vid in pics}
+
+
+def remember(clean_base_url, new_pics):
+    """記下新拿到的海報(空字串不記,下次還有機會補到);落盤由 sync_all 定期處理。"""
+    new_pics = {str(k): v for k, v in new_pics.items() if v}
+    if not new_pics:
+        return
+    entry = _entry(clean_base_url)
+    with _lock:
+        for vid, pic in new_pics.items():
+            if entry['pics'].get(vid) != pic:
+                entry['pics'].pop(vid, None)
+                entry['pics'][vid] = pic
+                entry['dirty'].add(vid)
+        _trim(entry['pics'])
+        due = entry['dirty'] and time.time() - entry['flushed_at'] >= _FLUSH_INTERVAL
+    if due and not periodic.enabled():
+        # 有排程執行緒時交給 sync_all;serverless 才在這裡排。
+        # 落盤可能是一次 KV 網路請求,丟到背景執行,不拖慢當前回應(也不卡 async_client 的 event loop)
+        background.submit(('poster_flush', clean_base_url), flush, clean_base_url)
+
+
+def _adopt(entry, stored):
+    """持 _lock 呼叫:以 storage 的內容為底,疊上還沒寫進去的新圖,取代記憶體裡的索引。"""
+    pics = dict(stored)
+    for vid in entry['dirty']:
+        if vid in entry['pics']:
+            pics.pop(vid, None)
+            pics[vid] = entry['pics'][vid]
+    entry['pics'] = _trim(pics)
+
+
+def flush(clean_base_url):
+    """把記憶體裡的新海報合併寫回 storage,並把合併後(含其他 worker 寫入)的索引讀回記憶體。"""
+    with _lock:
+        entry = _sites.get(clean_base_url)
+        if not entry:
+            return
+        pending = {vid: entry['pics'][vid] for vid in entry['dirty'] if vid in entry['pics']}
+        # 寫失敗也要等下個間隔才重試;dirty 等寫成功才清
+        entry['flushed_at'] = time.time()
+
+    stored = {}
+
+    def _merge(raw):
+        merged = _parse(raw)
+        for vid, pic in pending.items():
+            merged.pop(vid, None)
+            merged[vid] = pic
+        stored.update(_trim(merged))
+        return json.dumps(stored, ensure_ascii=False)
+
+    try:
+        if pending:
+            storage.update_text(_storage_key(clean_base_url), _merge)
+        else:
+            stored.update(_parse(storage.get_text(_storage_key(clean_base_url))))
+    except Exception as e:
+        # 寫不進去的留在 dirty,下次落盤再試;不影響這次回應
+        logger.warning(f"保存海報索引失敗 ({clean_base_url}): {e}")
+        return
+    with _lock:
+        # 寫入期間又被改過(換了新圖)的留著,下次再寫;被 _trim 丟掉的也一併清掉
+        entry['dirty'] = {vid for vid in entry['dirty']
+                          if vid in entry['pics'] and pending.get(vid) != entry['pics'][vid]}
+        _adopt(entry, stored)
+
+
+def sync_all():
+    """periodic 定期呼叫:每個已載入的站台各落盤 / 重新讀取一次。"""
+    with _lock:
+        urls = list(_sites)
+    for url in urls:
+        flush(url)
+
+
+periodic.register('poster_index', sync_all, _FLUSH_INTERVAL, leased=False)
@@ -0,0 +1,138 @@
+# prefetch.py
+#
+# 推測性預抓:使用者照順序翻頁時,第 N 頁送出後就先把第 N+1 頁(列表 + ac=videolist 補圖)
+# 抓進 response_cache,下一次點「下一頁」直接命中快取。/api/list 與合併分頁搜尋共用。
+# 預抓是多打上游的額外流量,所以有幾道閘門:
+#   - 每站每分鐘最多 prefetch_site_budget 次(預設 12),一站被狂翻也不會變成對它的壓測;
+#   - response_cache 用量超過上限的 prefetch_max_cache_ratio(預設 0.8)就不排,
+#     已排入但還沒開始的預抓在真正送出前會再看一次,壓力上來就取消,不去擠掉別人正在用的快取;
+#   - 同一頁已在快取(新鮮或背景刷新中)或已在排隊就略過;
+#   - serverless 沒有常駐程序,回應送出後的背景工作不一定跑得完,整個不啟用;
+#     config.json 的 prefetch 設 false 可關閉。
+# 有 aiohttp 時丟 async_client 的共用 event loop,否則走 background 的小執行緒池。
+
+import time
+import asyncio
+import threading
+from collections import deque
+import async_client
+import background
+import metrics
+import periodic
+import response_cache
+from config import get_config_value
+from api_parser import refresh_list, normalize_base_url
+from logger_config import setup_logger
+
+DEFAULT_SITE_BUDGET = 12        # 每站每分鐘最多預抓幾頁
+DEFAULT_MAX_CACHE_RATIO = 0.8   # response_cache 用量超過這個比例就不預抓
+_WINDOW = 60  # 秒
+
+logger = setup_logger()
+_lock = threading.Lock()
+_recent = {}       # 站台 clean url -> deque[送出時間]
+_inflight = set()  # response_cache.cache_key
+
+
+def enabled():
+    return periodic.enabled() and bool(get_config_value('prefetch', True))
+
+
+def _under_pressure():
+    return response_cache.response_cache.fill_ratio() >= get_config_value('prefetch_max_cache_ratio',
+                                                                          DEFAULT_MAX_CACHE_RATIO)
+
+
+def _take_budget(clean_url):
+    """滑動視窗:這站最近一分鐘的預抓次數還沒到上限就記一筆並回 True。"""
+    now = time.monotonic()
+    budget = get_config_value('prefetch_site_budget', DEFAULT_SITE_BUDGET)
+    with _lock:
+        recent = _recent.setdefault(clean_url, deque())
+        while recent and recent[0] <= now - _WINDOW:
+            recent.popleft()
+        if len(recent) >= budget:
+            return False
+        recent.append(now)
+        return True
+
+
+def _should_run(clean_url, params):
+    """真正送出前再確認一次:期間別人已經抓過、或快取壓力上來了就取消。"""
+    if _under_pressure():
+        metrics.inc('prefetch_total', outcome='cancelled')
+        return False
+    return response_cache.state_of(clean_url, params) not in ('fresh', 'stale')
+
+
+def _run(key, base_url, params, ssl_verify, site_name):
+    try:
+        if _should_run(key[0], params):
+            refresh_list(key[0], params, logger, ssl_verify=ssl_verify, site_name=site_name)
+    finally:
+        with _lock:
+            _inflight.discard(key)
+
+
+async def _run_async(key, base_url, params, ssl_verify, site_name):
+    try:
+        # _should_run 會讀設定(可能碰 storage),不在 event loop 執行緒上跑
+        if await asyncio.get_running_loop().run_in_executor(None, _should_run, key[0], params):
+            await async_client.refresh_list_async(base_url, params, logger,
+                                                  ssl_verify=ssl_verify, site_name=site_name)
+    finally:
+        with _lock:
+            _inflight.discard(key)
+
+
+def schedule(site, params):
+    """把 site(get_sites() 的一筆)的某頁列表 / 搜尋排進背景預抓。回傳是否有排入。"""
+    if not enabled():
+        return False
+    clean_url = normalize_base_url(site['url'])
+    key = response_cache.cache_key(clean_url, params)
+    if response_cache.state_of(clean_url, params) in ('fresh', 'stale'):
+        return False
+    with _lock:
+        if key in _inflight:
+            return False
+    if _under_pressure():
+        metrics.inc('prefetch_total', outcome='skipped_pressure')
+        return False
+    if not _take_budget(clean_url):
+        metrics.inc('prefetch_total', outcome='skipped_budget')
+        return False
+    with _lock:
+        _inflight.add(key)
+    metrics.inc('prefetch_total', outcome='scheduled')
+    args = (key, site['url'], dict(params), site.get('ssl_verify', True), site['name'])
+    try:
+        if async_client.is_available():
+            async_client.submit(_run_async(*args))
+        elif not background.submit(('prefetch',) + key, _run, *args):
+            with _lock:
+                _inflight.discard(key)
+            return False
+    except RuntimeError as e:
+        logger.warning(f"預抓排入失敗: {e}")
+        with _lock:
+            _inflight.discard(key)
+        return False
+    return True
+
+
+def next_page(site, params, result):
+    """列表第 N 頁成功送出後呼叫:還有下一頁就預抓第 N+1 頁。"""
+    if result.get('status') != 'success' or result.get('stale'):
+        return False
+    try:
+        page = int(params.get('pg') or 1)
+        page_count = int(result.get('pagecount') or 0)
+    except (TypeError, ValueError):
+        return False
+    if page >= page_count:
+        return False
+    return schedule(site, dict(params, pg=page + 1))
+
+
+metrics.describe('prefetch_total', 'counter', 'Speculative next-page prefetches by outcome.')
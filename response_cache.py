@@ -0,0 +1,253 @@
+# response_cache.py
+#
+# 上游回應的程序內快取。瀏覽 / 搜尋每次都要打上游兩次(列表 + ac=videolist 補圖),
+# 同一頁常常幾秒內被不同會員重複點開 → 以 (站台網址, 正規化參數) 為 key 快取成功的結果。
+#   - 依種類(瀏覽 / 搜尋 / 分類)各自的 TTL,可在 config.json 的 cache_ttl 覆寫;
+#   - 以位元組計的硬上限(cache_max_mb),超過就從最久沒用的開始丟(LRU);
+#   - 命中 / 未命中 / 淘汰次數計數,給健康檢查與監控看;
+#   - 瀏覽 / 分類頁過期後先回舊資料並背景刷新,上游出錯時在保留期內用舊資料墊(標 stale: true)。
+# 跟 config / site_manager 的短快取一樣存「原始 JSON 文字」,取出時 loads 出新物件,
+# 呼叫端(例如 multi_site_search 會在影片上加 from_site)可以安全地原地修改。
+#
+# 另有一個「單片詳情」快取 detail_cache,key 是 (站台網址, vod_id),存已拆好線路 / 集數的結果。
+# /api/details、歷史更新檢查、以及列表補圖時順便拿到的 ac=videolist 回應都讀寫同一份,
+# 所以瀏覽完列表馬上點開影片,不必再打一次上游。
+
+import time
+import threading
+from collections import OrderedDict
+import codec as json
+from config import get_config_value
+import metrics
+
+DEFAULT_TTLS = {
+    'browse': 120,    # 不帶分類的最新列表,站台更新頻繁,放短一點
+    'category': 300,
+    'search': 180,
+}
+DEFAULT_MAX_MB = 16
+# 瀏覽 / 分類頁過期後:DEFAULT_SWR 秒內先回舊資料再背景刷新;DEFAULT_MAX_STALE 秒內上游出錯時拿舊資料墊
+# (分別可用 config.json 的 cache_stale_while_revalidate / cache_max_stale 覆寫)。搜尋不套用。
+_STALE_KINDS = ('browse', 'category')
+DEFAULT_SWR = 600
+DEFAULT_MAX_STALE = 6 * 60 * 60
+DEFAULT_DETAIL_TTL = 600
+DEFAULT_DETAIL_MAX_MB = 8
+
+
+class LRUCache:
+    """有 TTL 與總位元組上限的 LRU。值一律是字串,大小以字元數估算。
+
+    put 時可另給 keep 秒:過了 TTL 之後仍保留這麼久,供 peek 取「過期但還能用」的舊資料
+    (stale-while-revalidate / stale-if-error);get 只回新鮮的。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (raw, expires_at, keep_until)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def peek(self, key):
+        """回傳 (raw, expires_at);不存在或已超過保留期回 None。"""
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[2] <= now:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            if entry[1] > now:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+            return entry[0], entry[1]
+
+    def expires_at(self, key):
+        """只看不取:回傳 expires_at,不存在或已超過保留期回 None。不計命中 / 未命中、不更新 LRU 順序
+        (預抓判斷「要不要抓」用,不能算成有人讀過,也不能讓沒人要的項目續命)。"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[2] <= time.time():
+                return None
+            return entry[1]
+
+    def get(self, key):
+        entry = self.peek(key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def put(self, key, raw, ttl, keep=0):
+        size = len(raw)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        expires_at = time.time() + ttl
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (raw, expires_at, expires_at + max(keep, 0))
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._data:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        raw = self._data.pop(key)[0]
+        self._bytes -= len(raw)
+
+    def fill_ratio(self):
+        """目前用量佔上限的比例(預抓判斷快取壓力用)。"""
+        with self._lock:
+            return self._bytes / self.max_bytes if self.max_bytes else 1.0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.stale_hits + self.misses
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.stale_hits) / total, 3) if total else 0.0,
+            }
+
+
+response_cache = LRUCache(int(get_config_value('cache_max_mb', DEFAULT_MAX_MB)) * 1024 * 1024)
+detail_cache = LRUCache(int(get_config_value('detail_cache_max_mb', DEFAULT_DETAIL_MAX_MB)) * 1024 * 1024)
+
+
+def _collect_metrics():
+    samples = []
+    for name, cache in (('response', response_cache), ('detail', detail_cache)):
+        st = cache.stats()
+        samples += [
+            ('cache_hits_total', {'cache': name, 'result': 'fresh'}, st['hits']),
+            ('cache_hits_total', {'cache': name, 'result': 'stale'}, st['stale_hits']),
+            ('cache_misses_total', {'cache': name}, st['misses']),
+            ('cache_evictions_total', {'cache': name}, st['evictions']),
+            ('cache_hit_ratio', {'cache': name}, st['hit_rate']),
+            ('cache_entries', {'cache': name}, st['entries']),
+            ('cache_bytes', {'cache': name}, st['bytes']),
+            ('cache_max_bytes', {'cache': name}, st['max_bytes']),
+        ]
+    return samples
+
+
+metrics.describe('cache_hits_total', 'counter', 'Cache hits (fresh or stale).')
+metrics.describe('cache_misses_total', 'counter', 'Cache misses.')
+metrics.describe('cache_evictions_total', 'counter', 'Entries evicted to stay under the byte cap.')
+metrics.describe('cache_hit_ratio', 'gauge', 'Hits (fresh + stale) over all lookups since start.')
+metrics.describe('cache_entries', 'gauge', 'Entries currently cached.')
+metrics.describe('cache_bytes', 'gauge', 'Approximate size of cached entries.')
+metrics.describe('cache_max_bytes', 'gauge', 'Configured byte cap.')
+metrics.register_collector(_collect_metrics)
+
+
+def request_kind(params):
+    """搜尋(帶 wd)/ 分類(帶 t)/ 瀏覽。"""
+    if params.get('wd'):
+        return 'search'
+    if params.get('t'):
+        return 'category'
+    return 'browse'
+
+
+def _ttl_for(kind):
+    ttls = get_config_value('cache_ttl', {})
+    if isinstance(ttls, dict) and kind in ttls:
+        return ttls[kind]
+    return DEFAULT_TTLS[kind]
+
+
+def cache_key(clean_base_url, params):
+    """空值參數不算、頁碼缺省視為 1,讓 {pg: 1} 與 {} 命中同一筆。"""
+    normalized = {k: str(v) for k, v in params.items() if v not in (None, '')}
+    normalized.setdefault('pg', '1')
+    return (clean_base_url, tuple(sorted(normalized.items())))
+
+
+def lookup_response(clean_base_url, params):
+    """回傳 (結果, 狀態)。狀態:
+      'fresh'   TTL 內,直接用;
+      'stale'   過期不久(瀏覽 / 分類才有),先回舊資料、背景刷新(stale-while-revalidate);
+      'expired' 過期較久但還在保留期內,只在上游失敗時拿來墊(stale-if-error);
+      'miss'    沒有。
+    """
+    entry = response_cache.peek(cache_key(clean_base_url, params))
+    if entry is None:
+        return None, 'miss'
+    raw, expires_at = entry
+    state = _state_for(params, expires_at)
+    if state == 'miss':
+        return None, state
+    return json.loads(raw), state
+
+
+def state_of(clean_base_url, params):
+    """同 lookup_response 的狀態,但不取值、不計入命中率、不更新 LRU 順序(預抓用)。"""
+    expires_at = response_cache.expires_at(cache_key(clean_base_url, params))
+    return 'miss' if expires_at is None else _state_for(params, expires_at)
+
+
+def _state_for(params, expires_at):
+    age_past_expiry = time.time() - expires_at
+    if age_past_expiry < 0:
+        return 'fresh'
+    if request_kind(params) not in _STALE_KINDS:
+        return 'miss'
+    if age_past_expiry < get_config_value('cache_stale_while_revalidate', DEFAULT_SWR):
+        return 'stale'
+    return 'expired'
+
+
+def get_response(clean_base_url, params):
+    result, state = lookup_response(clean_base_url, params)
+    return result if state == 'fresh' else None
+
+
+def put_response(clean_base_url, params, result):
+    """只快取成功的結果;錯誤(逾時、站台掛了)不能被記住,否則會把暫時性失敗放大。"""
+    if result.get('status') != 'success':
+        return
+    kind = request_kind(params)
+    keep = get_config_value('cache_max_stale', DEFAULT_MAX_STALE) if kind in _STALE_KINDS else 0
+    response_cache.put(cache_key(clean_base_url, params),
+                       json.dumps(result, ensure_ascii=False),
+                       _ttl_for(kind), keep)
+
+
+def get_detail(clean_base_url, vod_id):
+    raw = detail_cache.get((clean_base_url, str(vod_id)))
+    return json.loads(raw) if raw is not None else None
+
+
+def put_detail(clean_base_url, vod_id, detail):
+    """detail 是 api_parser.parse_detail_item 拆好的精簡結果(vod_name / vod_pic / sources)。"""
+    detail_cache.put((clean_base_url, str(vod_id)),
+                     json.dumps(detail, ensure_ascii=False),
+                     get_config_value('detail_cache_ttl', DEFAULT_DETAIL_TTL))
+
+
+def drop_detail(clean_base_url, vod_id):
+    """已知上游更新過的影片(更新偵測看到 vod_time 變了),丟掉舊詳情,下次一定重新抓。"""
+    detail_cache.discard((clean_base_url, str(vod_id)))
@@ -0,0 +1,207 @@
+# search_results.py
+#
+# 多站搜尋結果的後處理。同一部片常常十幾個站都有,multi_site_search 原本直接把各站結果串起來,
+# 前端收到、畫出幾百張幾乎一樣的卡片。這裡提供:
+#   - normalize_title:片名正規化(全形 / 半形、大小寫、標點空白、繁簡、季數寫法),
+#     讓「進擊的巨人 第二季」「进击的巨人第2季」「進擊的巨人 Season 2」得到同一個 key;
+#   - group_results:依 (正規化片名, 年份) 分組,每組一個代表(優先有封面的)加上精簡的其他來源清單;
+#   - rank_results:各站結果是依完成先後接起來的(等於亂序),這裡對整批結果依關鍵字打分數後排序:
+#     片名完全相同 > 開頭相同 > 包含,再加上年份、站台可靠度(健康檢查連續失敗、熔斷、延遲)與有沒有封面。
+#
+# 繁簡轉換:有裝 opencc 就用它(完整),沒裝用內建的常見字對照表(涵蓋片名常見字,不求完整)。
+# 只用在比對 key,回給前端的片名一律是站台原本的寫法。
+
+import re
+import time
+import unicodedata
+import circuit_breaker
+import latency_tracker
+from api_parser import normalize_base_url
+
+try:
+    import opencc
+except ImportError:  # pragma: no cover - 依部署環境而定
+    opencc = None
+
+# 內建繁→簡對照(每個字串前一個字是繁體、後一個是簡體)
+_T2S_PAIRS = (
+    '這这 個个 們们 來来 說说 時时 會会 從从 後后 對对 於于 與与 為为 無无 愛爱 戀恋 夢梦 龍龙 鳳凤 '
+    '國国 華华 東东 門门 開开 關关 長长 風风 飛飞 馬马 鳥鸟 魚鱼 雲云 電电 號号 車车 軍军 戰战 鬥斗 '
+    '殺杀 劍剑 俠侠 傳传 記记 錄录 書书 學学 習习 師师 醫医 藥药 聖圣 靈灵 獸兽 異异 變变 歸归 還还 '
+    '遠远 進进 過过 運运 連连 達达 邊边 陽阳 陰阴 陸陆 隊队 際际 險险 難难 雙双 離离 萬万 歲岁 歷历 '
+    '當当 黨党 實实 寶宝 寧宁 審审 寫写 將将 專专 尋寻 導导 層层 島岛 嶺岭 帥帅 帶带 幫帮 廣广 張张 '
+    '彈弹 強强 徑径 復复 複复 戲戏 戶户 擊击 擇择 據据 敵敌 斷断 權权 條条 樂乐 標标 機机 歡欢 殘残 '
+    '氣气 沒没 沖冲 衝冲 況况 漢汉 滅灭 濤涛 灣湾 煙烟 熱热 燈灯 爺爷 牆墙 獄狱 獨独 獵猎 現现 瑪玛 '
+    '環环 產产 畫画 盜盗 盡尽 監监 眾众 碼码 確确 禮礼 禍祸 種种 稱称 穩稳 競竞 筆笔 節节 範范 築筑 '
+    '簡简 糧粮 紅红 約约 級级 紀纪 純纯 紙纸 細细 終终 組组 結结 絕绝 給给 統统 經经 綠绿 網网 緣缘 '
+    '線线 練练 縣县 總总 繼继 續续 羅罗 義义 聯联 聲声 職职 聽听 腦脑 興兴 舊旧 艦舰 藍蓝 蘭兰 處处 '
+    '蟲虫 衛卫 裝装 見见 規规 視视 親亲 覺觉 觀观 計计 訊讯 討讨 訓训 許许 話话 誘诱 誠诚 誰谁 課课 '
+    '調调 談谈 論论 諜谍 謎谜 證证 識识 護护 讀读 讓让 豐丰 貓猫 貝贝 負负 財财 貴贵 買买 費费 賊贼 '
+    '資资 賽赛 贏赢 趕赶 趙赵 跡迹 軌轨 輕轻 輪轮 轉转 辦办 農农 週周 遊游 選选 遺遗 鄉乡 鄭郑 醜丑 '
+    '針针 鐵铁 錢钱 錯错 鍋锅 鏡镜 鐘钟 閃闪 閉闭 間间 閱阅 陳陈 隱隐 雞鸡 靜静 韓韩 頁页 順顺 頭头 '
+    '題题 顏颜 願愿 類类 顯显 飯饭 館馆 驚惊 驗验 體体 髮发 發发 鬧闹 鯨鲸 鳴鸣 麗丽 麼么 黃黄 齊齐 '
+    '龜龟 偵侦 傑杰 偉伟 備备 傷伤 價价 億亿 優优 兒儿 兩两 內内 凍冻 劇剧 創创 劉刘 動动 務务 勝胜 '
+    '勞劳 勢势 區区 協协 單单 員员 問问 啟启 嚴严 團团 園园 圖图 圓圆 場场 塵尘 壞坏 壓压 壯壮 夥伙 '
+    '奪夺 奮奋 婦妇 媽妈 孫孙 寵宠 屬属 壽寿 廳厅 徵征 惡恶 態态 憶忆 應应 懸悬 擁拥 擔担 攝摄 敗败 '
+    '數数 斬斩 曉晓 極极 構构 槍枪 樓楼 歐欧 漁渔 濟济 滿满 潛潜 煉炼 爭争 牽牵 狀状 獲获 瑤瑶 畢毕 '
+    '療疗 盤盘 稅税 窮穷 籃篮 紛纷 緊紧 縱纵 織织 罰罚 聞闻 膽胆 臉脸 臨临 莊庄 葉叶 蓋盖 蕭萧 薩萨 '
+    '藝艺 蘇苏 蝦虾 補补 襲袭 評评 詩诗 語语 誤误 請请 諸诸 講讲 謝谢 譯译 豬猪 賀贺 賞赏 質质 購购 '
+    '躍跃 軒轩 較较 輩辈 辭辞 違违 遙遥 適适 鄰邻 釋释 鋒锋 錦锦 鎮镇 闖闯 陣阵 階阶 雖虽 雜杂 響响 '
+    '頂顶 項项 領领 頻频 飄飘 飲饮 養养 餘余 騎骑 騰腾 驅驱 鬱郁 魯鲁 鮮鲜 鷹鹰 麥麦 點点 齡龄 劃划 '
+    '緝缉 鋼钢 衆众 喬乔 貪贪 嬌娇 綜综 觸触 穌稣 慶庆 亞亚 楊杨 樹树 橋桥 櫻樱 溫温 湯汤 澤泽 獅狮 '
+    '瘋疯 絲丝 術术 製制 訪访 詭诡 該该 誕诞 諾诺 賭赌 軟软 載载 轟轰 邏逻 銀银 隨随 霧雾 韻韵 顧顾 '
+    '騙骗 鶴鹤 鎖锁 閣阁 輝辉 測测 爾尔 彌弥 鴨鸭 蟻蚁 麵面 鄧邓 灘滩 倫伦 偽伪 棄弃 繪绘 韋韦 燒烧 '
+    '蘿萝 廟庙 鏈链 嗎吗'
+)
+_T2S = str.maketrans({pair[0]: pair[1] for pair in _T2S_PAIRS.split()})
+
+
+def _opencc_converter():
+    if opencc is None:
+        return None
+    for config_name in ('t2s', 't2s.json'):  # 不同的 opencc 套件設定檔名寫法不同
+        try:
+            return opencc.OpenCC(config_name).convert
+        except Exception:
+            continue
+    return None
+
+
+_to_simplified = _opencc_converter() or (lambda text: text.translate(_T2S))
+
+_CN_DIGITS = {'零': 0, '〇': 0, '一': 1, '二': 2, '两': 2, '三': 3, '四': 4, '五': 5,
+              '六': 6, '七': 7, '八': 8, '九': 9}
+
+
+def _cn_number(text):
+    """「二」「十二」「二十」「二十三」這類 99 以內的中文數字 → int;阿拉伯數字直接轉。"""
+    if text.isdigit():
+        return int(text)
+    if '十' in text:
+        tens, _, ones = text.partition('十')
+        return (_CN_DIGITS.get(tens, 1) if tens else 1) * 10 + (_CN_DIGITS.get(ones, 0) if ones else 0)
+    return _CN_DIGITS.get(text, 0)
+
+
+# 季 / 部 / 期數的各種寫法 → 統一成「s<n>」;轉簡體、轉小寫之後才比對
+_SEASON_PATTERNS = (
+    re.compile(r'第\s*([0-9]+|[零〇一二两三四五六七八九十]+)\s*[季部期]'),
+    re.compile(r'season\s*([0-9]+)'),
+    re.compile(r'(?<![a-z0-9])s([0-9]{1,2})(?![0-9])'),
+)
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_title(title):
+    """片名 → 比對用的 key。"""
+    text = unicodedata.normalize('NFKC', title or '').lower()
+    text = _to_simplified(text)
+    for pattern in _SEASON_PATTERNS:
+        text = pattern.sub(lambda m: f' s{_cn_number(m.group(1))} ', text)
+    return _NON_WORD.sub('', text)
+
+
+def _year(video):
+    year = str(video.get('vod_year') or '').strip()
+    return year if year.isdigit() and year != '0' else ''
+
+
+def group_results(videos):
+    """依 (正規化片名, 年份) 分組,保留第一次出現的順序(先排序再分組,組的順序就是最佳成員的名次)。
+
+    每組回傳代表影片(原欄位,優先挑有封面的)加上:
+      alternates:其他來源 [{'site_id', 'vod_id'}](代表本身不重複列);
+      source_count:這組共幾個來源。
+    沒有年份的結果:同片名剛好只有一個有年份的組時併進去,否則自成一組。
+    """
+    groups = {}
+    for video in videos:
+        key = (normalize_title(video.get('vod_name')), _year(video))
+        groups.setdefault(key, []).append(video)
+
+    years_by_title = {}
+    for title, year in groups:
+        if year:
+            years_by_title.setdefault(title, []).append(year)
+    for (title, year) in [key for key in groups if not key[1]]:
+        years = years_by_title.get(title, [])
+        if len(years) == 1:
+            groups[(title, years[0])].extend(groups.pop((title, year)))
+
+    results = []
+    for members in groups.values():
+        representative = next((v for v in members if v.get('vod_pic')), members[0])
+        group = dict(representative)
+        group['alternates'] = [{'site_id': v.get('from_site_id'), 'vod_id': v.get('vod_id')}
+                               for v in members if v is not representative]
+        group['source_count'] = len(members)
+        results.append(group)
+    return results
+
+
+# 排序分數的權重:片名比對是主軸,其他只用來在同一級裡分先後
+_MATCH_SCORES = {'exact': 100, 'prefix': 60, 'substring': 30, 'none': 0}
+_YEAR_IN_KEYWORD = re.compile(r'(?<![0-9])((?:19|20)[0-9]{2})(?![0-9])')
+
+
+def site_reliability(site):
+    """0~1:背景健康檢查連續失敗、熔斷狀態、延遲 p50 都會往下扣。"""
+    score = 1.0 / (1 + min(site.get('consecutive_errors', 0), 10))
+    clean_url = normalize_base_url(site['url'])
+    breaker = circuit_breaker.snapshot(clean_url)
+    if breaker['state'] != circuit_breaker.CLOSED:
+        score *= 0.3
+    elif breaker['failures']:
+        score *= 0.8
+    p50 = latency_tracker.snapshot(clean_url)['p50']
+    if p50 is not None and p50 > 1.0:
+        score *= max(0.5, 1.0 / p50)
+    return score
+
+
+def _match_kind(title, keyword):
+    if not keyword:
+        return 'none'
+    if title == keyword:
+        return 'exact'
+    if title.startswith(keyword):
+        return 'prefix'
+    return 'substring' if keyword in title else 'none'
+
+
+def rank_results(videos, keyword, sites, limit=None):
+    """依關鍵字對整批結果打分數、由高到低排序(同分保留原順序),有 limit 只回前幾筆。
+    影片會加上 score 欄位;sites 是參與搜尋的站台記錄(算可靠度用)。"""
+    norm_keyword = normalize_title(keyword)
+    keyword_year = _YEAR_IN_KEYWORD.search(keyword or '')
+    keyword_year = keyword_year.group(1) if keyword_year else ''
+    if keyword_year:
+        # 關鍵字帶年份(「沙丘 2021」)時,片名比對只看年份以外的部分
+        norm_keyword = normalize_title((keyword or '').replace(keyword_year, ' '))
+    current_year = time.localtime().tm_year
+    reliability = {site['id']: site_reliability(site) for site in sites}
+    titles = {}
+
+    def score(video):
+        name = video.get('vod_name') or ''
+        if name not in titles:
+            titles[name] = normalize_title(name)
+        title = titles[name]
+        total = _MATCH_SCORES[_match_kind(title, norm_keyword)]
+        if norm_keyword and title:
+            # 同一級裡片名越接近關鍵字長度越前面(「三體」比「三體:地球往事 幕後花絮」前)
+            total += 10 * len(norm_keyword) / max(len(title), len(norm_keyword))
+        year = _year(video)
+        if keyword_year:
+            total += 20 if year == keyword_year else 0
+        elif year:
+            total += max(0, 5 - (current_year - int(year)) * 0.5)
+        total += 10 * reliability.get(video.get('from_site_id'), 0.5)
+        if video.get('vod_pic'):
+            total += 5
+        return round(total, 2)
+
+    for video in videos:
+        video['score'] = score(video)
+    ranked = sorted(videos, key=lambda v: -v['score'])
+    return ranked[:limit] if limit else ranked
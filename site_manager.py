@@ -1,9 +1,15 @@
 # site_manager.py
 
-import ujson as json
+import re
+import secrets
+import concurrent.futures
+import codec as json
 import time
 import requests
 import storage
+import metrics
+import circuit_breaker
+import background
 from datetime import datetime, timedelta, timezone
 from logger_config import setup_logger
 from config import get_timeout_config
@@ -65,50 +71,213 @@ def save_sites(sites):
         logger.error(f"保存站點資料失敗: {e}")
         raise e
 
-def check_site_health(site):
-    """檢查單一站點的健康狀態"""
+def update_sites(fn):
+    """原子地改站台清單:fn(sites) 原地修改 list,整段讀→改→寫包在 storage.update_text 的鎖內。
+
+    給背景工作(學到的站台能力、健康檢查結果等)只改幾個欄位用,不會跟使用者同時在設定頁的
+    儲存互相蓋掉對方的改動。回傳改完的清單。
+    """
+    global _sites_cache_raw, _sites_cache_at
+    updated = []
+
+    def _apply(raw):
+        try:
+            sites = json.loads(raw) if raw else []
+        except ValueError:
+            sites = []
+        fn(sites)
+        updated[:] = sites
+        return json.dumps(sites, ensure_ascii=False, indent=4)
+
+    raw = storage.update_text(SITES_KEY, _apply)
+    _sites_cache_raw = raw
+    _sites_cache_at = time.time()
+    return updated
+
+
+# 健康檢查用輕量探測:只要一筆的列表頁(pagesize=1,不認得這參數的站台也只是回一般列表),
+# 而且最多讀前 _PROBE_MAX_BYTES 就斷開 —— 判斷「是不是活著的 MacCMS JSON」不需要整包列表。
+_PROBE_PARAMS = {'ac': 'list', 'pg': 1, 'pagesize': 1}
+_PROBE_MAX_BYTES = 4096
+_PROBE_CODE_RE = re.compile(r'"code"\s*:\s*"?(-?\d+)')
+
+
+def probe_site(site, timeout_seconds=None):
+    """對站台送一次輕量探測,回傳 (是否健康, 訊息, 耗時秒數)。結果同時回報熔斷器與監控指標。"""
+    # api_parser 模組層就 import 本模組,這裡延後 import 避免循環
+    from api_parser import normalize_base_url
+    clean_url = normalize_base_url(site['url'])
+    api_url = f"{clean_url}/api.php/provide/vod/"
+    headers = {'User-Agent': 'Mozilla/5.0'}
+    timeout_seconds = timeout_seconds or get_timeout_config()
+    session = get_check_session()
+    started = time.monotonic()
     try:
-        if not site.get('enabled', True):
-            return True  # 已停用的站點不需要檢查
-        
-        url = site['url']
-        if not url.startswith('http'):
-            url = 'http://' + url
-        
-        clean_url = url.rstrip('/')
-        api_url = f"{clean_url}/api.php/provide/vod/"
-        
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        ssl_verify = site.get('ssl_verify', True)
-
-        # 使用統一的超時設定和 Session
-        timeout_seconds = get_timeout_config()
-        session = get_check_session()
-        response = session.get(api_url, headers=headers, timeout=timeout_seconds, verify=ssl_verify)
-        response.raise_for_status()
-        
-        # 檢查API回應格式
-        data = response.json()
-        if data.get('code') == 1:
-            logger.info(f"站點檢查成功: {site['name']} ({url})")
-            return True
-        else:
-            logger.warning(f"站點API回應異常: {site['name']} ({url}) - {data.get('msg', '未知錯誤')}")
-            return False
-            
+        with session.get(api_url, headers=headers, params=_PROBE_PARAMS, timeout=timeout_seconds,
+                         verify=site.get('ssl_verify', True), stream=True) as response:
+            head = response.raw.read(_PROBE_MAX_BYTES, decode_content=True) or b''
+            status = response.status_code
     except requests.exceptions.Timeout:
-        logger.error(f"站點檢查超時: {site['name']} ({url})")
-        return False
+        metrics.upstream(clean_url, 'health', 'timeout', timeout_seconds)
+        circuit_breaker.record_failure(clean_url, '逾時')
+        return False, '連線逾時', timeout_seconds
     except requests.exceptions.RequestException as e:
-        logger.error(f"站點檢查失敗: {site['name']} ({url})", exc_info=True)
-        return False
-    except Exception as e:
-        logger.error(f"站點檢查發生未知錯誤: {site['name']} ({url})", exc_info=True)
+        metrics.upstream(clean_url, 'health', 'error')
+        circuit_breaker.record_failure(clean_url, '連線失敗')
+        return False, f'連線失敗: {e.__class__.__name__}', time.monotonic() - started
+    elapsed = time.monotonic() - started
+
+    text = head.decode('utf-8', errors='ignore').lstrip('\ufeff').lstrip()
+    match = _PROBE_CODE_RE.search(text)
+    if status >= 400:
+        outcome, ok, message = 'http_error', False, f'HTTP {status}'
+    elif not text.startswith('{'):
+        outcome, ok, message = 'invalid', False, '回應不是 JSON' if text else '空回應'
+    elif match and match.group(1) != '1':
+        # 站台活著但 API 回報錯誤(例如關閉了採集介面)
+        outcome, ok, message = 'ok', False, f'API 回應異常 (code {match.group(1)})'
+    else:
+        outcome, ok, message = 'ok', True, '檢查成功'
+    metrics.upstream(clean_url, 'health', outcome, elapsed)
+    if outcome == 'ok':
+        circuit_breaker.record_success(clean_url)
+    else:
+        circuit_breaker.record_failure(clean_url, message)
+    return ok, message, elapsed
+
+
+def check_site_health(site):
+    """檢查單一站點的健康狀態"""
+    if not site.get('enabled', True):
+        return True  # 已停用的站點不需要檢查
+    try:
+        ok, message, _ = probe_site(site)
+    except Exception:
+        logger.error(f"站點檢查發生未知錯誤: {site['name']} ({site['url']})", exc_info=True)
         return False
+    if ok:
+        logger.info(f"站點檢查成功: {site['name']} ({site['url']})")
+    else:
+        logger.warning(f"站點檢查失敗: {site['name']} ({site['url']}) - {message}")
+    return ok
+
+
+def apply_check_results(results):
+    """把一批檢查結果 {site_id: (是否健康, 耗時秒數)} 原子地寫回站台清單(只動檢查相關欄位)。"""
+    checked_at = datetime.now(timezone.utc).isoformat()
+
+    def _apply(sites):
+        for site in sites:
+            if site.get('id') not in results:
+                continue
+            ok, elapsed = results[site['id']]
+            site['last_check'] = checked_at
+            site['check_latency_ms'] = int(elapsed * 1000)
+            if ok:
+                site['consecutive_errors'] = 0
+                site['check_status'] = 'success'
+            else:
+                site['consecutive_errors'] = site.get('consecutive_errors', 0) + 1
+                site['check_status'] = 'failed'
+
+    return update_sites(_apply)
+
+
+# 「立即檢查」改成背景工作:API 立刻回 job id,前端輪詢進度。工作狀態存在 storage
+# (兩個 gunicorn worker 誰收到輪詢都讀得到)。檢查結果每湊滿 _CHECK_JOB_BATCH 站(或全部檢查完)
+# 才用一次 update_sites 寫回 sites.json 並更新工作進度,不會每站各重寫一次整份站台清單。
+CHECK_JOB_KEY = 'check_job.json'
+_CHECK_JOB_CONCURRENCY = 8
+_CHECK_JOB_BATCH = 8
+_CHECK_JOB_STALE = 600  # 執行中的工作超過這麼久沒進度,視為已中斷(例如 worker 被重啟),可以重開
 
 
-def check_sites_immediately(include_disabled=False):
-    """立即檢查所有站點並返回結果"""
+def _parse_job(raw):
+    try:
+        job = json.loads(raw) if raw else None
+    except ValueError:
+        return None
+    return job if isinstance(job, dict) else None
+
+
+def get_check_job(job_id=None):
+    """讀目前(最近一次)的檢查工作;給了 job_id 但不是同一個工作時回 None。"""
+    job = _parse_job(storage.get_text(CHECK_JOB_KEY))
+    if not job or (job_id and job.get('id') != job_id):
+        return None
+    return job
+
+
+def _update_job(job_id, fn):
+    def _apply(raw):
+        job = _parse_job(raw)
+        if not job or job.get('id') != job_id:
+            return raw or ''
+        fn(job)
+        job['updated_at'] = time.time()
+        return json.dumps(job, ensure_ascii=False)
+    storage.update_text(CHECK_JOB_KEY, _apply)
+
+
+def _check_result(site, ok, message, sites):
+    """組出給前端的單站結果(失敗時附上寫回後的連續錯誤數)。"""
+    if ok:
+        return {'id': site['id'], 'name': site['name'], 'url': site['url'], 'status': 'success', 'message': '檢查成功'}
+    saved = next((s for s in sites if s.get('id') == site['id']), site)
+    errors = saved.get('consecutive_errors', 0)
+    return {'id': site['id'], 'name': site['name'], 'url': site['url'], 'status': 'failed',
+            'message': f"{message}，連續錯誤 {errors} 次"}
+
+
+def _run_check_job(job_id, sites_to_check):
+    workers = max(1, min(_CHECK_JOB_CONCURRENCY, len(sites_to_check)))
+    checked = []  # 這一批還沒寫回的 (site, 是否健康, 訊息, 耗時秒數)
+    errors = []   # 這一批檢查本身出錯的站台結果
+
+    def _flush():
+        if not checked and not errors:
+            return
+        saved = []
+        if checked:
+            try:
+                saved = apply_check_results({site['id']: (ok, elapsed) for site, ok, _, elapsed in checked})
+            except Exception as e:
+                logger.error(f"寫回檢查結果失敗: {e}")
+        batch = [_check_result(site, ok, message, saved) for site, ok, message, _ in checked] + errors
+        checked.clear()
+        errors.clear()
+
+        def _progress(job):
+            job['results'].extend(batch)
+            job['done'] = len(job['results'])
+        _update_job(job_id, _progress)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='check-job') as pool:
+        futures = {pool.submit(probe_site, site): site for site in sites_to_check}
+        for future in concurrent.futures.as_completed(futures):
+            site = futures[future]
+            try:
+                checked.append((site,) + future.result())
+            except Exception as e:
+                logger.error(f"檢查站點 {site['name']} 時發生錯誤: {e}")
+                errors.append({'id': site['id'], 'name': site['name'], 'url': site['url'],
+                               'status': 'error', 'message': f'檢查錯誤: {str(e)}'})
+            if len(checked) + len(errors) >= _CHECK_JOB_BATCH:
+                _flush()
+    _flush()
+
+    def _finish(job):
+        job['status'] = 'done'
+        job['finished_at'] = time.time()
+    _update_job(job_id, _finish)
+    logger.info("立即檢查完成")
+
+
+def start_check_job(include_disabled=False):
+    """開始一個「立即檢查」工作並回傳工作狀態;已有進行中的工作就回傳那一個,不重複檢查。
+
+    檔案後端在背景執行緒跑;serverless(KV)回應送出後程序可能就被凍結,改成在請求內並行跑完。
+    """
     sites = get_sites()
     if include_disabled:
         sites_to_check = sites  # 檢查所有站點
@@ -116,52 +285,31 @@ def check_sites_immediately(include_disabled=False):
     else:
         sites_to_check = [s for s in sites if s.get('enabled', True)]  # 只檢查啟用站點
         logger.info(f"開始立即檢查啟用站點: {len(sites_to_check)} 個")
-    
-    results = []
-    
-    for site in sites_to_check:
-        try:
-            is_healthy = check_site_health(site)
-            
-            site['last_check'] = datetime.now(timezone.utc).isoformat()
-            if not is_healthy:
-                site.setdefault('consecutive_errors', 0)
-                site['consecutive_errors'] += 1
-                site['check_status'] = 'failed'
-                logger.warning(f"站點 {site['name']} 檢查失敗，連續錯誤 {site['consecutive_errors']} 次")
-                results.append({
-                    'name': site['name'],
-                    'url': site['url'],
-                    'status': 'failed',
-                    'message': f"檢查失敗，連續錯誤 {site['consecutive_errors']} 次"
-                })
-            else:
-                site['consecutive_errors'] = 0
-                site['check_status'] = 'success'
-                results.append({
-                    'name': site['name'],
-                    'url': site['url'],
-                    'status': 'success',
-                    'message': '檢查成功'
-                })
-                
-        except Exception as e:
-            logger.error(f"檢查站點 {site['name']} 時發生錯誤: {e}")
-            results.append({
-                'name': site['name'],
-                'url': site['url'],
-                'status': 'error',
-                'message': f'檢查錯誤: {str(e)}'
-            })
-    
-    # 儲存更新後的站點資料
-    save_sites(sites)
-    logger.info("立即檢查完成")
-    
-    return results
+
+    now = time.time()
+    job = {'id': secrets.token_hex(6), 'status': 'running', 'total': len(sites_to_check), 'done': 0,
+           'results': [], 'started_at': now, 'updated_at': now}
+    running = []
+
+    def _claim(raw):
+        current = _parse_job(raw)
+        if current and current.get('status') == 'running' and now - current.get('updated_at', 0) < _CHECK_JOB_STALE:
+            running.append(current)
+            return raw
+        return json.dumps(job, ensure_ascii=False)
+
+    storage.update_text(CHECK_JOB_KEY, _claim)
+    if running:
+        return running[0]
+    if storage.USE_KV:
+        _run_check_job(job['id'], sites_to_check)
+        return get_check_job(job['id']) or job
+    background.submit(('check_job', job['id']), _run_check_job, job['id'], sites_to_check)
+    return job
+
 
 def check_single_site_health(site_id):
-    """檢查單一站點的健康狀態"""
+    """檢查單一站點的健康狀態(只寫回這一站的檢查欄位)"""
     sites = get_sites()
     site = next((s for s in sites if s['id'] == site_id), None)
     
@@ -169,34 +317,12 @@ def check_single_site_health(site_id):
         raise ValueError(f"找不到ID為 {site_id} 的站點")
     
     try:
-        is_healthy = check_site_health(site)
-        
-        site['last_check'] = datetime.now(timezone.utc).isoformat()
-        if not is_healthy:
-            site.setdefault('consecutive_errors', 0)
-            site['consecutive_errors'] += 1
-            site['check_status'] = 'failed'
-            logger.warning(f"站點 {site['name']} 檢查失敗，連續錯誤 {site['consecutive_errors']} 次")
-            result = {
-                'name': site['name'],
-                'url': site['url'],
-                'status': 'failed',
-                'message': f"檢查失敗，連續錯誤 {site['consecutive_errors']} 次"
-            }
-        else:
-            site['consecutive_errors'] = 0
-            site['check_status'] = 'success'
-            result = {
-                'name': site['name'],
-                'url': site['url'],
-                'status': 'success',
-                'message': '檢查成功'
-            }
-            
-        # 儲存更新後的站點資料
-        save_sites(sites)
+        ok, message, elapsed = probe_site(site)
+        result = _check_result(site, ok, message, apply_check_results({site_id: (ok, elapsed)}))
+        if not ok:
+            logger.warning(f"站點 {site['name']} 檢查失敗: {result['message']}")
         logger.info(f"站點 {site['name']} 檢查完成: {result['status']}")
-        
+        del result['id']
         return result
         
     except Exception as e:
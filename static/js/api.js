@@ -111,6 +111,71 @@ export async function fetchMultiSiteVideoList(siteIds, page, keyword) {
     return await response.json();
 }
 
+// 串流版多站搜尋(NDJSON):每個站台完成就呼叫一次 onPartial(目前累積的結果),
+// 最後 resolve 成跟 fetchMultiSiteVideoList 相同格式、依相關度排好的完整結果。瀏覽器不支援串流讀取時退回一般版。
+export async function streamMultiSiteVideoList(siteIds, page, keyword, onPartial) {
+    const response = await fetch('/api/multi_site_search/stream', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ site_ids: siteIds, page, keyword })
+    });
+    if (!response.ok) {
+        const errData = await response.json().catch(() => ({ message: '多站點搜尋失敗' }));
+        if (errData.action) throw errData; // 拋出整個物件以進行重定向
+        throw new Error(errData.message);
+    }
+    if (!response.body || !response.body.getReader) {
+        return fetchMultiSiteVideoList(siteIds, page, keyword);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const list = [];
+    let pagecount = 0;
+    let buffer = '';
+    let summary = null;
+
+    const handleLine = (line) => {
+        if (!line.trim()) return;
+        const frame = JSON.parse(line);
+        if (frame.type === 'summary') {
+            summary = frame;
+            return;
+        }
+        list.push(...(frame.list || []));
+        pagecount = Math.max(pagecount, frame.pagecount || 0);
+        if (onPartial && frame.count > 0) {
+            onPartial({ status: 'success', list: list.slice(), page, pagecount: pagecount || page, total: list.length });
+        }
+    };
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let idx;
+        while ((idx = buffer.indexOf('\n')) >= 0) {
+            handleLine(buffer.slice(0, idx));
+            buffer = buffer.slice(idx + 1);
+        }
+    }
+    handleLine(buffer + decoder.decode());
+
+    if (!summary) throw new Error('多站點搜尋中斷');
+    if (!Array.isArray(summary.order)) return { ...summary, list };
+    // 最後一幀帶伺服器排好的相關度順序([site_id, vod_id]),照它重排,不依各站完成先後
+    const byKey = new Map();
+    for (const video of list) {
+        const key = `${video.from_site_id}|${video.vod_id}`;
+        if (!byKey.has(key)) byKey.set(key, []);
+        byKey.get(key).push(video);
+    }
+    const ranked = summary.order
+        .map(([siteId, vodId]) => (byKey.get(`${siteId}|${vodId}`) || []).shift())
+        .filter(Boolean);
+    return { ...summary, list: ranked };
+}
+
 export async function fetchVideoList(url, page, typeId, keyword) {
     try {
         const response = await fetch('/api/list', {
@@ -166,12 +231,20 @@ export async function fetchVideoList(url, page, typeId, keyword) {
     }
 }
 
+// 精簡格式的線路(names / urls 平行陣列)還原成前端慣用的 episodes: [{name, url}]
+function expandSources(sources) {
+    return sources.map(source => ({
+        flag: source.flag,
+        episodes: source.names.map((name, i) => ({ name, url: source.urls[i] }))
+    }));
+}
+
 export async function fetchVideoDetails(url, videoId) {
     try {
         const response = await fetch('/api/details', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ url, id: videoId })
+            body: JSON.stringify({ url, id: videoId, compact: true })
         });
 
         if (!response.ok) {
@@ -196,6 +269,8 @@ export async function fetchVideoDetails(url, videoId) {
             });
             throw new Error(result.message || 'API返回錯誤狀態');
         }
+        result.data = expandSources(result.sources || []);
+        delete result.sources;
         return result;
     } catch (error) {
         console.error('fetchVideoDetails 失敗:', {
@@ -222,6 +297,14 @@ export async function checkSitesNow(includeDisabled = false) {
     return response.json();
 }
 
+export async function getCheckJob(jobId) {
+    const response = await fetch(`/api/sites/check_now/${encodeURIComponent(jobId)}`);
+    if (!response.ok) {
+        throw new Error('取得檢查進度失敗');
+    }
+    return response.json();
+}
+
 export async function checkSingleSite(siteId) {
     const response = await fetch(`/api/sites/${siteId}/check`, {
         method: 'POST',
@@ -388,6 +388,19 @@ function handleCategorySelection(rawTypeId) {
     }
 }
 
+// 把一次清單結果寫進 state(串流搜尋時每收到一個站台就會呼叫一次)
+function applyListResult(result) {
+    state.videos = result.list;
+    state.currentPage = Number(result.page);
+    state.totalPages = Number(result.pagecount);
+
+    // 聚合 + 切顯示頁(雙層分頁的內層)
+    state.aggregated = ui.aggregateVideos(state.videos);
+    state.innerPageCount = Math.max(1, Math.ceil(state.aggregated.length / ui.INNER_PAGE_SIZE));
+    // 一般跳到第 1 個顯示頁;若是「往前跨資料頁」則停在最後一個顯示頁(連續往回)
+    state.displayPage = state._pendingDisplayLast ? state.innerPageCount : 1;
+}
+
 async function fetchAndRender(urlMode = 'auto') {
     const isMultiSiteSearch = state.searchSiteIds.length > 0;
 
@@ -407,14 +420,18 @@ async function fetchAndRender(urlMode = 'auto') {
     try {
         let result;
         if (isMultiSiteSearch) {
-            result = await api.fetchMultiSiteVideoList(
+            // 串流:快的站台先回來就先畫,不必等最慢的站台逾時
+            result = await api.streamMultiSiteVideoList(
                 state.searchSiteIds,
                 state.currentPage,
-                state.currentKeyword
+                state.currentKeyword,
+                (partial) => {
+                    ui.showLoader(false);
+                    applyListResult(partial);
+                    refreshView();
+                }
             );
 
-
-
             // In multi-site search, categories are disabled.
             state.categories = [];
             ui.renderCategories([]);
@@ -427,15 +444,7 @@ async function fetchAndRender(urlMode = 'auto') {
             );
         }
 
-        state.videos = result.list;
-        state.currentPage = Number(result.page);
-        state.totalPages = Number(result.pagecount);
-
-        // 聚合 + 切顯示頁(雙層分頁的內層)
-        state.aggregated = ui.aggregateVideos(state.videos);
-        state.innerPageCount = Math.max(1, Math.ceil(state.aggregated.length / ui.INNER_PAGE_SIZE));
-        // 一般跳到第 1 個顯示頁;若是「往前跨資料頁」則停在最後一個顯示頁(連續往回)
-        state.displayPage = state._pendingDisplayLast ? state.innerPageCount : 1;
+        applyListResult(result);
         state._pendingDisplayLast = false;
 
         if (!isMultiSiteSearch && result.class && result.class.length > 0) {
@@ -149,6 +149,14 @@ function renderSiteList(sites) {
             }
         }
 
+        // 熔斷狀態(由實際搜尋 / 瀏覽的成敗驅動,不必按檢查)
+        let breakerDisplay = '';
+        if (site.breaker && site.breaker.state === 'open') {
+            breakerDisplay = `<span class="check-failed" title="${site.breaker.last_error || ''}">⏸ 已熔斷(${site.breaker.retry_in} 秒後試探)</span>`;
+        } else if (site.breaker && site.breaker.state === 'half_open') {
+            breakerDisplay = '<span class="check-failed">⏸ 試探中</span>';
+        }
+
         li.innerHTML = `
             <div class="site-info">
                 <input type="text" class="site-name-input" value="${site.name}" placeholder="站點名稱">
@@ -158,6 +166,7 @@ function renderSiteList(sites) {
             <div class="site-status">
                 <div class="check-info">
                     <span class="check-result">${checkStatusDisplay}</span>
+                    ${breakerDisplay}
                     <span class="check-time">${checkTimeDisplay ? `檢查時間: ${checkTimeDisplay}` : '尚未檢查'}</span>
                 </div>
             </div>
@@ -182,6 +191,8 @@ function renderSiteList(sites) {
     });
 }
 
+const CHECK_POLL_INTERVAL = 1000; // 立即檢查的進度輪詢間隔(毫秒)
+
 async function handleCheckAllSites() {
     const checkBtn = $('#checkAllSitesBtn');
     const statusDiv = $('#checkStatus');
@@ -192,12 +203,21 @@ async function handleCheckAllSites() {
         checkBtn.textContent = '檢查中...';
         statusDiv.innerHTML = '<span class="checking">正在檢查站點...</span>';
 
-        // 呼叫立即檢查API
+        // 呼叫立即檢查API:伺服器立刻回傳工作,之後輪詢進度,邊檢查邊顯示已完成的站點
         const result = await api.checkSitesNow(includeDisabled);
 
         if (result.status === 'success') {
+            let job = result.job;
+            while (job.status === 'running') {
+                checkBtn.textContent = `檢查中 (${job.done}/${job.total})...`;
+                if (job.results.length > 0) {
+                    displayCheckResults(job.results);
+                }
+                await new Promise(resolve => setTimeout(resolve, CHECK_POLL_INTERVAL));
+                job = (await api.getCheckJob(job.id)).job;
+            }
             // 顯示檢查結果清單
-            displayCheckResults(result.results);
+            displayCheckResults(job.results);
         } else {
             statusDiv.innerHTML = `<span class="check-failed">檢查失敗: ${result.message}</span>`;
         }
@@ -43,6 +43,7 @@ export default {
     onHistoryUpdate: null, // 歷史記錄更新回調函數
     onPlaybackChange: null, // 播放開始時的回調(更新收藏星號)
     historyUpdateInfo: {}, // 存儲歷史記錄的更新信息 {videoId_siteUrl: {hasUpdate: bool, newEpisodesCount: number}}
+    serverUpdateFlags: false, // GET /api/history 已帶伺服器背景算好的更新標記
 
     // 檢查是否需要檢查歷史記錄更新（10分鐘內不重複檢查）
     shouldCheckHistoryUpdates() {
@@ -61,6 +62,18 @@ export default {
         localStorage.setItem('lastHistoryUpdateCheck', Date.now().toString());
     },
 
+    // 伺服器回的歷史 / 收藏項目若帶 hasUpdate,記進 historyUpdateInfo(同 check_updates 的結果格式)
+    applyServerUpdateFlags(items) {
+        items.forEach(item => {
+            if (item && item.hasUpdate) {
+                this.historyUpdateInfo[`${item.videoId}_${item.siteUrl}`] = {
+                    hasUpdate: true,
+                    newEpisodesCount: item.newEpisodesCount
+                };
+            }
+        });
+    },
+
     // 清除歷史記錄更新信息
     clearHistoryUpdateInfo() {
         this.historyUpdateInfo = {};
@@ -156,6 +169,9 @@ export default {
         try {
             const res = await fetch('/api/history');
             const data = res.ok ? await res.json() : [];
+            // 伺服器背景偵測有在跑:回應已帶算好的 hasUpdate / totalEpisodes,開頁不必再打 check_updates
+            this.serverUpdateFlags = res.headers.get('X-Update-Status') === 'precomputed';
+            this.applyServerUpdateFlags(Array.isArray(data) ? data : []);
             // 每筆 canonical 炸成「每線路一筆」(相容舊 lines 表),再去重
             const list = Array.isArray(data) ? this._dedupeHistory(data.flatMap(c => this._historyFromCanonical(c))) : [];
             // 保留墓碑(deletedAt>0)一起存,下次寫回時帶上去讓刪除跨裝置生效;但超過 TTL 的墓碑清掉
@@ -1053,8 +1053,8 @@ export function showHistoryPanel() {
                     }, { passive: false });
                 }
 
-                // 檢查是否需要檢查更新（10分鐘內不重複檢查）
-                if (state.shouldCheckHistoryUpdates()) {
+                // 檢查是否需要檢查更新（10分鐘內不重複檢查）;伺服器已背景算好標記時不必再查
+                if (!state.serverUpdateFlags && state.shouldCheckHistoryUpdates()) {
                     await performHistoryUpdateCheck();
                 }
             }
@@ -1282,7 +1282,7 @@ async function performHistoryUpdateCheck() {
     document.body.appendChild(checkingToast);
 
     try {
-        // 準備前5個歷史記錄的數據（後端會再次限制最多10個）
+        // 整份歷史一起送:後端依站台分組、每站批次查詳情並同時進行
         // 各線路獨立 → 同片同站可能多筆,檢查更新以「片+站」去重,避免重複送同一部片
         const seenVS = new Set();
         const itemsToCheck = state.activeHistory().filter(item => {
@@ -1290,7 +1290,7 @@ async function performHistoryUpdateCheck() {
             if (seenVS.has(k)) return false;
             seenVS.add(k);
             return true;
-        }).slice(0, 5).map(item => ({
+        }).map(item => ({
             videoId: item.videoId,
             videoName: item.videoName,
             siteUrl: item.siteUrl,
@@ -15,6 +15,8 @@ import threading
 import tempfile
 import shutil
 import requests
+import codec as json
+import metrics
 
 DATA_DIR = 'data'
 
@@ -38,6 +40,11 @@ _KV_LOCK_WAIT_S = 5.0
 _KV_LOCK_RETRY_S = 0.05
 
 
+metrics.describe('storage_call_seconds', 'histogram', 'Storage backend call latency in seconds.')
+metrics.describe('storage_lock_wait_seconds', 'histogram', 'Time spent waiting for the update_text lock.')
+metrics.describe('storage_lock_timeouts_total', 'counter', 'KV update_text lock acquisitions that timed out.')
+
+
 _writable_cache = None
 
 def is_writable():
@@ -66,14 +73,15 @@ def is_writable():
 
 def _kv_command(*args):
     """對 Upstash REST API 送一個 Redis 指令（命令陣列形式）。"""
-    resp = requests.post(
-        _KV_URL,
-        json=list(args),
-        headers={'Authorization': f'Bearer {_KV_TOKEN}'},
-        timeout=_KV_TIMEOUT,
-    )
+    with metrics.timer('storage_call_seconds', backend='kv', op=str(args[0]).lower()):
+        resp = requests.post(
+            _KV_URL,
+            json=list(args),
+            headers={'Authorization': f'Bearer {_KV_TOKEN}'},
+            timeout=_KV_TIMEOUT,
+        )
     resp.raise_for_status()
-    return resp.json().get('result')
+    return json.loads(resp.content).get('result')
 
 
 def _atomic_write(path, data):
@@ -98,15 +106,16 @@ def get_text(key):
     if USE_KV:
         return _kv_command('GET', _KV_PREFIX + key)
     path = os.path.join(DATA_DIR, key)
-    if not os.path.exists(path):
-        return None
-    with open(path, 'r', encoding='utf-8') as f:
-        return f.read()
+    with metrics.timer('storage_call_seconds', backend='file', op='get'):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
 
 
 def _write_file(key, data):
     """檔案後端的寫入；唯讀環境（未連 KV 的 serverless）會給出明確訊息而非裸 OSError。"""
-    with _file_lock:
+    with _file_lock, metrics.timer('storage_call_seconds', backend='file', op='set'):
         try:
             _atomic_write(os.path.join(DATA_DIR, key), data)
         except OSError as e:
@@ -159,7 +168,11 @@ def update_text(key, fn):
     if USE_KV:
         lock_key = _KV_PREFIX + 'lock:' + key
         token = secrets.token_urlsafe(16)
+        waited = time.monotonic()
         locked = _kv_acquire_lock(lock_key, token)
+        metrics.observe('storage_lock_wait_seconds', time.monotonic() - waited, backend='kv')
+        if not locked:
+            metrics.inc('storage_lock_timeouts_total', backend='kv')
         try:
             new_val = fn(get_text(key))
             set_text(key, new_val)
@@ -167,7 +180,9 @@ def update_text(key, fn):
         finally:
             if locked:
                 _kv_release_lock(lock_key, token)
+    waited = time.monotonic()
     with _file_lock:
+        metrics.observe('storage_lock_wait_seconds', time.monotonic() - waited, backend='file')
         new_val = fn(get_text(key))
         set_text(key, new_val)
         return new_val
@@ -0,0 +1,214 @@
+# update_detector.py
+#
+# 便宜的新集數偵測。原本檢查更新要對每一筆觀看歷史各抓一次完整詳情(整串播放網址),
+# 上游請求數跟歷史筆數成正比。MacCMS 的 ac=list&h=N 會列出最近 N 小時有更新的影片(帶 vod_time / vod_remarks),
+# 所以這裡定期(update_check_interval,預設 30 分鐘)對每個站台只讀這份「最近更新」列表:
+#   - 收集所有帳號(管理員 + 會員)history_<帳號> / favorites_<帳號> 裡的 (站台, videoId);
+#   - 每站讀一次 ac=list&h=N(N 依該站上次成功的時間算,第一次用 update_check_max_hours),跟關注的 id 取交集;
+#   - 只有真的變了(vod_time 跟上次記錄不同)的影片才丟掉詳情快取、以 get_details_batch 批次抓完整詳情;
+#     新加入歷史 / 收藏、還沒有記錄的影片也批次查一次,當作之後比對的基準;
+#   - 結果(總集數、vod_remarks、vod_time)存在 storage 的 update_status.json,key 是「站台網址|videoId」。
+# 一輪的上游請求數因此從 O(歷史筆數) 變成 O(站台數)。某站窗口內更新量大到超過翻頁上限時,
+# 那一站退回直接批次查所有關注影片的詳情(一樣是批次,不是一筆一請求)。
+#
+# 登記成 periodic 的定期工作(多 worker 只有租約持有者執行、serverless 不跑);
+# config.json 的 update_detector 設 false 可關閉。
+
+import math
+import time
+import concurrent.futures
+import codec as json
+import storage
+import periodic
+import response_cache
+from config import get_config_value
+from site_manager import get_sites
+from api_parser import get_recent_changes, get_details_batch, normalize_base_url
+from blueprints.auth import get_members
+from logger_config import setup_logger
+
+STATUS_KEY = 'update_status.json'
+DEFAULT_INTERVAL = 1800   # 秒
+DEFAULT_MAX_HOURS = 72    # ac=list&h= 最多往回看幾小時(第一次執行、或很久沒成功時)
+DEFAULT_BUDGET = 120      # 一輪的時間預算(秒),到了就不再送新請求,沒查完的站台下一輪再查
+DEFAULT_CONCURRENCY = 4
+
+logger = setup_logger()
+
+
+def active():
+    """偵測是否在背景跑;不跑時(serverless / 關閉)前端要自己呼叫 /api/history/check_updates。"""
+    return periodic.enabled() and bool(get_config_value('update_detector', True))
+
+
+def account_ids():
+    """所有會有歷史 / 收藏的帳號:管理員固定 'admin',會員 'm<id>'(跟 auth.authenticate 一致)。"""
+    return ['admin'] + [f"m{m['id']}" for m in get_members() if m.get('id') is not None]
+
+
+def _stored_list(key):
+    try:
+        data = json.loads(storage.get_text(key) or '[]')
+    except ValueError:
+        return []
+    return data if isinstance(data, list) else []
+
+
+def watched_videos():
+    """{站台 clean url: {'site_url': 原始網址, 'ids': {videoId 字串}}},略過已刪除的墓碑。"""
+    watched = {}
+    for account_id in account_ids():
+        for key in (f'history_{account_id}', f'favorites_{account_id}'):
+            for item in _stored_list(key):
+                if not isinstance(item, dict) or item.get('deletedAt'):
+                    continue
+                site_url, video_id = item.get('siteUrl'), item.get('videoId')
+                if not site_url or video_id is None:
+                    continue
+                entry = watched.setdefault(normalize_base_url(site_url), {'site_url': site_url, 'ids': set()})
+                entry['ids'].add(str(video_id))
+    return watched
+
+
+def status_key(site_url, video_id):
+    return f'{normalize_base_url(site_url)}|{video_id}'
+
+
+def annotate(items):
+    """GET /api/history、/api/favorites 用:依最近一輪的偵測結果補上 totalEpisodes(最新總集數)
+    與 hasUpdate / newEpisodesCount(比項目自己記的集數多)。只讀 storage,不打上游;
+    回傳新的 list,不改原本的項目。記錄的集數為 0(第一次記)不算更新,跟 check_updates 一致。"""
+    videos = load_status()['videos']
+    if not videos:
+        return items
+    annotated = []
+    for item in items:
+        known = None
+        if isinstance(item, dict) and not item.get('deletedAt') and item.get('siteUrl') \
+                and item.get('videoId') is not None:
+            known = videos.get(status_key(item['siteUrl'], item['videoId']))
+        if not known or not known.get('totalEpisodes'):
+            annotated.append(item)
+            continue
+        old = item.get('totalEpisodes') if isinstance(item.get('totalEpisodes'), (int, float)) else 0
+        latest = known['totalEpisodes']
+        item = dict(item, totalEpisodes=max(latest, old), hasUpdate=bool(old and latest > old))
+        if item['hasUpdate']:
+            item['newEpisodesCount'] = latest - old
+        annotated.append(item)
+    return annotated
+
+
+def load_status():
+    try:
+        data = json.loads(storage.get_text(STATUS_KEY) or '{}')
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    data.setdefault('videos', {})
+    data.setdefault('sites', {})
+    return data
+
+
+def _hours_since(last_ok, now):
+    max_hours = get_config_value('update_check_max_hours', DEFAULT_MAX_HOURS)
+    if not last_ok:
+        return max_hours
+    # 多看一小時,避免剛好卡在整點邊界漏掉
+    return max(1, min(max_hours, math.ceil((now - last_ok) / 3600) + 1))
+
+
+def check_site(clean_url, entry, site, known, last_ok, now, deadline):
+    """查一個站台。回傳 ({videoId: 狀態}, 是否推進水位)。"""
+    ssl_verify = site.get('ssl_verify', True) if site else True
+    site_name = site['name'] if site else clean_url
+    hours = _hours_since(last_ok, now)
+    changes, complete, error = get_recent_changes(entry['site_url'], hours, logger, ssl_verify=ssl_verify,
+                                                  site_name=site_name, deadline=deadline)
+    if error:
+        logger.warning(f"站點 [{site_name}] 最近更新列表讀取失敗: {error}")
+    if complete or error:
+        # 變了的,加上還沒有記錄的(新加入歷史 / 收藏):後者只查一次,之後就靠最近更新列表
+        changed = [vid for vid in entry['ids'] if vid not in known or
+                   (vid in changes and known[vid].get('vodTime') != changes[vid]['vod_time'])]
+    else:
+        # 窗口內更新太多、翻頁讀不完:改成直接批次查這站所有關注的影片
+        changed = sorted(entry['ids'])
+    results = {}
+    if changed:
+        for vid in changed:
+            response_cache.drop_detail(clean_url, vid)
+        details, detail_error = get_details_batch(entry['site_url'], changed, logger, ssl_verify=ssl_verify,
+                                                  site_name=site_name, deadline=deadline)
+        if detail_error:
+            logger.warning(f"站點 [{site_name}] 更新影片詳情讀取失敗: {detail_error}")
+            error = error or detail_error
+        checked_at = int(time.time() * 1000)
+        for vid, detail in details.items():
+            if not detail.get('sources'):
+                continue
+            change = changes.get(vid, {})
+            results[vid] = {
+                'totalEpisodes': max(source['count'] for source in detail['sources']),
+                'remarks': change.get('vod_remarks', ''),
+                'vodTime': change.get('vod_time', ''),
+                'checkedAt': checked_at,
+            }
+    return results, error is None
+
+
+def run_round():
+    """跑一輪偵測,回傳這輪更新了幾部影片的狀態。"""
+    started = time.time()
+    watched = watched_videos()
+    sites = {normalize_base_url(s['url']): s for s in get_sites()}
+    watched = {url: entry for url, entry in watched.items()
+               if url not in sites or sites[url].get('enabled', True)}
+    if not watched:
+        return 0
+    status = load_status()
+    deadline = time.monotonic() + get_config_value('update_check_budget', DEFAULT_BUDGET)
+
+    prefix = {url: f'{url}|' for url in watched}
+    known = {url: {k[len(p):]: v for k, v in status['videos'].items() if k.startswith(p)}
+             for url, p in prefix.items()}
+    found, advanced = {}, []
+    workers = max(1, min(get_config_value('update_check_concurrency', DEFAULT_CONCURRENCY), len(watched)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update-check') as pool:
+        futures = {pool.submit(check_site, url, entry, sites.get(url), known[url],
+                               status['sites'].get(url), started, deadline): url
+                   for url, entry in watched.items()}
+        for future in concurrent.futures.as_completed(futures):
+            url = futures[future]
+            try:
+                results, ok = future.result()
+            except Exception as e:
+                logger.error(f"更新偵測 {url} 失敗: {e}", exc_info=True)
+                continue
+            found.update({f'{url}|{vid}': result for vid, result in results.items()})
+            if ok:
+                advanced.append(url)
+
+    keep = {f'{url}|{vid}' for url, entry in watched.items() for vid in entry['ids']}
+
+    def _merge(raw):
+        try:
+            current = json.loads(raw) if raw else {}
+        except ValueError:
+            current = {}
+        videos = {k: v for k, v in (current.get('videos') or {}).items() if k in keep}
+        videos.update(found)
+        marks = {url: ts for url, ts in (current.get('sites') or {}).items() if url in watched}
+        marks.update({url: started for url in advanced})
+        return json.dumps({'videos': videos, 'sites': marks})
+
+    storage.update_text(STATUS_KEY, _merge)
+    logger.info(f"更新偵測完成: {len(watched)} 個站台({len(advanced)} 個成功),"
+                f"{sum(len(e['ids']) for e in watched.values())} 部關注影片,{len(found)} 部有變動")
+    return len(found)
+
+
+periodic.register('update_detector', run_round,
+                  lambda: get_config_value('update_check_interval', DEFAULT_INTERVAL),
+                  enabled=lambda: bool(get_config_value('update_detector', True)))
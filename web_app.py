@@ -4,6 +4,11 @@ import os
 from flask import Flask, cli
 from config import get_config_value, set_config_value
 from logger_config import setup_logger
+from codec import CodecJSONProvider
+import periodic
+import health_monitor  # noqa: F401 - import 時登記定期工作
+import update_detector  # noqa: F401
+import catalog  # noqa: F401
 
 # --- Blueprints ---
 from blueprints.auth import auth_bp, init_auth_check
@@ -14,6 +19,7 @@ from blueprints.members import members_bp
 # --- Flask App Initialization ---
 cli.show_server_banner = lambda *x: None
 app = Flask(__name__)
+app.json = CodecJSONProvider(app)  # jsonify / request.json 也走 codec(orjson 優先)
 logger = setup_logger()
 
 # --- Version Configuration ---
@@ -56,6 +62,11 @@ app.register_blueprint(members_bp)
 # --- Initialize Request Hooks ---
 init_auth_check(app)
 
+# --- Background Jobs (health monitor / update detector / catalog) ---
+# gunicorn --preload 會在 fork 前 import 本檔,執行緒不會跟進 worker;
+# 所以等每個 worker 收到第一個請求時才啟動(serverless 環境會自動略過)。
+app.before_request(periodic.ensure_started)
+
 
 
 # --- Main Execution ---